@@ -7,81 +7,515 @@ import yaml
 import logging
 from pathlib import Path
 from typing import Dict, List, Any, Optional, Tuple, Generator
-from dataclasses import dataclass
+from dataclasses import dataclass, asdict, field
 import pandas as pd
+from pandas.io.parsers import TextParser
+import numpy as np
 import openpyxl
 from openpyxl.styles import Font, PatternFill, Border, Side, Alignment
 from openpyxl.utils.dataframe import dataframe_to_rows
+from openpyxl.utils import get_column_letter, column_index_from_string
+from openpyxl.cell import WriteOnlyCell
 from copy import copy
 import gc
+import array
 import time
+import tracemalloc
+import itertools
 from io import BytesIO
 import zipfile
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import tempfile
+import hashlib
+import re
+import fnmatch
+import shutil
+from xml.sax.saxutils import escape as xml_escape
+import xml.etree.ElementTree as ET
+import posixpath
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+from openpyxl.utils.datetime import to_excel
+from openpyxl.utils.units import DEFAULT_COLUMN_WIDTH
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 import threading
-from collections import defaultdict
+import heapq
+import numbers
+from datetime import date, datetime
+from collections import defaultdict, deque
+from contextlib import contextmanager
 
 # 配置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-class DetailedTimer:
-    """详细计时器，用于跟踪各个步骤的耗时"""
+class LatencyHistogram:
+    """HDR风格的耗时直方图：按微秒计，小于64微秒精确计数，之后每个2的幂区间等分为64个桶
+    
+    相对误差不超过1/64（约1.6%），桶数与记录次数无关（覆盖到数小时也只有约2000个桶），
+    可以在长期运行的服务中常驻。次数、总耗时、最短和最长耗时精确记录。
+    """
+    
+    SUB_BUCKETS = 64
+    __slots__ = ('buckets', 'count', 'total', 'min', 'max')
     
     def __init__(self):
-        self.timers = defaultdict(list)  # 存储每个步骤的多次计时
-        self.current_timers = {}  # 当前正在计时的步骤
+        self.buckets = {}  # 桶序号 -> 次数
+        self.count = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+    
+    @classmethod
+    def _bucket(cls, micros: int) -> int:
+        if micros < cls.SUB_BUCKETS:
+            return micros
+        shift = micros.bit_length() - 7  # 使 micros >> shift 落在 [64, 128)
+        return (shift + 1) * cls.SUB_BUCKETS + (micros >> shift) - cls.SUB_BUCKETS
+    
+    @classmethod
+    def _bucket_value(cls, index: int) -> float:
+        """桶的代表值(微秒)：取桶区间的中点"""
+        if index < cls.SUB_BUCKETS:
+            return float(index)
+        shift = index // cls.SUB_BUCKETS - 1
+        lower = (index % cls.SUB_BUCKETS + cls.SUB_BUCKETS) << shift
+        return lower + ((1 << shift) - 1) / 2
+    
+    def record(self, seconds: float):
+        """记录一次耗时(秒)"""
+        index = self._bucket(max(int(seconds * 1e6), 0))
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.total += seconds
+        if seconds < self.min:
+            self.min = seconds
+        if seconds > self.max:
+            self.max = seconds
+    
+    def merge(self, other: 'LatencyHistogram'):
+        """合并另一个直方图"""
+        for index, count in list(other.buckets.items()):
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+    
+    def quantile(self, q: float) -> float:
+        """第q分位数(秒)，结果限制在[最短, 最长]之间"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                return min(max(self._bucket_value(index) / 1e6, self.min), self.max)
+        return self.max
+
+@dataclass
+class TimerSpan:
+    """一次计时区间：记录所在进程/线程、父区间和perf_counter时间戳"""
+    span_id: int
+    name: str
+    parent_id: Optional[int]  # 同一线程中外层区间的span_id
+    pid: int
+    thread_ident: int
+    thread_name: str
+    start: float               # time.perf_counter()
+    end: Optional[float] = None
+    args: Dict[str, Any] = field(default_factory=dict)
+
+class DetailedTimer:
+    """详细计时器，用于跟踪各个步骤的耗时
+    
+    有两种模式：
+    - "detailed"（默认）：每次开始/结束都记录日志、区间和内存采样；
+    - "aggregate"：只在各线程自己的耗时直方图中累计，不加全局锁、不逐次记日志，
+      汇总时合并各线程累计器，适合在生产环境中常开。
+    详细模式下每次计时同时记录为一个区间(TimerSpan)：同一线程内嵌套的计时构成父子关系，
+    可用 export_chrome_trace 导出为Chrome trace / Perfetto可以打开的JSON。
+    开启内存采样后，后台线程定时采样进程内存（RSS，可选tracemalloc跟踪的Python分配），
+    并把采样峰值归到当时正在计时的所有步骤上，每个步骤额外记录峰值和增量内存。
+    """
+    
+    def __init__(self, max_spans: int = 100000):
+        self.timers = defaultdict(LatencyHistogram)  # 每个步骤的耗时直方图（不保留每次的原始耗时）
+        self.current_timers = {}  # 当前正在计时的步骤：(步骤名, 线程) -> 开始时间(perf_counter)
         self.thread_timers = defaultdict(dict)  # 线程级别的计时
+        self.spans = deque(maxlen=max_spans)  # 已结束的区间，超出上限时丢弃最早的
+        self._open_spans = {}  # 正在计时的步骤 -> TimerSpan
+        self._span_ids = itertools.count(1)
+        self._local = threading.local()  # 每个线程当前打开的区间栈、累计模式下的计时和累计器
+        self.mode = "detailed"
+        self._accumulators = []  # 累计模式下各线程的 (线程, 步骤 -> LatencyHistogram)
+        self._retired = {}  # 已结束线程的累计结果
+        # reset()前的累计耗时直方图和峰值内存，不随reset清空，供指标导出使用
+        self._lifetime = {}
+        self._lifetime_peaks = {}
+        # 每个步骤的内存汇总：[次数, 最高峰值RSS, 最大峰值增长, 净增量之和, 最大Python分配峰值增长]
+        self.memory = {}
+        self._open_memory = {}  # 正在计时的步骤 -> [起始RSS, 峰值RSS, 起始Python分配, 峰值Python分配]
+        self._process = None
+        self._sampler = None
+        self._sampler_stop = None
+        self._sample_interval = 0.05
         self._lock = threading.Lock()
     
-    def start(self, step_name: str, thread_id: str = None):
-        """开始计时"""
+    def enable_memory_sampling(self, interval: float = 0.05, trace_python: bool = False):
+        """开启后台内存采样，interval为采样间隔(秒)；trace_python同时用tracemalloc跟踪Python分配（开销较大）"""
+        try:
+            import psutil
+            self._process = psutil.Process()
+        except ImportError:
+            logger.warning("psutil模块不可用，内存采样功能将被禁用")
+            return
+        if trace_python and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        with self._lock:
+            self._sample_interval = interval
+            if self._sampler is not None and self._sampler.is_alive():
+                return
+            self._sampler_stop = threading.Event()
+            self._sampler = threading.Thread(target=self._sample_memory, name="memory-sampler", daemon=True)
+            self._sampler.start()
+    
+    def disable_memory_sampling(self):
+        """停止后台内存采样"""
+        with self._lock:
+            sampler, self._sampler = self._sampler, None
+            self._open_memory.clear()
+        if sampler is not None:
+            self._sampler_stop.set()
+            sampler.join()
+    
+    def _memory_now(self) -> Tuple[int, int]:
+        """当前进程RSS和tracemalloc跟踪的Python分配（未跟踪时为0）"""
+        rss = self._process.memory_info().rss
+        traced = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else 0
+        return rss, traced
+    
+    def _sample_memory(self):
+        """采样线程：把当前内存计入所有正在计时的步骤的峰值"""
+        while not self._sampler_stop.wait(self._sample_interval):
+            if not self._open_memory:
+                continue
+            try:
+                rss, traced = self._memory_now()
+            except Exception:
+                continue
+            with self._lock:
+                for sample in self._open_memory.values():
+                    sample[1] = max(sample[1], rss)
+                    sample[3] = max(sample[3], traced)
+    
+    def set_mode(self, mode: str):
+        """切换计时模式："detailed" 或 "aggregate"
+        
+        模式对整个进程生效；切换前已开始的计时仍按开始时的模式结束。
+        """
+        if mode not in ("detailed", "aggregate"):
+            raise ValueError(f"不支持的计时模式: {mode}")
+        self.mode = mode
+    
+    def _thread_accumulator(self) -> Dict[str, LatencyHistogram]:
+        """当前线程的累计器，首次使用时登记，同时把已结束线程的累计结果合并进_retired"""
+        acc = getattr(self._local, 'acc', None)
+        if acc is None:
+            acc = self._local.acc = {}
+            with self._lock:
+                alive = []
+                for thread, thread_acc in self._accumulators:
+                    if thread.is_alive():
+                        alive.append((thread, thread_acc))
+                    else:
+                        self._merge_accumulator(self._retired, thread_acc)
+                alive.append((threading.current_thread(), acc))
+                self._accumulators = alive
+        return acc
+    
+    @staticmethod
+    def _merge_accumulator(totals: Dict[str, LatencyHistogram], acc: Dict[str, LatencyHistogram]):
+        for step, histogram in list(acc.items()):
+            total = totals.get(step)
+            if total is None:
+                total = totals[step] = LatencyHistogram()
+            total.merge(histogram)
+    
+    def _accumulate(self, step_name: str, elapsed: float):
+        """累计模式：只更新当前线程的直方图，不加锁"""
+        acc = self._thread_accumulator()
+        histogram = acc.get(step_name)
+        if histogram is None:
+            histogram = acc[step_name] = LatencyHistogram()
+        histogram.record(elapsed)
+    
+    def _aggregate_totals(self) -> Dict[str, LatencyHistogram]:
+        """合并所有线程的累计结果（调用方需持有锁）"""
+        totals = {}
+        self._merge_accumulator(totals, self._retired)
+        for _, acc in self._accumulators:
+            self._merge_accumulator(totals, acc)
+        return totals
+    
+    @staticmethod
+    def _timer_key(step_name: str, thread_id: str = None) -> Tuple[str, Any]:
+        """计时键：未指定thread_id时按当前线程区分，并发线程中的同名步骤不会互相覆盖"""
+        return step_name, thread_id if thread_id else threading.get_ident()
+    
+    def _span_stack(self) -> List[TimerSpan]:
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+    
+    def start(self, step_name: str, thread_id: str = None, **args):
+        """开始计时，args作为区间参数记录（如 sheet="员工信息"），导出trace时可见"""
+        if self.mode == "aggregate":
+            open_timers = getattr(self._local, 'open', None)
+            if open_timers is None:
+                open_timers = self._local.open = {}
+            open_timers[self._timer_key(step_name, thread_id)] = time.perf_counter()
+            return
+        memory_now = self._memory_now() if self._sampler is not None else None
+        stack = self._span_stack()
+        thread = threading.current_thread()
+        span = TimerSpan(
+            span_id=next(self._span_ids),
+            name=step_name,
+            parent_id=stack[-1].span_id if stack else None,
+            pid=os.getpid(),
+            thread_ident=thread.ident,
+            thread_name=thread.name,
+            start=time.perf_counter(),
+            args=args
+        )
         with self._lock:
-            timer_key = f"{step_name}_{thread_id}" if thread_id else step_name
-            self.current_timers[timer_key] = time.time()
+            timer_key = self._timer_key(step_name, thread_id)
+            self.current_timers[timer_key] = span.start
+            # 同一步骤未结束又重新开始时，旧区间不再作为后续区间的父区间
+            stale = self._open_spans.pop(timer_key, None)
+            if stale is not None and stale in stack:
+                stack.remove(stale)
+            stack.append(span)
+            self._open_spans[timer_key] = span
+            if memory_now is not None:
+                rss, traced = memory_now
+                self._open_memory[timer_key] = [rss, rss, traced, traced]
             logger.info(f"[计时开始] {step_name}" + (f" (线程: {thread_id})" if thread_id else ""))
     
+    def _close_span(self, span: TimerSpan, extra_info: str = ""):
+        """结束区间并从所在线程的区间栈中移除"""
+        span.end = time.perf_counter()
+        if extra_info:
+            span.args['info'] = extra_info
+        stack = self._span_stack()
+        if span in stack:
+            stack.remove(span)
+        self.spans.append(span)
+    
     def end(self, step_name: str, thread_id: str = None, extra_info: str = ""):
-        """结束计时并记录"""
+        """结束计时并记录
+        
+        按计时开始时的模式结束：计时期间其他会话可能切换了模式，详细模式开始的步骤
+        仍要从current_timers和区间栈中移除，否则后续区间的父区间会出错。
+        """
+        timer_key = self._timer_key(step_name, thread_id)
+        open_timers = getattr(self._local, 'open', None)
+        started = open_timers.pop(timer_key, None) if open_timers else None
+        if started is not None:
+            self._accumulate(step_name, time.perf_counter() - started)
+            return
+        if self.mode == "aggregate" and timer_key not in self.current_timers:
+            return
+        memory_now = self._memory_now() if self._sampler is not None else None
         with self._lock:
-            timer_key = f"{step_name}_{thread_id}" if thread_id else step_name
             if timer_key in self.current_timers:
-                elapsed = time.time() - self.current_timers[timer_key]
-                self.timers[step_name].append(elapsed)
+                elapsed = time.perf_counter() - self.current_timers[timer_key]
+                self.timers[step_name].record(elapsed)
+                span = self._open_spans.pop(timer_key, None)
+                if span is not None:
+                    self._close_span(span, extra_info)
                 
                 info_str = f" (线程: {thread_id})" if thread_id else ""
                 extra_str = f" - {extra_info}" if extra_info else ""
-                logger.info(f"[计时结束] {step_name}{info_str} - 耗时: {elapsed:.3f}秒{extra_str}")
+                memory_str = ""
+                sample = self._open_memory.pop(timer_key, None)
+                if sample is not None and memory_now is not None:
+                    rss, traced = memory_now
+                    peak = max(sample[1], rss)
+                    summary = self.memory.get(step_name)
+                    if summary is None:
+                        summary = self.memory[step_name] = [0, 0, 0, 0, 0]
+                    summary[0] += 1
+                    summary[1] = max(summary[1], peak)
+                    summary[2] = max(summary[2], peak - sample[0])
+                    summary[3] += rss - sample[0]
+                    summary[4] = max(summary[4], max(sample[3], traced) - sample[2])
+                    memory_str = f", 峰值内存: {peak / 1024 / 1024:.1f}MB (增长 {(peak - sample[0]) / 1024 / 1024:.1f}MB)"
+                logger.info(f"[计时结束] {step_name}{info_str} - 耗时: {elapsed:.3f}秒{memory_str}{extra_str}")
                 
                 del self.current_timers[timer_key]
     
+    @contextmanager
+    def span(self, step_name: str, thread_id: str = None, **args):
+        """计时区间的上下文管理器，也可用作装饰器：
+        
+            with detailed_timer.span("写入拆分文件", group="技术部"):
+                ...
+        
+            @detailed_timer.span("校准成本模型")
+            def calibrate(...): ...
+        """
+        self.start(step_name, thread_id, **args)
+        try:
+            yield
+        except Exception as e:
+            self.end(step_name, thread_id, extra_info=f"失败: {e}")
+            raise
+        else:
+            self.end(step_name, thread_id)
+    
+    def record(self, step_name: str, elapsed: float, extra_info: str = ""):
+        """记录一次在别处测得的耗时（如子进程中的读取），区间按刚刚结束记录在当前线程"""
+        if self.mode == "aggregate":
+            self._accumulate(step_name, elapsed)
+            return
+        stack = self._span_stack()
+        thread = threading.current_thread()
+        now = time.perf_counter()
+        span = TimerSpan(
+            span_id=next(self._span_ids),
+            name=step_name,
+            parent_id=stack[-1].span_id if stack else None,
+            pid=os.getpid(),
+            thread_ident=thread.ident,
+            thread_name=thread.name,
+            start=now - elapsed,
+            end=now,
+            args={'info': extra_info} if extra_info else {}
+        )
+        with self._lock:
+            self.spans.append(span)
+            self.timers[step_name].record(elapsed)
+            extra_str = f" - {extra_info}" if extra_info else ""
+            logger.info(f"[计时记录] {step_name} - 耗时: {elapsed:.3f}秒{extra_str}")
+    
+    def reset(self):
+        """清空已结束的计时和内存记录（内存采样保持开启）
+        
+        正在计时的步骤保留：它们可能属于其他会话中仍在运行的任务，结束时需要正常出栈。
+        """
+        with self._lock:
+            self._merge_accumulator(self._lifetime, self.timers)
+            self._merge_accumulator(self._lifetime, self._aggregate_totals())
+            for step, summary in self.memory.items():
+                self._lifetime_peaks[step] = max(self._lifetime_peaks.get(step, 0), summary[1])
+            self.timers.clear()
+            self.thread_timers.clear()
+            self.memory.clear()
+            self.spans.clear()
+            # 累计器原地清空，各线程继续使用已登记的累计器；线程的区间栈和未结束的计时不受影响
+            for _, acc in self._accumulators:
+                acc.clear()
+            self._retired = {}
+    
+    def _step_stats(self, step_name: str, aggregates: Dict[str, LatencyHistogram]) -> Dict[str, Any]:
+        """单个步骤的统计，合并详细记录和累计模式的结果（调用方需持有锁）"""
+        histogram = LatencyHistogram()
+        if step_name in self.timers:
+            histogram.merge(self.timers[step_name])
+        if step_name in aggregates:
+            histogram.merge(aggregates[step_name])
+        stat = {
+            'count': histogram.count,
+            'total_time': histogram.total,
+            'avg_time': histogram.total / histogram.count,
+            'min_time': histogram.min,
+            'max_time': histogram.max,
+            'p50_time': histogram.quantile(0.5),
+            'p95_time': histogram.quantile(0.95),
+            'p99_time': histogram.quantile(0.99)
+        }
+        summary = self.memory.get(step_name)
+        if summary:
+            mb = 1024 * 1024
+            stat['peak_rss_mb'] = summary[1] / mb
+            stat['max_growth_mb'] = summary[2] / mb
+            stat['avg_delta_mb'] = summary[3] / summary[0] / mb
+            if summary[4]:
+                stat['max_python_growth_mb'] = summary[4] / mb
+        return stat
+    
     def get_stats(self, step_name: str = None) -> Dict[str, Any]:
-        """获取计时统计信息"""
+        """获取计时统计信息：次数、总/平均/最短/最长耗时和p50/p95/p99分位耗时（直方图估算，误差约1.6%）；
+        开启内存采样时包含峰值内存(peak_rss_mb)、单次最大增长(max_growth_mb)和平均净增量(avg_delta_mb)"""
         with self._lock:
+            aggregates = self._aggregate_totals()
             if step_name:
-                if step_name in self.timers:
-                    times = self.timers[step_name]
-                    return {
-                        'step': step_name,
-                        'count': len(times),
-                        'total_time': sum(times),
-                        'avg_time': sum(times) / len(times),
-                        'min_time': min(times),
-                        'max_time': max(times),
-                        'times': times
-                    }
+                if step_name in self.timers or step_name in aggregates:
+                    return {'step': step_name, **self._step_stats(step_name, aggregates)}
                 return None
             else:
-                stats = {}
-                for step, times in self.timers.items():
-                    stats[step] = {
-                        'count': len(times),
-                        'total_time': sum(times),
-                        'avg_time': sum(times) / len(times),
-                        'min_time': min(times),
-                        'max_time': max(times)
-                    }
-                return stats
+                steps = list(self.timers) + [step for step in aggregates if step not in self.timers]
+                return {step: self._step_stats(step, aggregates) for step in steps}
+    
+    def lifetime_stats(self) -> Dict[str, Dict[str, Any]]:
+        """进程启动以来各步骤的累计统计（不受reset影响）：次数、总耗时、p50/p95/p99分位耗时，
+        开启内存采样时包含峰值内存(peak_rss_mb)"""
+        with self._lock:
+            totals = {}
+            self._merge_accumulator(totals, self._lifetime)
+            self._merge_accumulator(totals, self.timers)
+            self._merge_accumulator(totals, self._aggregate_totals())
+            peaks = dict(self._lifetime_peaks)
+            for step, summary in self.memory.items():
+                peaks[step] = max(peaks.get(step, 0), summary[1])
+        stats = {}
+        for step, histogram in totals.items():
+            stats[step] = {
+                'count': histogram.count,
+                'total_time': histogram.total,
+                'p50_time': histogram.quantile(0.5),
+                'p95_time': histogram.quantile(0.95),
+                'p99_time': histogram.quantile(0.99)
+            }
+            if step in peaks:
+                stats[step]['peak_rss_mb'] = peaks[step] / 1024 / 1024
+        return stats
+    
+    def export_chrome_trace(self, output_path: str) -> str:
+        """把已结束的区间导出为Chrome trace事件格式(JSON)，可在chrome://tracing或Perfetto中打开
+        
+        每个区间是一个完整事件(ph="X")，时间戳为perf_counter微秒；同一线程内的嵌套区间按时间自动嵌套显示，
+        parent_id/span_id记录在事件参数中。
+        """
+        with self._lock:
+            spans = list(self.spans)
+        events = []
+        threads = {}
+        for span in spans:
+            threads[(span.pid, span.thread_ident)] = span.thread_name
+            args = {key: value if isinstance(value, (int, float, bool)) else str(value)
+                    for key, value in span.args.items()}
+            args['span_id'] = span.span_id
+            if span.parent_id is not None:
+                args['parent_id'] = span.parent_id
+            events.append({
+                'name': span.name,
+                'cat': 'excel',
+                'ph': 'X',
+                'ts': span.start * 1e6,
+                'dur': (span.end - span.start) * 1e6,
+                'pid': span.pid,
+                'tid': span.thread_ident,
+                'args': args
+            })
+        for (pid, tid), thread_name in threads.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid,
+                           'args': {'name': thread_name}})
+        with open(output_path, "w", encoding="utf-8") as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f, ensure_ascii=False)
+        return output_path
     
     def print_summary(self):
         """打印计时总结"""
@@ -104,6 +538,12 @@ class DetailedTimer:
             logger.info(f"  平均耗时: {stat['avg_time']:.3f}秒")
             logger.info(f"  最短耗时: {stat['min_time']:.3f}秒")
             logger.info(f"  最长耗时: {stat['max_time']:.3f}秒")
+            logger.info(f"  分位耗时: p50 {stat['p50_time']:.3f}秒, p95 {stat['p95_time']:.3f}秒, p99 {stat['p99_time']:.3f}秒")
+            if 'peak_rss_mb' in stat:
+                logger.info(f"  峰值内存: {stat['peak_rss_mb']:.1f}MB (单次最大增长 {stat['max_growth_mb']:.1f}MB, "
+                            f"平均净增 {stat['avg_delta_mb']:.1f}MB)")
+            if 'max_python_growth_mb' in stat:
+                logger.info(f"  Python分配最大增长: {stat['max_python_growth_mb']:.1f}MB")
             logger.info("-" * 40)
         
         logger.info(f"总计耗时: {total_time:.3f}秒")
@@ -112,6 +552,29 @@ class DetailedTimer:
 # 全局计时器实例
 detailed_timer = DetailedTimer()
 
+# 拼音排序字符表缓存：字符 -> 排序值，进程内共享
+_collation_char_table: Dict[str, int] = {}
+
+def _collation_char_rank(char: str) -> int:
+    """单个字符的拼音排序值：ASCII < GB2312字符（一级汉字按拼音排列）< 其他字符"""
+    rank = _collation_char_table.get(char)
+    if rank is None:
+        code = ord(char)
+        if code < 0x80:
+            rank = code
+        else:
+            try:
+                encoded = char.encode('gb2312')
+                rank = 0x10000 + (encoded[0] << 8 | encoded[1])
+            except UnicodeEncodeError:
+                rank = 0x20000 + code  # 不在GB2312中的字符按码位排在最后
+        _collation_char_table[char] = rank
+    return rank
+
+def pinyin_collation_key(text: str) -> Tuple[int, ...]:
+    """字符串的拼音排序键"""
+    return tuple(_collation_char_rank(char) for char in text)
+
 @dataclass
 class ProcessingConfig:
     split_field: str = ""
@@ -122,9 +585,40 @@ class ProcessingConfig:
     selected_sheets: List[str] = None  # 新增：用户选择的要处理的sheet列表
     preserve_format: bool = True
     custom_groups: Dict[str, List[str]] = None
+    catch_all_group: str = None  # 自定义分组未覆盖的值归入该分组（如"其他"），为空则丢弃
+    streaming_merge: bool = False  # 不排序合并时逐个文件流式追加写出，内存只与单个输入有关
+    # 输入是否已按sort_fields排好序："off"按常规全量排序；"detect"先只读排序列检测；
+    # "assume"直接认定有序（合并时校验）。有序时使用流式k路归并
+    presorted_inputs: str = "off"
+    spill_dir: str = None  # 排序合并超出内存限制时溢写有序段的临时目录，默认使用系统临时目录
+    read_processes: int = None  # 合并时并行读取输入的进程数，默认同max_workers，1表示顺序读取
+    prefetch_files: int = None  # 合并时最多预读（已提交读取但尚未写出）的文件数，默认为读取进程数+1
+    reconcile_schema: bool = False  # 合并前根据各输入的采样行统一列集合和列类型
+    merge_columns: Optional[List[str]] = None  # 流式合并输出的列；给定时不预读表头，输入迭代器保持惰性
+    schema_sample_rows: int = 1000  # 推断合并结构时每个输入采样的行数
+    dedup_keys: List[str] = None  # 合并去重字段，如 ["工号"] 或 ["姓名", "部门"]
+    # 重复时保留哪一行："first"第一次出现；"last"最后一次出现；"newest_file"修改时间最新的文件中的行
+    dedup_keep: str = "first"
+    source_column: str = None  # 合并时追加的来源文件列名（如"来源文件"），为空则不追加
     batch_size: int = 1000  # 批处理大小
     max_workers: int = 4    # 最大线程数
     memory_limit_mb: int = 512  # 内存限制(MB)
+    gc_rss_growth_mb: int = 64  # 进程内存比上次回收增长超过该值(MB)时才主动垃圾回收
+    gc_freeze: bool = True  # 拆分时冻结源工作簿等长期存活对象，垃圾回收不再遍历它们
+    compact_dtypes: bool = True  # 拆分读取后压缩列类型：低基数文本转分类、其余文本转Arrow字符串、数值无损降位
+    category_max_ratio: float = 0.5  # 不同值个数/非空行数不超过该比例的文本列转为分类类型
+    memory_sample_ms: int = 50  # 后台采样进程内存的间隔(毫秒)，把峰值内存归到各计时步骤；0表示不采样
+    trace_python_memory: bool = False  # 采样时同时用tracemalloc统计Python分配（开销较大，排查时开启）
+    # 计时模式："detailed"逐次记录日志、区间和内存；"aggregate"各线程累计、只输出汇总（生产环境常开）；
+    # 为空则保持当前模式
+    timer_mode: str = None
+    # 派生拆分键：对源列做一次向量化计算，split_field作为派生键名称
+    # 例如 {"source": "入职日期", "type": "date", "freq": "M"}
+    #      {"source": "薪资", "type": "bins", "bins": [0, 5000, 10000], "labels": ["低", "中"]}
+    #      {"source": "部门", "type": "prefix", "length": 2}
+    #      {"source": "工号", "type": "regex", "pattern": "^([A-Z]+)"}
+    split_key: Dict[str, Any] = None
+    sort_collation: str = None  # 字符串排序规则：None按Unicode码位，"pinyin"按拼音
     
     def post_init(self):
         if self.keep_fields is None:
@@ -136,11 +630,192 @@ class ProcessingConfig:
         if self.selected_sheets is None:
             self.selected_sheets = []
 
+@dataclass
+class SplitCostModel:
+    """拆分输出的成本模型：按单元格数线性估算输出文件大小和写入耗时"""
+    bytes_per_cell: float = 6.0          # 每个单元格压缩后的平均字节数
+    seconds_per_cell: float = 0.0004     # 每个单元格的平均写入耗时(秒)
+    file_overhead_bytes: int = 5000      # 单个xlsx文件的固定开销(字节)
+    file_overhead_seconds: float = 0.02  # 单个文件创建和保存的固定耗时(秒)
+    calibrated: bool = False             # 是否经过实测校准
+
+    def estimate(self, rows: int, columns: int) -> Tuple[int, float]:
+        """估算输出文件字节数和写入耗时（含表头行）"""
+        cells = (rows + 1) * columns
+        est_bytes = int(self.file_overhead_bytes + cells * self.bytes_per_cell)
+        est_seconds = self.file_overhead_seconds + cells * self.seconds_per_cell
+        return est_bytes, est_seconds
+
+@dataclass
+class SplitPartition:
+    """拆分分区：数据按(分组, 排序字段)整体排序一次，每个分组是其中一段连续切片"""
+    frame: pd.DataFrame   # 排序后的输出数据（仅输出字段）
+    labels: List[Any]     # 分组标签：拆分值或自定义分组名
+    starts: np.ndarray    # 每个分组在frame中的起始行
+    ends: np.ndarray      # 每个分组在frame中的结束行（不含）
+    unassigned_rows: int = 0  # 未分配到任何自定义分组的行数（含归入兜底分组的行）
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    def group(self, index: int) -> pd.DataFrame:
+        """返回第index个分组的连续切片"""
+        return self.frame.iloc[self.starts[index]:self.ends[index]]
+
+    def row_counts(self) -> Dict[Any, int]:
+        """每个分组的行数"""
+        return {label: int(end - start) for label, start, end in zip(self.labels, self.starts, self.ends)}
+
+@dataclass
+class MemoryReservation:
+    """内存预约：任务开始前按估算占用登记，结束后归还"""
+    nbytes: int   # 预约的字节数
+    label: str    # 任务描述，用于日志
+
+class GCPolicy:
+    """垃圾回收策略
+    
+    处理大文件时会同时存在数百万个openpyxl对象，每次完整回收都要遍历它们，耗时可达数秒：
+    - 批量阶段内提高第0代回收阈值，减少自动回收次数；
+    - 冻结长期存活的对象（如拆分时的源工作簿），之后的回收不再遍历它们；
+    - 主动回收只在进程内存比上次回收增长超过阈值时执行。
+    gc的阈值和冻结是进程级的，状态记录在类上，并发任务按引用计数进入和退出。
+    主动回收和批量阶段内自动回收的耗时都记录到计时器。
+    """
+    
+    BULK_THRESHOLD = 50000  # 批量阶段的第0代回收阈值（Python默认为700）
+    
+    _lock = threading.Lock()
+    _bulk_depth = 0
+    _saved_threshold = None
+    _freeze_depth = 0
+    _last_rss = None        # 上次主动回收后的进程内存
+    _collecting = False     # 正在主动回收，自动回收统计时跳过
+    _auto_started = None
+    _auto_seconds = 0.0     # 自动回收累计耗时
+    _auto_count = 0         # 自动回收累计次数
+    _callback_installed = False
+    
+    def __init__(self, rss_growth_mb: int = 64, freeze: bool = True):
+        self.growth_bytes = rss_growth_mb * 1024 * 1024
+        self.freeze_enabled = freeze
+        cls = GCPolicy
+        with cls._lock:
+            if not cls._callback_installed:
+                gc.callbacks.append(cls._on_gc)
+                cls._callback_installed = True
+            if cls._last_rss is None:
+                cls._last_rss = self._rss_bytes()
+    
+    @staticmethod
+    def _rss_bytes() -> Optional[int]:
+        """进程内存(字节)，psutil不可用时返回None"""
+        try:
+            import psutil
+            return psutil.Process().memory_info().rss
+        except Exception:
+            return None
+    
+    @classmethod
+    def _on_gc(cls, phase: str, info: Dict[str, Any]):
+        """gc回调：累计自动回收的耗时（回收在持有GIL的线程中串行执行）"""
+        if cls._collecting:
+            return
+        if phase == "start":
+            cls._auto_started = time.perf_counter()
+        elif cls._auto_started is not None:
+            cls._auto_seconds += time.perf_counter() - cls._auto_started
+            cls._auto_count += 1
+            cls._auto_started = None
+    
+    @contextmanager
+    def bulk_phase(self, label: str):
+        """批量阶段：提高自动回收阈值，退出时恢复并记录期间自动回收的耗时"""
+        cls = GCPolicy
+        with cls._lock:
+            if cls._bulk_depth == 0:
+                cls._saved_threshold = gc.get_threshold()
+                gc.set_threshold(self.BULK_THRESHOLD, *cls._saved_threshold[1:])
+            cls._bulk_depth += 1
+        seconds, count = cls._auto_seconds, cls._auto_count
+        try:
+            yield
+        finally:
+            with cls._lock:
+                cls._bulk_depth -= 1
+                if cls._bulk_depth == 0:
+                    gc.set_threshold(*cls._saved_threshold)
+                    cls._saved_threshold = None
+            count = cls._auto_count - count
+            if count:
+                detailed_timer.record("自动垃圾回收", cls._auto_seconds - seconds,
+                                      extra_info=f"{label}: {count} 次")
+    
+    def freeze(self):
+        """冻结当前所有存活对象，之后的回收不再遍历它们（需与unfreeze配对调用）"""
+        if not self.freeze_enabled:
+            return
+        with GCPolicy._lock:
+            gc.freeze()
+            GCPolicy._freeze_depth += 1
+    
+    def unfreeze(self):
+        """解除冻结：最后一个冻结方退出时才把对象放回可回收的代中"""
+        if not self.freeze_enabled:
+            return
+        with GCPolicy._lock:
+            GCPolicy._freeze_depth -= 1
+            if GCPolicy._freeze_depth == 0:
+                gc.unfreeze()
+    
+    def maybe_collect(self, label: str) -> bool:
+        """进程内存比上次回收增长超过阈值时才回收，返回是否执行了回收"""
+        rss = self._rss_bytes()
+        if rss is None:
+            return False  # 无法判断内存增长时交给自动回收
+        cls = GCPolicy
+        with cls._lock:
+            if cls._last_rss is not None and rss - cls._last_rss < self.growth_bytes:
+                return False
+            cls._last_rss = rss  # 先登记，避免多个线程同时触发回收
+        self.collect(label)
+        return True
+    
+    def collect(self, label: str) -> int:
+        """执行一次完整回收并记录耗时，返回回收的对象数"""
+        cls = GCPolicy
+        start_time = time.perf_counter()
+        cls._collecting = True
+        try:
+            collected = gc.collect()
+        finally:
+            cls._collecting = False
+        elapsed = time.perf_counter() - start_time
+        rss = self._rss_bytes()
+        with cls._lock:
+            cls._last_rss = rss
+        memory_str = f", 回收后内存: {rss / 1024 / 1024:.1f}MB" if rss is not None else ""
+        detailed_timer.record("垃圾回收", elapsed, extra_info=f"{label}: 回收对象 {collected}{memory_str}")
+        return collected
+
 class MemoryManager:
-    """内存管理器，监控和控制内存使用"""
+    """内存管理器，监控和控制内存使用
+    
+    除了检查进程内存外，还提供准入控制：拆分/合并任务开始前先按估算占用预约内存，
+    所有任务的预约总量不超过memory_limit_mb，预算不足时等待其他任务释放。
+    预约记录在类上，同一进程内的所有处理器（包括多个网页会话）共享同一份预算。
+    """
+    
+    XLSX_EXPANSION = 10  # xlsx读入内存后相对文件大小的膨胀倍数（估算值）
+    CELL_BYTES = 400     # openpyxl普通模式下每个单元格对象的大致内存
+    
+    _admission = threading.Condition()
+    _reserved_bytes = 0
+    _waiting = 0  # 正在等待预算的任务数
     
-    def __init__(self, limit_mb: int = 512):
+    def __init__(self, limit_mb: int = 512, gc_rss_growth_mb: int = 64, gc_freeze: bool = True):
         self.limit_bytes = limit_mb * 1024 * 1024
+        self.gc_policy = GCPolicy(gc_rss_growth_mb, gc_freeze)
         self._lock = threading.Lock()
         self._psutil_available = False
         
@@ -166,8 +841,104 @@ class MemoryManager:
             return True
     
     def force_gc(self):
-        """强制垃圾回收"""
-        gc.collect()
+        """强制垃圾回收（不论内存增长多少），耗时记录到计时器"""
+        self.gc_policy.collect("强制垃圾回收")
+    
+    def should_spill(self, buffered_bytes: int) -> bool:
+        """判断排序缓冲区是否需要溢写到磁盘
+        
+        排序时需要额外一份数据副本，因此缓冲区达到内存限制的一半，
+        或进程内存已经超限时即溢写。
+        """
+        if buffered_bytes <= 0:
+            return False
+        if buffered_bytes >= self.limit_bytes // 2:
+            return True
+        return not self.check_memory()
+    
+    def estimate_file_bytes(self, file_paths) -> int:
+        """估算读入xlsx文件所需内存，file_paths可以是单个路径或路径列表"""
+        if isinstance(file_paths, (str, os.PathLike)):
+            file_paths = [file_paths]
+        total = 0
+        for file_path in file_paths:
+            try:
+                total += os.path.getsize(file_path)
+            except OSError:
+                continue
+        return total * self.XLSX_EXPANSION
+    
+    def estimate_sheet_bytes(self, rows: int, columns: int) -> int:
+        """估算用openpyxl普通模式写出rows行columns列（含表头）所需内存"""
+        return (rows + 1) * max(columns, 1) * self.CELL_BYTES
+    
+    @classmethod
+    def reserved_bytes(cls) -> int:
+        """当前进程内所有任务的预约总量"""
+        with cls._admission:
+            return cls._reserved_bytes
+    
+    @classmethod
+    def waiting_tasks(cls) -> int:
+        """当前因预算不足而排队等待的任务数"""
+        with cls._admission:
+            return cls._waiting
+    
+    def _can_admit(self, nbytes: int, parent: Optional[MemoryReservation]) -> bool:
+        """判断能否接纳nbytes的新任务（调用方需持有_admission）"""
+        others = MemoryManager._reserved_bytes - (parent.nbytes if parent else 0)
+        if others <= 0:
+            # 没有其他任务占用预算时总是放行，保证超大任务也能执行
+            return True
+        if MemoryManager._reserved_bytes + nbytes > self.limit_bytes:
+            return False
+        # 预约之外的占用（缓存、未回收对象）已经超限时也先等待
+        return self.check_memory()
+    
+    def acquire(self, nbytes: int, label: str = "",
+                parent: Optional[MemoryReservation] = None) -> MemoryReservation:
+        """预约内存，预算不足时阻塞等待
+        
+        parent为调用方所属上层任务的预约：子任务不会因为上层任务自身的预约而无限等待。
+        单个任务最多预约整个内存预算。
+        """
+        nbytes = int(min(max(nbytes, 0), self.limit_bytes))
+        cls = MemoryManager
+        start_time = None
+        with cls._admission:
+            while not self._can_admit(nbytes, parent):
+                if start_time is None:
+                    start_time = time.perf_counter()
+                    cls._waiting += 1
+                    logger.info(f"等待内存预算: {label} 需要 {nbytes / 1024 / 1024:.1f}MB，"
+                                f"已预约 {cls._reserved_bytes / 1024 / 1024:.1f}MB")
+                # 定时醒来重新检查：进程内存可能因垃圾回收下降而没有任务释放预约
+                cls._admission.wait(timeout=1.0)
+            if start_time is not None:
+                cls._waiting -= 1
+            cls._reserved_bytes += nbytes
+        if start_time is not None:
+            detailed_timer.record("等待内存预算", time.perf_counter() - start_time,
+                                  extra_info=f"{label}: {nbytes / 1024 / 1024:.1f}MB")
+        return MemoryReservation(nbytes, label)
+    
+    def release(self, reservation: MemoryReservation):
+        """归还预约并唤醒等待的任务"""
+        cls = MemoryManager
+        with cls._admission:
+            cls._reserved_bytes = max(cls._reserved_bytes - reservation.nbytes, 0)
+            reservation.nbytes = 0
+            cls._admission.notify_all()
+    
+    @contextmanager
+    def reserve(self, nbytes: int, label: str = "",
+                parent: Optional[MemoryReservation] = None):
+        """预约内存的上下文管理器：进入时等待预算，退出时归还"""
+        reservation = self.acquire(nbytes, label, parent)
+        try:
+            yield reservation
+        finally:
+            self.release(reservation)
     
     def get_memory_usage(self) -> float:
         """获取当前内存使用量(MB)"""
@@ -186,7 +957,7 @@ class MemoryManager:
 class ProgressTracker:
     """进度跟踪器"""
     
-    def __init__(self, total_steps: int, description: str = "处理中"):
+    def __init__(self, total_steps: Optional[int], description: str = "处理中"):
         self.total_steps = total_steps
         self.current_step = 0
         self.description = description
@@ -194,11 +965,13 @@ class ProgressTracker:
         self._lock = threading.Lock()
     
     def update(self, steps: int = 1):
-        """更新进度"""
+        """更新进度（总步数未知时只记录已完成步数）"""
         with self._lock:
             self.current_step += steps
             elapsed = time.time() - self.start_time
-            if self.current_step > 0:
+            if not self.total_steps:
+                logger.info(f"{self.description}: {self.current_step} 已完成，已耗时: {elapsed:.1f}s")
+            elif self.current_step > 0:
                 eta = (elapsed / self.current_step) * (self.total_steps - self.current_step)
                 logger.info(f"{self.description}: {self.current_step}/{self.total_steps} "
                            f"({self.current_step/self.total_steps*100:.1f}%) "
@@ -209,6 +982,1138 @@ class ProgressTracker:
         elapsed = time.time() - self.start_time
         logger.info(f"{self.description} 完成，耗时: {elapsed:.2f}秒")
 
+class ProcessingMetrics:
+    """进程内的处理指标，以Prometheus文本格式导出
+    
+    计数器（任务数、读写行数、单元格数）在任务/批次结束时累加，不在逐单元格路径上加锁；
+    进行中的任务数、进程内存、准入排队数和各步骤耗时在导出时读取。各步骤耗时取自
+    detailed_timer.lifetime_stats()，网页版每次任务开始时的reset()不会清零其他会话看到的指标。
+    每秒行数/单元格数由抓取端对计数器求速率，例如 rate(excel_rows_written_total[1m])。
+    可以用serve()在本机端口提供 /metrics，或用write_file()/start_file_writer()写到文件，
+    供本地抓取器（如node_exporter的textfile收集器）读取。
+    """
+    
+    PREFIX = "excel"
+    COUNTERS = {
+        'jobs_total': "已结束的任务数",
+        'job_duration_seconds_total': "任务累计耗时(秒)",
+        'rows_read_total': "读取的数据行数",
+        'rows_written_total': "写出的数据行数",
+        'cells_written_total': "写出的单元格数",
+    }
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(float)  # (指标名, 标签元组) -> 累计值
+        self._in_flight = defaultdict(int)  # 任务类型 -> 进行中的任务数
+        self._server = None
+        self._file_writer = None
+        self._process = None
+        try:
+            import psutil
+            self._process = psutil.Process()
+        except ImportError:
+            pass
+    
+    def inc(self, name: str, value: float = 1, **labels):
+        """累加计数器，name为COUNTERS中的名称（不含前缀）"""
+        if not value:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] += value
+    
+    @contextmanager
+    def job(self, kind: str):
+        """记录一次任务：进入时计入进行中的任务，退出时按成功/失败计数并累计耗时"""
+        with self._lock:
+            self._in_flight[kind] += 1
+        start_time = time.perf_counter()
+        status = "success"
+        try:
+            yield
+        except BaseException:
+            status = "failed"
+            raise
+        finally:
+            with self._lock:
+                self._in_flight[kind] -= 1
+            self.inc('jobs_total', kind=kind, status=status)
+            self.inc('job_duration_seconds_total', time.perf_counter() - start_time, kind=kind)
+    
+    @staticmethod
+    def _format_labels(labels) -> str:
+        if not labels:
+            return ""
+        parts = []
+        for key, value in labels:
+            value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+            parts.append(f'{key}="{value}"')
+        return "{" + ",".join(parts) + "}"
+    
+    def _family(self, lines: List[str], name: str, metric_type: str, help_text: str, samples):
+        """输出一个指标族：HELP/TYPE行和各样本行，samples为 (后缀, 标签元组, 值)"""
+        lines.append(f"# HELP {self.PREFIX}_{name} {help_text}")
+        lines.append(f"# TYPE {self.PREFIX}_{name} {metric_type}")
+        for suffix, labels, value in samples:
+            lines.append(f"{self.PREFIX}_{name}{suffix}{self._format_labels(labels)} {float(value)!r}")
+    
+    def render(self) -> str:
+        """生成Prometheus文本格式(0.0.4)的全部指标"""
+        with self._lock:
+            counters = dict(self._counters)
+            in_flight = dict(self._in_flight)
+        lines = []
+        
+        for name, help_text in self.COUNTERS.items():
+            samples = [("", labels, value) for (key, labels), value in sorted(counters.items()) if key == name]
+            if not samples:
+                samples = [("", (), 0)]
+            self._family(lines, name, "counter", help_text, samples)
+        
+        self._family(lines, "jobs_in_flight", "gauge", "进行中的任务数（含等待内存预算的任务）",
+                     [("", (("kind", kind),), count) for kind, count in sorted(in_flight.items())] or [("", (), 0)])
+        self._family(lines, "admission_queue_depth", "gauge", "因内存预算不足而排队等待的任务数",
+                     [("", (), MemoryManager.waiting_tasks())])
+        self._family(lines, "memory_reserved_bytes", "gauge", "所有任务当前预约的内存",
+                     [("", (), MemoryManager.reserved_bytes())])
+        if self._process is not None:
+            try:
+                rss = self._process.memory_info().rss
+            except Exception:
+                rss = None
+            if rss is not None:
+                self._family(lines, "process_rss_bytes", "gauge", "进程常驻内存", [("", (), rss)])
+        
+        stats = detailed_timer.lifetime_stats()
+        samples = []
+        for step, stat in stats.items():
+            step_label = (("step", step),)
+            for quantile in ("0.5", "0.95", "0.99"):
+                key = f"p{round(float(quantile) * 100)}_time"
+                samples.append(("", step_label + (("quantile", quantile),), stat[key]))
+            samples.append(("_sum", step_label, stat['total_time']))
+            samples.append(("_count", step_label, stat['count']))
+        self._family(lines, "step_duration_seconds", "summary",
+                     "各处理步骤的耗时（进程启动以来累计，不受detailed_timer.reset()影响）", samples)
+        peaks = [("", (("step", step),), stat['peak_rss_mb'] * 1024 * 1024)
+                 for step, stat in stats.items() if 'peak_rss_mb' in stat]
+        if peaks:
+            self._family(lines, "step_peak_rss_bytes", "gauge", "各处理步骤期间采样到的峰值内存", peaks)
+        
+        return "\n".join(lines) + "\n"
+    
+    def write_file(self, path: str) -> str:
+        """把指标写到文件：先写临时文件再替换，抓取器不会读到写了一半的内容"""
+        path = str(path)
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".metrics_", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(self.render())
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return path
+    
+    def start_file_writer(self, path: str, interval: float = 15.0):
+        """启动后台线程，每interval秒把指标写到path；重复调用不会启动多个线程"""
+        with self._lock:
+            if self._file_writer is not None:
+                return self._file_writer
+            stop_event = threading.Event()
+            
+            def run():
+                while True:
+                    try:
+                        self.write_file(path)
+                    except Exception as e:
+                        logger.warning(f"写入指标文件失败: {e}")
+                    if stop_event.wait(interval):
+                        return
+            
+            thread = threading.Thread(target=run, name="metrics-file-writer", daemon=True)
+            thread.stop_event = stop_event
+            self._file_writer = thread
+        thread.start()
+        logger.info(f"指标每 {interval:g} 秒写入 {path}")
+        return thread
+    
+    def serve(self, port: int = 9108, host: str = "127.0.0.1"):
+        """在本机端口提供 /metrics（后台线程）；重复调用返回已启动的服务"""
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        metrics = self
+        
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?", 1)[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            
+            def log_message(self, format, *args):
+                pass
+        
+        with self._lock:
+            if self._server is not None:
+                return self._server
+            server = ThreadingHTTPServer((host, port), MetricsHandler)
+            server.daemon_threads = True
+            self._server = server
+        threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+        logger.info(f"指标服务已启动: http://{host}:{server.server_address[1]}/metrics")
+        return server
+    
+    def shutdown(self):
+        """停止指标服务和文件写入线程"""
+        with self._lock:
+            server, self._server = self._server, None
+            writer, self._file_writer = self._file_writer, None
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+        if writer is not None:
+            writer.stop_event.set()
+            writer.join()
+
+# 全局处理指标实例
+processing_metrics = ProcessingMetrics()
+
+def read_excel_input(file_path: str, keep_fields: Dict[str, List[str]] = None,
+                     nrows: int = None, sheet_name: str = None,
+                     columns: List[str] = None) -> Tuple[pd.DataFrame, float]:
+    """只读数据地读取输入文件的一个sheet（默认第一个）并应用字段筛选，返回(数据, 耗时)
+
+    定义在模块级别，以便在进程池中执行。nrows不为空时只读取前nrows行（用于采样），
+    columns不为空时只读取这些列（代替keep_fields）。
+    """
+    start = time.perf_counter()
+    with pd.ExcelFile(file_path) as excel_file:
+        sheet = sheet_name or excel_file.sheet_names[0]
+        wanted = columns if columns is not None else (keep_fields or {}).get(sheet)
+        usecols = None
+        if wanted:
+            needed = set(wanted)
+            usecols = lambda col: col in needed
+        df = excel_file.parse(sheet, usecols=usecols, nrows=nrows)
+    
+    if usecols is not None:
+        df = df[[col for col in wanted if col in df.columns]]
+    return df, time.perf_counter() - start
+
+def discover_input_files(input_dir: str, pattern: str = "*.xlsx",
+                         recursive: bool = False) -> Generator[str, None, None]:
+    """惰性扫描目录下匹配pattern的Excel文件，按目录逐个产出（同一目录内按文件名排序）
+
+    不预先列出全部文件，合并可以在扫描的同时开始；跳过Excel打开文件时产生的 ~$ 临时文件。
+    """
+    with os.scandir(input_dir) as entries:
+        entries = sorted(entries, key=lambda entry: entry.name)
+    subdirs = []
+    for entry in entries:
+        if entry.is_dir():
+            subdirs.append(entry.path)
+        elif entry.is_file() and not entry.name.startswith("~$") and fnmatch.fnmatch(entry.name, pattern):
+            yield entry.path
+    if recursive:
+        for subdir in subdirs:
+            yield from discover_input_files(subdir, pattern, recursive)
+
+def _arrow_string_dtype():
+    """缺失值为NaN的Arrow字符串类型，pandas或pyarrow版本不支持时返回None"""
+    try:
+        return pd.StringDtype("pyarrow", na_value=np.nan)
+    except (TypeError, ImportError):
+        return None
+
+def compact_dataframe(df: pd.DataFrame, category_max_ratio: float = 0.5,
+                      exclude=()) -> Tuple[pd.DataFrame, Dict[str, str]]:
+    """压缩列类型，返回 (压缩后的DataFrame, 列名 -> 新类型)
+    
+    - 不同值个数/非空行数不超过category_max_ratio的文本列转为分类类型（整数编码+一份取值表）；
+    - 其余纯文本列转为Arrow字符串；
+    - 整数列降为能容纳取值的最小整数类型，浮点列只在float32能精确表示所有值时降位。
+    混合类型的列和exclude中的列保持不变。
+    """
+    converted = {}
+    columns = {}
+    arrow_string = None
+    for col in df.columns:
+        if col in exclude:
+            continue
+        column = df[col]
+        dtype = column.dtype
+        if pd.api.types.is_bool_dtype(dtype) or isinstance(dtype, pd.CategoricalDtype):
+            continue
+        if pd.api.types.is_integer_dtype(dtype) and isinstance(dtype, np.dtype):
+            new_column = pd.to_numeric(column, downcast='integer')
+        elif pd.api.types.is_float_dtype(dtype) and isinstance(dtype, np.dtype) and dtype.itemsize > 4:
+            values = column.to_numpy()
+            with np.errstate(over='ignore'):
+                narrowed = values.astype(np.float32)
+            if not np.array_equal(narrowed.astype(dtype), values, equal_nan=True):
+                continue
+            new_column = pd.Series(narrowed, index=column.index, name=col)
+        elif pd.api.types.is_object_dtype(dtype) or pd.api.types.is_string_dtype(dtype):
+            if pd.api.types.infer_dtype(column, skipna=True) != 'string':
+                continue
+            non_null = int(column.notna().sum())
+            if non_null and column.nunique(dropna=True) <= non_null * category_max_ratio:
+                new_column = column.astype('category')
+            else:
+                if arrow_string is None:
+                    arrow_string = _arrow_string_dtype() or dtype
+                if dtype == arrow_string:
+                    continue
+                new_column = column.astype(arrow_string)
+        else:
+            continue
+        if new_column.dtype != dtype:
+            columns[col] = new_column
+            converted[col] = str(new_column.dtype)
+    if columns:
+        df = df.copy(deep=False)
+        for col, value in columns.items():
+            df[col] = value
+    return df, converted
+
+@dataclass
+class MergeSchema:
+    """合并的目标结构：所有输入列的并集及每列的目标类型
+    
+    类型为 "int"、"float"、"datetime"、"bool"、"string" 之一，None表示不做转换。
+    文本只有在其它输入中该列为数值（或日期）类型、且全部可解析时才转为数值（或日期），
+    带前导零的文本（如工号）始终视为文本。
+    """
+    columns: List[Any]
+    dtypes: Dict[Any, Optional[str]]
+    
+    @staticmethod
+    def _clean_numeric_text(values: pd.Series) -> pd.Series:
+        return values.astype(str).str.strip().str.replace(",", "", regex=False)
+    
+    @classmethod
+    def _column_kind(cls, column: pd.Series) -> Optional[str]:
+        """推断单个输入中一列的类型，全空列返回None"""
+        values = column.dropna()
+        if values.empty:
+            return None
+        if pd.api.types.is_bool_dtype(values):
+            return "bool"
+        if pd.api.types.is_integer_dtype(values):
+            return "int"
+        if pd.api.types.is_float_dtype(values):
+            return "float"
+        if pd.api.types.is_datetime64_any_dtype(values):
+            return "datetime"
+        
+        text = cls._clean_numeric_text(values)
+        if not text.str.match(r"^[+-]?0\d").any():
+            numeric = pd.to_numeric(text, errors="coerce")
+            if numeric.notna().all():
+                return "int_text" if (numeric % 1 == 0).all() else "float_text"
+        parsed = pd.to_datetime(values.astype(str), errors="coerce", format="mixed")
+        if parsed.notna().all():
+            return "datetime_text"
+        return "string"
+    
+    @classmethod
+    def infer(cls, samples: List[pd.DataFrame]) -> 'MergeSchema':
+        """根据各输入的表头和采样行推断列并集及目标类型"""
+        columns = []
+        kinds = defaultdict(set)
+        for sample in samples:
+            for col in sample.columns:
+                if col not in kinds:
+                    columns.append(col)
+                kind = cls._column_kind(sample[col])
+                kinds[col].add(kind)
+        
+        dtypes = {}
+        for col in columns:
+            observed = kinds[col] - {None}
+            if not observed:
+                dtypes[col] = None
+            elif observed <= {"bool"}:
+                dtypes[col] = "bool"
+            elif observed & {"int", "float"} and observed <= {"int", "float", "int_text", "float_text"}:
+                dtypes[col] = "int" if observed <= {"int", "int_text"} else "float"
+            elif "datetime" in observed and observed <= {"datetime", "datetime_text"}:
+                dtypes[col] = "datetime"
+            else:
+                dtypes[col] = "string"
+        return cls(columns, dtypes)
+    
+    def _cast_column(self, column: pd.Series, target: str) -> Tuple[Optional[pd.Series], int]:
+        """把一列转换为目标类型，返回(转换结果, 无法转换的值个数)；有值无法转换时结果为None"""
+        notna = column.notna()
+        if target in ("int", "float"):
+            if pd.api.types.is_numeric_dtype(column) and not pd.api.types.is_bool_dtype(column):
+                converted = column
+            else:
+                converted = pd.to_numeric(self._clean_numeric_text(column).where(notna), errors="coerce")
+            failed = int((converted.isna() & notna).sum())
+            if failed:
+                return None, failed
+            if target == "int" and converted.notna().all():
+                return converted.astype("int64"), 0
+            return converted.astype("float64"), 0
+        if target == "datetime":
+            if pd.api.types.is_datetime64_any_dtype(column):
+                return column, 0
+            converted = pd.to_datetime(column.where(notna).astype(str).where(notna), errors="coerce", format="mixed")
+            failed = int((converted.isna() & notna).sum())
+            return (None, failed) if failed else (converted, 0)
+        if target == "string":
+            if pd.api.types.is_float_dtype(column):
+                values = column.dropna()
+                if (values % 1 == 0).all():
+                    # 整数值的浮点列（因空值被读成浮点）按整数格式化
+                    column = column.astype("Int64")
+            return column.astype(str).where(notna), 0
+        return column, 0
+    
+    @staticmethod
+    def _dtype_kind(column: pd.Series) -> str:
+        """按dtype快速判断列类型，文本列返回推断的值类型（如 "string"、"mixed-integer"）"""
+        if pd.api.types.is_bool_dtype(column):
+            return "bool"
+        if pd.api.types.is_integer_dtype(column):
+            return "int"
+        if pd.api.types.is_float_dtype(column):
+            return "float"
+        if pd.api.types.is_datetime64_any_dtype(column):
+            return "datetime"
+        return pd.api.types.infer_dtype(column, skipna=True)
+    
+    def cast(self, df: pd.DataFrame) -> Tuple[pd.DataFrame, List[Dict[str, Any]]]:
+        """把一个输入对齐到列并集并按目标类型向量化转换，返回(结果, 转换记录)"""
+        df = df.reindex(columns=self.columns)
+        coercions = []
+        for col in self.columns:
+            target = self.dtypes.get(col)
+            if target is None:
+                continue
+            column = df[col]
+            source = self._dtype_kind(column)
+            if source == target or source == "empty":
+                continue
+            converted, failed = self._cast_column(column, target)
+            rows = int(column.notna().sum())
+            if rows:
+                coercions.append({
+                    'column': col,
+                    'from': source,
+                    'to': target if converted is not None else source,
+                    'rows': rows,
+                    'failed': failed,
+                })
+            if converted is not None:
+                df[col] = converted
+        return df, coercions
+
+class MergeDeduplicator:
+    """合并去重：按去重字段的64位哈希建立索引，不需要对合并后的全量数据drop_duplicates
+    
+    keep="first" 时边读边过滤；"last" 和 "newest_file" 需要先只读去重字段，
+    确定每个键保留的行后再过滤。去重字段全为空的行不参与去重。
+    """
+    KEEP_POLICIES = ("first", "last", "newest_file")
+    
+    def __init__(self, keys: List[str], keep: str = "first"):
+        if keep not in self.KEEP_POLICIES:
+            raise ValueError(f"不支持的去重策略: {keep}")
+        self.keys = list(keys)
+        self.keep = keep
+        self.dropped_rows = 0
+        self._seen = set()  # 已保留行的键哈希，逐个输入增量加入，每个输入的开销只与其行数有关
+        self._keep_masks = {}  # 输入序号 -> 保留行掩码
+    
+    @property
+    def needs_prepass(self) -> bool:
+        return self.keep != "first"
+    
+    def hash_rows(self, df: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray]:
+        """计算每行去重键的哈希，返回(哈希, 是否参与去重)"""
+        missing = [key for key in self.keys if key not in df.columns]
+        if missing:
+            raise ValueError(f"去重字段 {missing} 不存在")
+        key_frame = df[self.keys]
+        normalized = {}
+        for key in self.keys:
+            column = key_frame[key]
+            if pd.api.types.is_float_dtype(column) and (column.dropna() % 1 == 0).all():
+                # 因空值被读成浮点的整数列，与其它文件中的整数列按同样的文本比较
+                column = column.astype("Int64")
+            normalized[key] = column.astype(str)
+        hashes = pd.util.hash_pandas_object(pd.DataFrame(normalized), index=False).to_numpy()
+        valid = key_frame.notna().any(axis=1).to_numpy()
+        return hashes, valid
+    
+    def prepare(self, key_frames: List[Tuple[int, pd.DataFrame]], ranks: Dict[int, Any]):
+        """根据各输入的去重字段确定每个键保留的行：排名最高的输入中的最后一次出现"""
+        hashes, valid, priorities, rows, bounds = [], [], [], [], []
+        offset = 0
+        rank_order = {index: pos for pos, index in enumerate(sorted(ranks, key=ranks.get))}
+        for index, key_frame in key_frames:
+            file_hashes, file_valid = self.hash_rows(key_frame)
+            hashes.append(file_hashes)
+            valid.append(file_valid)
+            priorities.append(np.full(len(key_frame), rank_order[index], dtype=np.int64))
+            rows.append(np.arange(len(key_frame), dtype=np.int64))
+            bounds.append((index, offset, offset + len(key_frame)))
+            offset += len(key_frame)
+        if not bounds:
+            return
+        
+        hashes = np.concatenate(hashes)
+        valid = np.concatenate(valid)
+        # 按优先级从高到低排列，每个哈希第一次出现的位置即保留行
+        order = np.lexsort((np.concatenate(rows), np.concatenate(priorities)))[::-1]
+        order = order[valid[order]]
+        _, first = np.unique(hashes[order], return_index=True)
+        keep = ~valid
+        keep[order[first]] = True
+        for index, start, end in bounds:
+            self._keep_masks[index] = keep[start:end]
+    
+    def filter(self, index: int, df: pd.DataFrame) -> pd.DataFrame:
+        """过滤一个输入中的重复行，index为该输入在合并列表中的序号"""
+        if self.needs_prepass:
+            mask = self._keep_masks.pop(index, None)
+            if mask is None:
+                return df
+            if len(mask) != len(df):
+                raise ValueError("去重预读与数据读取的行数不一致，输入文件可能已被修改")
+        else:
+            hashes, valid = self.hash_rows(df)
+            seen = self._seen
+            mask = np.ones(len(df), dtype=bool)
+            for row, value in zip(np.flatnonzero(valid).tolist(), hashes[valid].tolist()):
+                if value in seen:
+                    mask[row] = False
+                else:
+                    seen.add(value)
+        
+        dropped = int(len(mask) - mask.sum())
+        if not dropped:
+            return df
+        self.dropped_rows += dropped
+        return df[mask]
+
+@dataclass
+class SheetStyleTemplate:
+    """工作表格式模板：按列名记录表头和首行数据的单元格格式及列宽，不依赖源工作簿
+    
+    同时按位置记录列宽、行高、合并单元格和首行数据格式，供普通模式写出时还原整张表的版式。
+    """
+    sheet_name: str
+    header: List[Any]
+    header_styles: Dict[Any, Dict[str, Any]]
+    row_styles: Dict[Any, Dict[str, Any]]
+    column_widths: Dict[Any, float]
+    header_height: Optional[float] = None
+    column_letter_widths: Dict[str, float] = field(default_factory=dict)  # 列字母 -> 列宽
+    row_heights: Dict[int, float] = field(default_factory=dict)  # 行号 -> 行高
+    merged_ranges: List[str] = field(default_factory=list)  # 合并单元格区域，如 "A1:C1"
+    data_styles: List[Optional[Dict[str, Any]]] = field(default_factory=list)  # 首行数据按列位置的格式
+
+    _LAYOUT_TAG_RE = re.compile(rb'<(?:\w+:)?(col|row|mergeCell)\b([^>]*)>')
+    _ATTR_RE = re.compile(rb'([\w:]+)="([^"]*)"')
+
+    @staticmethod
+    def _cell_style(cell) -> Optional[Dict[str, Any]]:
+        """复制单元格格式对象，只读模式下不存在的单元格返回None"""
+        if getattr(cell, 'font', None) is None:
+            return None
+        return {
+            'font': copy(cell.font),
+            'fill': copy(cell.fill),
+            'border': copy(cell.border),
+            'alignment': copy(cell.alignment),
+            'number_format': cell.number_format
+        }
+
+    @classmethod
+    def _from_cells(cls, title: str, header_cells, data_cells, column_letter_widths: Dict[str, float],
+                    row_heights: Dict[int, float], merged_ranges: List[str]) -> 'SheetStyleTemplate':
+        header = [cell.value for cell in header_cells]
+        header_styles = {cell.value: cls._cell_style(cell) for cell in header_cells}
+        data_styles = [cls._cell_style(cell) for cell in data_cells]
+        row_styles = {}
+        column_widths = {}
+        for idx, name in enumerate(header):
+            if idx < len(data_styles):
+                row_styles[name] = data_styles[idx]
+            width = column_letter_widths.get(get_column_letter(idx + 1))
+            if width:
+                column_widths[name] = width
+        return cls(
+            sheet_name=title,
+            header=header,
+            header_styles=header_styles,
+            row_styles=row_styles,
+            column_widths=column_widths,
+            header_height=row_heights.get(1),
+            column_letter_widths=column_letter_widths,
+            row_heights=row_heights,
+            merged_ranges=merged_ranges,
+            data_styles=data_styles
+        )
+
+    @classmethod
+    def from_worksheet(cls, ws) -> 'SheetStyleTemplate':
+        """从已加载的工作表提取格式模板"""
+        header_cells = next(ws.iter_rows(min_row=1, max_row=1), ())
+        data_cells = next(ws.iter_rows(min_row=2, max_row=2), ())
+        return cls._from_cells(
+            ws.title, header_cells, data_cells,
+            {letter: dim.width for letter, dim in ws.column_dimensions.items() if dim.width is not None},
+            {idx: dim.height for idx, dim in ws.row_dimensions.items() if dim.height is not None},
+            [str(merged_range) for merged_range in ws.merged_cells.ranges]
+        )
+
+    @classmethod
+    def from_file(cls, file_path: str, sheet_name: str = None) -> 'SheetStyleTemplate':
+        """直接从文件提取格式模板，不完整加载工作簿
+        
+        只读模式只解析表头和首行数据的单元格，列宽、行高和合并单元格从工作表XML中扫描得到。
+        """
+        wb = openpyxl.load_workbook(file_path, read_only=True)
+        try:
+            ws = wb[sheet_name] if sheet_name else wb[wb.sheetnames[0]]
+            title = ws.title
+            rows = list(ws.iter_rows(min_row=1, max_row=2))
+            header_cells = rows[0] if rows else ()
+            data_cells = rows[1] if len(rows) > 1 else ()
+        finally:
+            wb.close()
+        return cls._from_cells(title, header_cells, data_cells, *cls._scan_layout(file_path, title))
+
+    @classmethod
+    def _scan_layout(cls, file_path: str, sheet_name: str) -> Tuple[Dict[str, float], Dict[int, float], List[str]]:
+        """分块扫描工作表XML中的<col>、<row>和<mergeCell>标签，返回 (列宽, 行高, 合并单元格)"""
+        widths, heights, merged = {}, {}, []
+        row_index = 0
+        with zipfile.ZipFile(file_path) as zf:
+            _, part = _locate_sheet_part(zf, sheet_name)
+            with zf.open(part) as f:
+                leftover = b""
+                while True:
+                    chunk = f.read(1 << 20)
+                    buffer = leftover + chunk
+                    # 只处理到最后一个完整标签，剩余部分与下一块拼接
+                    cut = buffer.rfind(b">") + 1 if chunk else len(buffer)
+                    for match in cls._LAYOUT_TAG_RE.finditer(buffer, 0, cut):
+                        tag = match.group(1)
+                        attrs = dict(cls._ATTR_RE.findall(match.group(2)))
+                        if tag == b"row":
+                            row_index = int(attrs[b"r"]) if b"r" in attrs else row_index + 1
+                            if b"ht" in attrs:
+                                heights[row_index] = float(attrs[b"ht"])
+                        elif tag == b"col":
+                            width = float(attrs[b"width"]) if b"width" in attrs else DEFAULT_COLUMN_WIDTH
+                            widths[get_column_letter(int(attrs[b"min"]))] = width
+                        elif b"ref" in attrs:
+                            merged.append(attrs[b"ref"].decode("utf-8"))
+                    leftover = buffer[cut:]
+                    if not chunk:
+                        break
+        return widths, heights, merged
+
+class StreamingSheetWriter:
+    """只写模式的工作表写入器：按批追加行，已写出的行不再占用内存"""
+    
+    def __init__(self, output_path: str, columns: List[Any], sheet_name: str = "Sheet1",
+                 template: SheetStyleTemplate = None, preserve_format: bool = True,
+                 wb: openpyxl.Workbook = None):
+        self.output_path = output_path
+        self.columns = list(columns)
+        self.rows_written = 0
+        # 传入共享的只写工作簿时，多个写入器各写一个sheet，由调用方统一保存
+        self._owns_workbook = wb is None
+        self.wb = openpyxl.Workbook(write_only=True) if wb is None else wb
+        self.ws = self.wb.create_sheet(sheet_name)
+        
+        use_template = template if preserve_format else None
+        self._row_styles = [None] * len(self.columns)
+        header_styles = [None] * len(self.columns)
+        if use_template:
+            for idx, name in enumerate(self.columns):
+                width = use_template.column_widths.get(name)
+                if width:
+                    self.ws.column_dimensions[get_column_letter(idx + 1)].width = width
+                header_styles[idx] = self._prototype_style(use_template.header_styles.get(name))
+                self._row_styles[idx] = self._prototype_style(use_template.row_styles.get(name))
+            if use_template.header_height:
+                self.ws.row_dimensions[1].height = use_template.header_height
+        
+        self.ws.append([self._make_cell(name, style) for name, style in zip(self.columns, header_styles)])
+        self._styled = any(style is not None for style in self._row_styles)
+    
+    def _prototype_style(self, style: Optional[Dict[str, Any]]):
+        """在输出工作簿中登记一次格式，返回可复用的样式数组"""
+        if not style:
+            return None
+        cell = WriteOnlyCell(self.ws)
+        cell.font = style['font']
+        cell.fill = style['fill']
+        cell.border = style['border']
+        cell.alignment = style['alignment']
+        cell.number_format = style['number_format']
+        return cell._style
+    
+    def _make_cell(self, value, style):
+        if style is None:
+            return value
+        cell = WriteOnlyCell(self.ws, value=value)
+        cell._style = copy(style)
+        return cell
+    
+    def append_row(self, row):
+        """追加一行数据，值顺序与写入器的列定义一致"""
+        if self._styled:
+            self.ws.append([self._make_cell(value, style) for value, style in zip(row, self._row_styles)])
+        else:
+            self.ws.append(row)
+        self.rows_written += 1
+    
+    def append_frame(self, df: pd.DataFrame):
+        """追加一批数据行，列顺序按写入器的列定义对齐"""
+        if df.empty:
+            return
+        values = df.reindex(columns=self.columns).astype(object)
+        values = values.where(values.notna(), None)
+        for row in values.itertuples(index=False, name=None):
+            self.append_row(row)
+    
+    def close(self):
+        """保存输出文件（共享工作簿由调用方保存）"""
+        processing_metrics.inc('rows_written_total', self.rows_written)
+        processing_metrics.inc('cells_written_total', self.rows_written * len(self.columns))
+        if self._owns_workbook:
+            self.wb.save(self.output_path)
+            self.wb.close()
+
+def _xml_local_name(tag: str) -> str:
+    """去掉命名空间后的标签/属性名"""
+    return tag.rsplit("}", 1)[-1]
+
+def _resolve_part_target(base_dir: str, target: str) -> str:
+    """把关系文件中的Target解析为压缩包内的部件路径"""
+    if target.startswith("/"):
+        return target.lstrip("/")
+    return posixpath.normpath(posixpath.join(base_dir, target))
+
+def _locate_sheet_part(zf: zipfile.ZipFile, sheet_name: str = None) -> Tuple[str, str]:
+    """根据workbook.xml及其关系文件找到工作表对应的XML部件
+    
+    按命名空间解析XML，不依赖属性顺序、命名空间前缀和workbook.xml的位置。
+    """
+    workbook_part = "xl/workbook.xml"
+    if "_rels/.rels" in zf.namelist():
+        for rel in ET.fromstring(zf.read("_rels/.rels")):
+            if rel.get("Type", "").endswith("/officeDocument"):
+                workbook_part = _resolve_part_target("", rel.get("Target"))
+                break
+    sheets = []
+    for element in ET.fromstring(zf.read(workbook_part)).iter():
+        if _xml_local_name(element.tag) == "sheet":
+            rel_id = next((value for key, value in element.attrib.items()
+                           if key.startswith("{") and _xml_local_name(key) == "id"), None)
+            sheets.append((element.get("name"), rel_id))
+    if not sheets:
+        raise ValueError("工作簿中没有工作表")
+    if sheet_name is None:
+        name, rel_id = sheets[0]
+    else:
+        matches = [sheet for sheet in sheets if sheet[0] == sheet_name]
+        if not matches:
+            raise ValueError(f"工作簿中不存在工作表 {sheet_name}")
+        name, rel_id = matches[0]
+    base_dir = posixpath.dirname(workbook_part)
+    rels_part = posixpath.join(base_dir, "_rels", posixpath.basename(workbook_part) + ".rels")
+    for rel in ET.fromstring(zf.read(rels_part)):
+        if rel.get("Id") == rel_id:
+            return name, _resolve_part_target(base_dir, rel.get("Target"))
+    raise ValueError(f"找不到工作表 {name} 的XML部件")
+
+class XlsxSheetAppender:
+    """直接在xlsx的工作表XML中追加数据行：已有行原样复制，不解析、不重新设置格式
+    
+    新行插入到 </sheetData> 之前，各列沿用已有最后一行的样式(s属性)，并更新dimension。
+    """
+    TAIL_BYTES = 1 << 20  # 保留在内存中用于定位最后一行的尾部字节数
+    
+    def __init__(self, path: str, sheet_name: str = None):
+        self.path = str(path)
+        with zipfile.ZipFile(self.path) as zf:
+            self.sheet_name, self.sheet_part = _locate_sheet_part(zf, sheet_name)
+    
+    @staticmethod
+    def _last_row_styles(tail: bytes) -> Tuple[Optional[int], Dict[str, str]]:
+        """从sheetData尾部解析最后一行的行号和每列的样式编号"""
+        start = tail.rfind(b"<row ")
+        if start < 0:
+            start = tail.rfind(b"<row>")
+        if start < 0:
+            return None, {}
+        row_xml = tail[start:].decode("utf-8", errors="ignore")
+        row_match = re.match(r'<row\b[^>]*?\br="(\d+)"', row_xml)
+        styles = {}
+        for cell in re.finditer(r'<c\b([^>]*?)/?>', row_xml):
+            attrs = cell.group(1)
+            ref = re.search(r'\br="([A-Z]+)\d+"', attrs)
+            style = re.search(r'\bs="(\d+)"', attrs)
+            if ref and style:
+                styles[ref.group(1)] = style.group(1)
+        return (int(row_match.group(1)) if row_match else None), styles
+    
+    @staticmethod
+    def _cell_xml(ref: str, value, style: Optional[str]) -> str:
+        if isinstance(value, np.generic):
+            value = value.item()
+        if value is None or (isinstance(value, float) and not np.isfinite(value)):
+            return ""
+        style_attr = f' s="{style}"' if style else ""
+        if isinstance(value, bool):
+            return f'<c r="{ref}"{style_attr} t="b"><v>{int(value)}</v></c>'
+        if isinstance(value, numbers.Number):
+            return f'<c r="{ref}"{style_attr}><v>{value!r}</v></c>'
+        if isinstance(value, (datetime, date)):
+            return f'<c r="{ref}"{style_attr}><v>{to_excel(value)!r}</v></c>'
+        text = ILLEGAL_CHARACTERS_RE.sub("", str(value))
+        space = ' xml:space="preserve"' if text != text.strip() else ""
+        return f'<c r="{ref}"{style_attr} t="inlineStr"><is><t{space}>{xml_escape(text)}</t></is></c>'
+    
+    def _rows_xml(self, frames: List[pd.DataFrame], columns: List[Any], first_row: int,
+                  styles: Dict[str, str]) -> Generator[bytes, None, None]:
+        letters = [get_column_letter(idx + 1) for idx in range(len(columns))]
+        row_number = first_row
+        for df in frames:
+            values = df.reindex(columns=columns).astype(object)
+            values = values.where(values.notna(), None)
+            for row in values.itertuples(index=False, name=None):
+                cells = "".join(self._cell_xml(f"{letter}{row_number}", value, styles.get(letter))
+                                for letter, value in zip(letters, row))
+                yield f'<row r="{row_number}">{cells}</row>'.encode("utf-8")
+                row_number += 1
+    
+    def append_frames(self, frames: List[pd.DataFrame], columns: List[Any]) -> int:
+        """把多批数据追加到工作表末尾，返回追加的行数；先写临时文件，成功后替换原文件"""
+        total_rows = sum(len(df) for df in frames)
+        if not total_rows:
+            return 0
+        
+        tmp_path = f"{self.path}.appending"
+        try:
+            with zipfile.ZipFile(self.path) as zin, zipfile.ZipFile(tmp_path, "w", zipfile.ZIP_DEFLATED) as zout:
+                for info in zin.infolist():
+                    if info.filename == self.sheet_part:
+                        self._append_to_part(zin, zout, info, frames, columns, total_rows)
+                    else:
+                        with zin.open(info) as src, zout.open(info, "w") as dst:
+                            shutil.copyfileobj(src, dst)
+            os.replace(tmp_path, self.path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return total_rows
+    
+    def _append_to_part(self, zin: zipfile.ZipFile, zout: zipfile.ZipFile, info: zipfile.ZipInfo,
+                        frames: List[pd.DataFrame], columns: List[Any], total_rows: int):
+        """流式复制工作表XML，在 </sheetData> 前插入新行"""
+        end_tag = b"</sheetData>"
+        with zin.open(info) as src, zout.open(info, "w") as dst:
+            pending = b""
+            dimension_done = False
+            dimension_last_row = None
+            while True:
+                chunk = src.read(self.TAIL_BYTES)
+                pending += chunk
+                if not dimension_done:
+                    match = re.search(rb'<dimension ref="([A-Z]+)(\d+)(?::([A-Z]+)(\d+))?"\s*/>', pending)
+                    if match or b"<sheetData" in pending or not chunk:
+                        dimension_done = True
+                        if match:
+                            first_col, first_row, last_col, last_row = (
+                                group.decode() if group else None for group in match.groups())
+                            last_row = int(last_row or first_row)
+                            width = max(column_index_from_string(last_col or first_col), len(columns))
+                            new_ref = f'<dimension ref="{first_col}{first_row}:' \
+                                      f'{get_column_letter(width)}{last_row + total_rows}" />'
+                            pending = pending[:match.start()] + new_ref.encode() + pending[match.end():]
+                            dimension_last_row = last_row
+                
+                position = pending.find(end_tag)
+                if position >= 0:
+                    last_row, styles = self._last_row_styles(pending[:position])
+                    if last_row is None:
+                        last_row = dimension_last_row
+                    if last_row is None:
+                        raise ValueError("无法确定工作表的最后一行")
+                    if dimension_last_row is not None and dimension_last_row != last_row:
+                        logger.warning(f"工作表 {self.sheet_name} 的dimension与实际最后一行不一致，"
+                                       f"打开时Excel会自动修正")
+                    dst.write(pending[:position])
+                    for row_xml in self._rows_xml(frames, columns, last_row + 1, styles):
+                        dst.write(row_xml)
+                    dst.write(pending[position:])
+                    shutil.copyfileobj(src, dst)
+                    return
+                if not chunk:
+                    raise ValueError("工作表XML中找不到 </sheetData>")
+                # 只保留尾部用于定位最后一行，其余直接写出
+                if len(pending) > self.TAIL_BYTES * 2:
+                    flush = len(pending) - self.TAIL_BYTES
+                    dst.write(pending[:flush])
+                    pending = pending[flush:]
+
+class SharedStringColumnWriter:
+    """把输出工作表中指定列的内联字符串改为引用共享字符串表
+    
+    openpyxl写出的字符串都是内联的；来源文件这类取值很少、重复很多的列改为共享字符串后，
+    每个取值在文件中只保存一次，单元格里只保存序号。
+    改写是写出后的额外一遍：整个输出压缩包要解压、改写并重新压缩一次，耗时与输出文件大小成正比。
+    首尾有空白的取值在共享字符串表中加xml:space="preserve"，避免读取时被去掉。
+    """
+    SST_PART = "xl/sharedStrings.xml"
+    SST_CONTENT_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sharedStrings+xml"
+    SST_REL_TYPE = "http://schemas.openxmlformats.org/officeDocument/2006/relationships/sharedStrings"
+    CHUNK_BYTES = 1 << 20
+    
+    def __init__(self, path: str, strings: List[str]):
+        self.path = str(path)
+        self.strings = list(strings)
+        self._index = {xml_escape(text).encode("utf-8"): idx for idx, text in enumerate(self.strings)}
+        self.cells_rewritten = 0
+    
+    def rewrite(self, sheet_columns: Dict[str, int]) -> int:
+        """sheet_columns: {sheet名: 列序号(从0开始)}，返回改写的单元格数"""
+        with zipfile.ZipFile(self.path) as zin:
+            if self.SST_PART in zin.namelist():
+                logger.info("输出文件已有共享字符串表，来源列保持内联字符串")
+                return 0
+            parts = {}
+            for sheet, column in sheet_columns.items():
+                _, part = _locate_sheet_part(zin, sheet)
+                parts[part] = get_column_letter(column + 1)
+            
+            tmp_path = f"{self.path}.sst"
+            try:
+                with zipfile.ZipFile(tmp_path, "w", zipfile.ZIP_DEFLATED) as zout:
+                    for info in zin.infolist():
+                        if info.filename in parts:
+                            self._rewrite_sheet(zin, zout, info, parts[info.filename])
+                        elif info.filename == "[Content_Types].xml":
+                            xml = zin.read(info).decode("utf-8").replace(
+                                "</Types>",
+                                f'<Override PartName="/{self.SST_PART}" ContentType="{self.SST_CONTENT_TYPE}"/></Types>')
+                            zout.writestr(info, xml)
+                        elif info.filename == "xl/_rels/workbook.xml.rels":
+                            xml = zin.read(info).decode("utf-8")
+                            ids = [int(num) for num in re.findall(r'Id="rId(\d+)"', xml)]
+                            rel_id = f"rId{max(ids, default=0) + 1}"
+                            xml = xml.replace(
+                                "</Relationships>",
+                                f'<Relationship Id="{rel_id}" Type="{self.SST_REL_TYPE}" '
+                                f'Target="sharedStrings.xml"/></Relationships>')
+                            zout.writestr(info, xml)
+                        else:
+                            with zin.open(info) as src, zout.open(info, "w") as dst:
+                                shutil.copyfileobj(src, dst)
+                    items = "".join(
+                        f'<si><t xml:space="preserve">{xml_escape(text)}</t></si>' if text != text.strip()
+                        else f"<si><t>{xml_escape(text)}</t></si>"
+                        for text in self.strings)
+                    zout.writestr(self.SST_PART,
+                                  '<sst xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+                                  f'count="{self.cells_rewritten}" uniqueCount="{len(self.strings)}">{items}</sst>')
+                os.replace(tmp_path, self.path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        return self.cells_rewritten
+    
+    def _rewrite_sheet(self, zin: zipfile.ZipFile, zout: zipfile.ZipFile, info: zipfile.ZipInfo, letter: str):
+        """流式改写一个工作表：按完整的行分块处理，避免单元格跨块"""
+        pattern = re.compile(
+            rb'<c r="(' + letter.encode() + rb'\d+)"((?: s="\d+")?) t="inlineStr"><is><t[^>]*>([^<]*)</t></is></c>')
+        
+        def replace(match):
+            idx = self._index.get(match.group(3))
+            if idx is None:
+                return match.group(0)
+            self.cells_rewritten += 1
+            return b'<c r="' + match.group(1) + b'"' + match.group(2) + b' t="s"><v>' + str(idx).encode() + b"</v></c>"
+        
+        with zin.open(info) as src, zout.open(info, "w") as dst:
+            pending = b""
+            while True:
+                chunk = src.read(self.CHUNK_BYTES)
+                pending += chunk
+                cut = len(pending) if not chunk else pending.rfind(b"</row>") + len(b"</row>")
+                if cut >= len(b"</row>"):
+                    dst.write(pattern.sub(replace, pending[:cut]))
+                    pending = pending[cut:]
+                if not chunk:
+                    dst.write(pending)
+                    return
+
+class SortedRunSpiller:
+    """外部排序的溢写器：把排好序的数据段写入临时Parquet文件，最后按批读回做k路归并"""
+    
+    def __init__(self, sort_frame, spill_dir: str = None):
+        import pyarrow  # 缺少pyarrow时由调用方回退到内存排序
+        self._sort_frame = sort_frame
+        self._tmpdir = tempfile.TemporaryDirectory(prefix="excel_merge_spill_", dir=spill_dir)
+        self.run_paths = []
+        self.columns = []
+    
+    def spill(self, frames: List[pd.DataFrame]) -> int:
+        """排序一段缓冲数据并写入临时文件，返回写出的行数"""
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        
+        run = self._sort_frame(pd.concat(frames, ignore_index=True))
+        for col in run.columns:
+            if col not in self.columns:
+                self.columns.append(col)
+        
+        try:
+            table = pa.Table.from_pandas(run, preserve_index=False)
+        except (pa.ArrowTypeError, pa.ArrowInvalid):
+            # 同一列混有数值和文本时Arrow无法推断类型，溢写时统一转为文本
+            mixed = [col for col in run.columns
+                     if run[col].dtype == object and run[col].dropna().map(type).nunique() > 1]
+            logger.warning(f"以下列包含混合类型，溢写时转为文本: {mixed}")
+            run = run.copy()
+            for col in mixed:
+                run[col] = run[col].where(run[col].isna(), run[col].astype(str))
+            table = pa.Table.from_pandas(run, preserve_index=False)
+        
+        path = os.path.join(self._tmpdir.name, f"run_{len(self.run_paths):05d}.parquet")
+        pq.write_table(table, path)
+        self.run_paths.append(path)
+        return len(run)
+    
+    def iter_run(self, path: str, batch_size: int) -> Generator[tuple, None, None]:
+        """按批读回一个有序段，逐行返回按最终列顺序对齐的值"""
+        import pyarrow.parquet as pq
+        
+        parquet_file = pq.ParquetFile(path)
+        for batch in parquet_file.iter_batches(batch_size=batch_size):
+            frame = batch.to_pandas().reindex(columns=self.columns).astype(object)
+            frame = frame.where(frame.notna(), None)
+            yield from frame.itertuples(index=False, name=None)
+    
+    def cleanup(self):
+        """删除所有临时文件"""
+        self._tmpdir.cleanup()
+
+class ColumnChunkBuilder:
+    """分块读取时按列累积单元格值，块满后直接由列数组构造数据块，不为每行创建列表
+    
+    每列按块内第一个非空值的类型分配缓冲区：整数列为int64，小数列为float64（空值为NaN），
+    数值在缓冲区中不再占用Python对象，构造数据块时零拷贝交给pandas。
+    文本、日期、布尔和混合类型的列（包括含空值的整数列）退回object数组并把已写入的空值还原为None，
+    再由infer_objects推断类型（日期逐个写入datetime64数组比infer_objects整列转换更慢），
+    构造出的数据块与按行构造DataFrame后推断类型的结果一致。
+    """
+    
+    _EMPTY = frozenset([type(None)])  # 尚未遇到非空值的列，暂用全NaN缓冲区
+    _TYPED = {
+        int: (frozenset([int]), 'q'),
+        float: (frozenset([float, type(None)]), 'd'),
+    }
+    _NUMPY_DTYPES = {'q': np.int64, 'd': np.float64}
+    
+    def __init__(self, columns: int, capacity: int):
+        self.capacity = capacity
+        self.rows = 0
+        self._indices = range(columns)
+        self.arrays = [array.array('d', [np.nan]) * capacity for _ in range(columns)]
+        # 每列缓冲区可以直接写入的值类型，None表示object列
+        self.accepts = [self._EMPTY] * columns
+    
+    def append(self, row: tuple):
+        """追加一行，短行缺少的单元格按空值处理，超出表头的单元格忽略"""
+        i = self.rows
+        arrays = self.arrays
+        for j, buffer, accept, value in zip(self._indices, arrays, self.accepts, row):
+            if accept is None or type(value) in accept:
+                try:
+                    buffer[i] = value
+                    continue
+                except (OverflowError, TypeError):  # 超出int64范围的整数；float缓冲区中的None
+                    pass
+            self._put_slow(j, i, value)
+        for j in range(len(row), len(arrays)):
+            self._put_slow(j, i, None)
+        self.rows = i + 1
+    
+    def _put_slow(self, j: int, i: int, value: Any):
+        """写入当前缓冲区放不下的值：空列按值的类型分配缓冲区，其余情况退回object数组"""
+        accept = self.accepts[j]
+        if accept is self._EMPTY and type(value) in self._TYPED:
+            typed_accept, typecode = self._TYPED[type(value)]
+            # 前面的空值只有float64能表示，int64列必须从块的第一行开始
+            if typecode == 'd' or i == 0:
+                if typecode == 'q':
+                    self.arrays[j] = array.array('q', bytes(8 * self.capacity))
+                self.accepts[j] = accept = typed_accept
+        if accept is not None and type(value) in accept:
+            if value is None:
+                self.arrays[j][i] = np.nan
+                return
+            try:
+                self.arrays[j][i] = value
+                return
+            except OverflowError:
+                pass
+        self._to_object(j)
+        self.arrays[j][i] = value
+    
+    def _column(self, j: int) -> np.ndarray:
+        """第j列已写入部分的numpy数组，数值缓冲区零拷贝"""
+        buffer = self.arrays[j]
+        if isinstance(buffer, array.array):
+            return np.frombuffer(buffer, dtype=self._NUMPY_DTYPES[buffer.typecode])[:self.rows]
+        return buffer[:self.rows]
+    
+    def _to_object(self, j: int):
+        """把第j列转为object数组，已写入的NaN还原为None"""
+        if self.accepts[j] is None:
+            return
+        converted = np.full(self.capacity, None, dtype=object)
+        if self.accepts[j] is not self._EMPTY:
+            filled = self._column(j)
+            converted[:self.rows] = filled.astype(object)
+            if filled.dtype == np.float64:
+                converted[:self.rows][np.isnan(filled)] = None
+        self.arrays[j] = converted
+        self.accepts[j] = None
+    
+    def to_frame(self, headers: List[Any]) -> pd.DataFrame:
+        """由已写入的行构造数据块；全空列保持object（与按行构造一致），object列再推断类型"""
+        columns = {}
+        for j, accept in enumerate(self.accepts):
+            if accept is self._EMPTY:
+                columns[j] = np.full(self.rows, None, dtype=object)
+            else:
+                columns[j] = self._column(j)
+        df = pd.DataFrame(columns, copy=False)
+        df.columns = headers
+        return df.infer_objects()
+
 class OptimizedExcelProcessor:
     """优化版Excel处理器，支持大规模数据处理"""
     
@@ -216,10 +2121,18 @@ class OptimizedExcelProcessor:
         self.config = config
         self.output_dir = Path(config.output_dir)
         self.output_dir.mkdir(exist_ok=True)
-        self.memory_manager = MemoryManager(config.memory_limit_mb)
-        self._format_cache = {}  # 格式缓存
+        self.memory_manager = MemoryManager(config.memory_limit_mb, config.gc_rss_growth_mb, config.gc_freeze)
         self._workbook_cache = {}  # 工作簿缓存
-    
+        self.cost_model = SplitCostModel()  # 拆分预估成本模型
+        self.split_report = {}  # 最近一次拆分每个sheet的分组行数统计
+        self.merge_report = {}  # 最近一次合并的目标结构和类型转换记录
+        self._source_names = {}  # 来源文件名 -> 共享字符串序号（按首次出现顺序）
+        self._split_reservation = None  # 当前拆分任务的内存预约，分组写出任务以它为上层预约
+        if config.timer_mode:
+            detailed_timer.set_mode(config.timer_mode)
+        if config.memory_sample_ms:
+            detailed_timer.enable_memory_sampling(config.memory_sample_ms / 1000, config.trace_python_memory)
+
     def read_excel_chunked(self, file_path: str, sheet_name: str = None, 
                           chunk_size: int = None) -> Generator[pd.DataFrame, None, None]:
         """分块读取Excel文件，减少内存占用"""
@@ -232,22 +2145,19 @@ class OptimizedExcelProcessor:
         # 获取表头
         headers = [cell.value for cell in next(sheet.iter_rows(min_row=1, max_row=1))]
         
-        # 分块读取数据
-        current_chunk = []
-        for row in sheet.iter_rows(min_row=2):
-            if len(current_chunk) >= chunk_size:
-                df_chunk = pd.DataFrame(current_chunk, columns=headers)
-                yield df_chunk
-                current_chunk = []
-                self.memory_manager.force_gc()
-            
-            row_data = [cell.value for cell in row]
-            current_chunk.append(row_data)
+        # 分块读取数据：单元格值直接写入按类型分配的列数组，
+        # 不再为每行创建列表，也不需要在构造DataFrame时按行转置
+        chunk = ColumnChunkBuilder(len(headers), chunk_size)
+        for row in sheet.iter_rows(min_row=2, values_only=True):
+            chunk.append(row)
+            if chunk.rows == chunk_size:
+                yield chunk.to_frame(headers)
+                chunk = ColumnChunkBuilder(len(headers), chunk_size)
+                self.memory_manager.gc_policy.maybe_collect("分块读取")
         
         # 返回最后一块
-        if current_chunk:
-            df_chunk = pd.DataFrame(current_chunk, columns=headers)
-            yield df_chunk
+        if chunk.rows:
+            yield chunk.to_frame(headers)
         
         wb.close()
     
@@ -293,9 +2203,6 @@ class OptimizedExcelProcessor:
         for chunk in self.read_excel_chunked(file_path, sheet_name):
             chunks.append(chunk)
             chunk_count += 1
-            if not self.memory_manager.check_memory():
-                logger.warning("内存使用接近限制，强制垃圾回收")
-                self.memory_manager.force_gc()
         
         detailed_timer.end("分块读取大文件", extra_info=f"读取了 {chunk_count} 个数据块")
         
@@ -309,90 +2216,58 @@ class OptimizedExcelProcessor:
         
         return df, wb
     
-    def copy_cell_format_optimized(self, source_cell, target_cell):
-        """优化版格式复制，使用缓存"""
-        if not self.config.preserve_format:
+    def _apply_cell_style(self, target_cell, style: Optional[Dict[str, Any]]):
+        """把格式模板中的格式应用到目标单元格"""
+        if not self.config.preserve_format or style is None:
             return
+        target_cell.font = style['font']
+        target_cell.fill = style['fill']
+        target_cell.border = style['border']
+        target_cell.alignment = style['alignment']
+        target_cell.number_format = style['number_format']
+    
+    def write_excel_with_format_optimized(self, df: pd.DataFrame, style_source, 
+                                        output_path: str, sheet_name: str = "Sheet1"):
+        """优化版Excel写入，支持大文件
         
-        # 使用缓存键
-        cache_key = (id(source_cell.font), id(source_cell.fill), id(source_cell.border), 
-                    id(source_cell.alignment), source_cell.number_format)
-        
-        if cache_key in self._format_cache:
-            # 使用缓存的格式对象
-            cached_format = self._format_cache[cache_key]
-            target_cell.font = cached_format['font']
-            target_cell.fill = cached_format['fill']
-            target_cell.border = cached_format['border']
-            target_cell.alignment = cached_format['alignment']
-            target_cell.number_format = cached_format['number_format']
-            return
+        style_source为源工作簿（从其中的sheet_name提取格式模板）或已提取的SheetStyleTemplate，
+        传入模板时写出不需要源工作簿常驻内存。
+        """
+        detailed_timer.start("写入Excel文件")
         
-        # 创建新的格式对象
-        font = copy(source_cell.font) if source_cell.font else None
-        fill = copy(source_cell.fill) if source_cell.fill else None
-        border = copy(source_cell.border) if source_cell.border else None
-        alignment = copy(source_cell.alignment) if source_cell.alignment else None
-        number_format = source_cell.number_format
-        
-        # 缓存格式对象
-        self._format_cache[cache_key] = {
-            'font': font,
-            'fill': fill,
-            'border': border,
-            'alignment': alignment,
-            'number_format': number_format
-        }
-        
-        # 应用格式
-        target_cell.font = font
-        target_cell.fill = fill
-        target_cell.border = border
-        target_cell.alignment = alignment
-        target_cell.number_format = number_format
-        
-        # 复制超链接
-        if source_cell.hyperlink:
-            target_cell.hyperlink = source_cell.hyperlink
-    
-    def write_excel_with_format_optimized(self, df: pd.DataFrame, wb: openpyxl.Workbook, 
-                                        output_path: str, sheet_name: str = "Sheet1"):
-        """优化版Excel写入，支持大文件"""
-        detailed_timer.start("写入Excel文件")
-        
-        source_ws = wb[sheet_name]
+        if isinstance(style_source, SheetStyleTemplate):
+            template = style_source
+        else:
+            template = SheetStyleTemplate.from_worksheet(style_source[sheet_name])
         new_wb = openpyxl.Workbook()
         new_ws = new_wb.active
         new_ws.title = sheet_name
         
         detailed_timer.start("复制格式设置")
         # 复制列宽和行高
-        for col_letter, dim in source_ws.column_dimensions.items():
-            new_ws.column_dimensions[col_letter].width = dim.width
-        for row_idx, dim in source_ws.row_dimensions.items():
-            new_ws.row_dimensions[row_idx].height = dim.height
+        for col_letter, width in template.column_letter_widths.items():
+            new_ws.column_dimensions[col_letter].width = width
+        for row_idx, height in template.row_heights.items():
+            new_ws.row_dimensions[row_idx].height = height
         
         # 复制合并单元格
-        for merged_range in source_ws.merged_cells.ranges:
-            new_ws.merge_cells(str(merged_range))
+        for merged_range in template.merged_ranges:
+            new_ws.merge_cells(merged_range)
         detailed_timer.end("复制格式设置")
         
-        # 获取表头
-        header = [cell.value for cell in next(source_ws.iter_rows(min_row=1, max_row=1))]
-        col_map = {col: idx for idx, col in enumerate(header)}
-        
         detailed_timer.start("写入表头")
         # 批量写入表头
         for c, v in enumerate(df.columns, 1):
-            src_cell = source_ws.cell(row=1, column=col_map[v]+1)
             tgt_cell = new_ws.cell(row=1, column=c, value=v)
-            self.copy_cell_format_optimized(src_cell, tgt_cell)
+            # 合并时列并集中可能有参考文件没有的列
+            self._apply_cell_style(tgt_cell, template.header_styles.get(v))
         detailed_timer.end("写入表头", extra_info=f"表头列数: {len(df.columns)}")
         
         detailed_timer.start("写入数据行")
         # 批量写入数据行
         batch_size = self.config.batch_size
         total_rows = len(df)
+        data_styles = template.data_styles
         
         for batch_start in range(0, total_rows, batch_size):
             batch_end = min(batch_start + batch_size, total_rows)
@@ -400,14 +2275,14 @@ class OptimizedExcelProcessor:
             
             for r, row in enumerate(batch_df.itertuples(index=False), batch_start + 2):
                 for c, v in enumerate(row, 1):
-                    # 使用第一行作为格式模板，避免逐行查找
-                    src_cell = source_ws.cell(row=2, column=c)
+                    # 使用第一行数据的格式作为模板，避免逐行查找
                     tgt_cell = new_ws.cell(row=r, column=c, value=v)
-                    self.copy_cell_format_optimized(src_cell, tgt_cell)
+                    if c <= len(data_styles):
+                        self._apply_cell_style(tgt_cell, data_styles[c - 1])
             
-            # 定期清理内存
+            # 定期检查内存增长，只有增长足够多时才回收
             if batch_start % (batch_size * 10) == 0:
-                self.memory_manager.force_gc()
+                self.memory_manager.gc_policy.maybe_collect("写入数据行")
         
         detailed_timer.end("写入数据行", extra_info=f"数据行数: {total_rows}")
         
@@ -421,184 +2296,457 @@ class OptimizedExcelProcessor:
         detailed_timer.end("保存文件", extra_info=f"文件路径: {output_path}")
         
         new_wb.close()
+        processing_metrics.inc('rows_written_total', total_rows)
+        processing_metrics.inc('cells_written_total', total_rows * len(df.columns))
         detailed_timer.end("写入Excel文件", extra_info=f"总行数: {total_rows}, 总列数: {len(df.columns)}")
     
-    def split_excel_optimized(self, input_file: str, sheet_name: str = None, 
-                            progress_callback=None) -> List[str]:
-        """优化版Excel拆分，支持大文件和多sheet"""
-        detailed_timer.start("Excel拆分总流程")
-        logger.info(f"开始处理文件: {input_file}")
-        
-        # 读取sheet名时可用read_only=True，但后续格式复制必须用默认模式
-        detailed_timer.start("加载工作簿")
-        wb = openpyxl.load_workbook(input_file)  # 不加read_only=True，保证格式属性可用
-        detailed_timer.end("加载工作簿")
-        
-        # 确定要处理的sheet列表
-        sheets_to_process = []
+    def _resolve_sheets(self, sheetnames: List[str], sheet_name: str = None) -> List[str]:
+        """确定要处理的sheet列表"""
         if self.config.selected_sheets:
             # 使用用户选择的sheet列表
-            sheets_to_process = [sheet for sheet in self.config.selected_sheets if sheet in wb.sheetnames]
+            sheets_to_process = [sheet for sheet in self.config.selected_sheets if sheet in sheetnames]
             if not sheets_to_process:
                 raise ValueError(f"用户选择的sheet都不存在于文件中: {self.config.selected_sheets}")
+            return sheets_to_process
+
+        # 兼容旧版本，使用单个sheet
+        use_sheet = sheet_name or self.config.sheet_name or sheetnames[0]
+        if use_sheet not in sheetnames:
+            use_sheet = sheetnames[0]
+        return [use_sheet]
+
+    def _read_split_sheet(self, input_file: str, sheet_name: str, nrows: int = None,
+                          planning: bool = False) -> Optional[pd.DataFrame]:
+        """列投影读取：只读取保留字段、拆分字段和排序字段，拆分字段不存在时返回None
+        
+        nrows不为空时只读取前nrows行（用于校准等采样）。
+        planning为True时（拆分预演只统计分组行数）不压缩列类型，也不计入读取的数据行数。
+        """
+        usecols = None
+        if self.config.keep_fields and sheet_name in self.config.keep_fields:
+            needed = set(self.config.keep_fields[sheet_name])
+            needed.add(self._split_source_field())
+            needed.update(self.config.sort_fields or [])
+            usecols = lambda col: col in needed
+
+        detailed_timer.start("读取Sheet数据")
+        df = pd.read_excel(input_file, sheet_name=sheet_name, header=0, usecols=usecols, nrows=nrows)
+        detailed_timer.end("读取Sheet数据", extra_info=f"数据行数: {len(df)}, 列数: {len(df.columns)}")
+        if nrows is None and not planning:
+            processing_metrics.inc('rows_read_total', len(df), kind="split")
+
+        # 检查拆分字段是否存在
+        source_field = self._split_source_field()
+        if source_field not in df.columns:
+            logger.warning(f"拆分字段 '{source_field}' 在sheet '{sheet_name}' 中不存在，跳过该sheet")
+            return None
+        return df if planning else self._compact_frame(df)
+
+    def _compact_frame(self, df: pd.DataFrame) -> pd.DataFrame:
+        """按配置压缩列类型，分区和写出直接使用分类编码"""
+        if not self.config.compact_dtypes:
+            return df
+        detailed_timer.start("压缩列类型")
+        before = int(df.memory_usage(deep=True).sum())
+        # 派生拆分键的源列保持原类型，避免日期解析、数值分段等计算受分类类型影响
+        exclude = {self.config.split_key['source']} if self.config.split_key else set()
+        df, converted = compact_dataframe(df, self.config.category_max_ratio, exclude)
+        after = int(df.memory_usage(deep=True).sum())
+        detailed_timer.end("压缩列类型", extra_info=f"转换列数: {len(converted)}, "
+                           f"内存: {before / 1024 / 1024:.1f}MB -> {after / 1024 / 1024:.1f}MB")
+        return df
+
+    def _split_source_field(self) -> str:
+        """拆分键依赖的源列：配置派生拆分键时为其source，否则为拆分字段本身"""
+        if self.config.split_key:
+            return self.config.split_key['source']
+        return self.config.split_field
+
+    def _compute_split_key(self, df: pd.DataFrame) -> pd.Series:
+        """计算拆分键：整列向量化求值一次，不做逐行Python回调"""
+        spec = self.config.split_key
+        if not spec:
+            return df[self.config.split_field]
+
+        source = df[spec['source']]
+        key_type = spec.get('type')
+
+        if key_type == 'date':
+            # 日期截断：Y/Q/M/W/D等周期，或指定strftime格式
+            dates = pd.to_datetime(source, errors='coerce')
+            if spec.get('format'):
+                key = dates.dt.strftime(spec['format'])
+            else:
+                key = dates.dt.to_period(spec.get('freq', 'M')).astype(str).where(dates.notna())
+        elif key_type == 'bins':
+            # 数值分段：区间默认左闭右开，返回分类类型
+            numbers = pd.to_numeric(source, errors='coerce')
+            key = pd.cut(numbers, bins=spec['bins'], labels=spec.get('labels'),
+                         right=spec.get('right', False))
+        elif key_type == 'prefix':
+            key = source.astype(str).str.slice(0, spec.get('length', 1)).where(source.notna())
+        elif key_type == 'regex':
+            # 取正则第一个捕获组，未匹配的行为空值
+            key = source.astype(str).str.extract(spec['pattern'], expand=False).where(source.notna())
         else:
-            # 兼容旧版本，使用单个sheet
-            use_sheet = sheet_name or self.config.sheet_name or wb.sheetnames[0]
-            if use_sheet not in wb.sheetnames:
-                use_sheet = wb.sheetnames[0]
-            sheets_to_process = [use_sheet]
+            raise ValueError(f"不支持的拆分键类型: {key_type}")
+
+        return key.rename(self.config.split_field or spec['source'])
+
+    def _assign_group_codes(self, split_key: pd.Series) -> Tuple[np.ndarray, List[Any], int]:
+        """分组分配：把拆分键映射为分组编号（-1表示不输出），一次向量化完成
+
+        返回 (分组编号, 分组标签, 未分配行数)。自定义分组模式下，未命中任何分组的行
+        （即与分组值表的反连接）在同一遍中归入兜底分组。
+        """
+        if self.config.custom_groups:
+            # 值 -> 分组编号的哈希映射；同一值出现在多个分组时以第一个分组为准
+            labels = []
+            value_to_group = {}
+            for group_name, group_values in self.config.custom_groups.items():
+                if not group_values:
+                    continue
+                group_index = len(labels)
+                labels.append(group_name)
+                for value in group_values:
+                    if value in value_to_group:
+                        logger.warning(f"字段值 '{value}' 同时出现在多个分组中，归入分组 '{labels[value_to_group[value]]}'")
+                        continue
+                    value_to_group[value] = group_index
+            if isinstance(split_key.dtype, pd.CategoricalDtype):
+                # 分类列只映射取值表，再按编码取分组编号（编码-1即空值对应末尾的-1）
+                category_groups = [value_to_group.get(str(value), -1) for value in split_key.cat.categories]
+                codes = np.array(category_groups + [-1], dtype=np.int64)[split_key.cat.codes.to_numpy()]
+            else:
+                codes = split_key.astype(str).map(value_to_group).fillna(-1).to_numpy(dtype=np.int64)
+
+            unassigned_mask = codes < 0
+            unassigned_rows = int(unassigned_mask.sum())
+            if unassigned_rows:
+                unassigned = set(split_key[unassigned_mask].astype(str).unique())
+                catch_all = self.config.catch_all_group
+                if catch_all:
+                    if catch_all not in labels:
+                        labels.append(catch_all)
+                    codes[unassigned_mask] = labels.index(catch_all)
+                    logger.info(f"{unassigned_rows} 行未分配的数据归入分组 '{catch_all}': {unassigned}")
+                else:
+                    logger.warning(f"以下字段值未分配到任何分组: {unassigned}")
+            return codes, labels, unassigned_rows
+
+        try:
+            codes, uniques = pd.factorize(split_key, sort=True)
+        except TypeError:
+            # 混合类型无法排序时按首次出现顺序编号
+            codes, uniques = pd.factorize(split_key)
+        return codes.astype(np.int64, copy=False), list(uniques), 0
+
+    def _sort_key_codes(self, column: pd.Series) -> np.ndarray:
+        """把排序列转换为保序的整数键，空值排在最后"""
+        values_dtype = column.cat.categories.dtype if isinstance(column.dtype, pd.CategoricalDtype) else column.dtype
+        if self.config.sort_collation == 'pinyin' and (
+                pd.api.types.is_object_dtype(values_dtype) or pd.api.types.is_string_dtype(values_dtype)):
+            return self._collation_key_codes(column)
+        try:
+            codes, uniques = pd.factorize(column, sort=True)
+        except TypeError:
+            # 混合类型列按字符串比较
+            codes, uniques = pd.factorize(column.astype(str).where(column.notna()), sort=True)
+        codes = codes.astype(np.int64)
+        codes[codes < 0] = len(uniques)
+        return codes
+
+    def _collation_key_codes(self, column: pd.Series) -> np.ndarray:
+        """按拼音排序的整数键：只对去重后的值计算一次排序键，再按编码映射回每一行"""
+        if isinstance(column.dtype, pd.CategoricalDtype):
+            # 分类列直接使用已有的编码和取值表
+            codes, uniques = column.cat.codes.to_numpy(), column.cat.categories
+        else:
+            codes, uniques = pd.factorize(column)
+        unique_keys = [pinyin_collation_key(str(value)) for value in uniques]
+        ranks = np.empty(len(uniques) + 1, dtype=np.int64)
+        ranks[sorted(range(len(uniques)), key=unique_keys.__getitem__)] = np.arange(len(uniques))
+        ranks[-1] = len(uniques)  # 空值（编码-1）排在最后
+        return ranks[codes]
+
+    def _sort_frame(self, df: pd.DataFrame) -> pd.DataFrame:
+        """按排序字段的整数键做向量化多键排序"""
+        sort_fields = [col for col in (self.config.sort_fields or []) if col in df.columns]
+        if not sort_fields:
+            return df
+        order = np.lexsort([self._sort_key_codes(df[col]) for col in reversed(sort_fields)])
+        return df.take(order)
+
+    def _partition_row_counts(self, split_key: pd.Series) -> Tuple[Dict[Any, int], int]:
+        """分区步骤：统计每个输出分组的行数和未分配行数，与拆分时的分组规则一致"""
+        codes, labels, unassigned_rows = self._assign_group_codes(split_key)
+        counts = np.bincount(codes[codes >= 0], minlength=len(labels))
+        return {label: int(count) for label, count in zip(labels, counts)}, unassigned_rows
+
+    def _partition_split(self, df: pd.DataFrame, split_key: pd.Series,
+                         sheet_name: str) -> SplitPartition:
+        """按(拆分键, 排序字段)整体排序一次，用searchsorted找出每个分组的连续区间"""
+        detailed_timer.start("数据分区")
+
+        codes, labels, unassigned_rows = self._assign_group_codes(split_key)
+
+        # 未分配到任何分组的行不参与排序和输出
+        positions = np.flatnonzero(codes >= 0)
+        group_codes = codes[positions]
+
+        # np.lexsort以最后一个键为主键：先排序字段（逆序），最后是分组编号
+        sort_fields = [col for col in (self.config.sort_fields or []) if col in df.columns]
+        sort_keys = [self._sort_key_codes(df[col])[positions] for col in reversed(sort_fields)]
+        order = positions[np.lexsort(sort_keys + [group_codes])]
+        sorted_codes = codes[order]
+
+        group_ids = np.arange(len(labels))
+        starts = np.searchsorted(sorted_codes, group_ids, side='left')
+        ends = np.searchsorted(sorted_codes, group_ids, side='right')
+
+        # 只保留输出字段，整体只复制一次
+        if self.config.keep_fields and sheet_name in self.config.keep_fields:
+            output_columns = [col for col in self.config.keep_fields[sheet_name] if col in df.columns]
+        else:
+            output_columns = list(df.columns)
+        column_positions = [df.columns.get_loc(col) for col in output_columns]
+        frame = df.iloc[order, column_positions]
+
+        detailed_timer.end("数据分区", extra_info=f"分组数: {len(labels)}, 输出行数: {len(frame)}")
+        return SplitPartition(frame=frame, labels=labels, starts=starts, ends=ends,
+                              unassigned_rows=unassigned_rows)
+
+    def _split_output_path(self, value) -> Path:
+        """根据拆分值或分组名生成输出文件路径"""
+        safe_value = str(value).replace('/', '_').replace('\\', '_').replace(':', '_')
+        if self.config.custom_groups:
+            return self.output_dir / f"{safe_value}.xlsx"
+        split_name = self.config.split_field or self._split_source_field()
+        return self.output_dir / f"{split_name}-{safe_value}.xlsx"
+
+    def calibrate_cost_model(self, input_file: str, sheet_name: str = None,
+                             sample_rows: int = 500) -> SplitCostModel:
+        """用真实数据样本写入临时文件，校准单元格成本模型"""
+        detailed_timer.start("校准成本模型")
+
+        wb = openpyxl.load_workbook(input_file, read_only=True)
+        current_sheet = self._resolve_sheets(wb.sheetnames, sheet_name)[0]
+        wb.close()
+        df = self._read_split_sheet(input_file, current_sheet, nrows=sample_rows)
+        if df is None or df.empty:
+            logger.warning("没有可用于校准的数据，保留默认成本模型")
+            detailed_timer.end("校准成本模型", extra_info="无数据")
+            return self.cost_model
+
+        if self.config.keep_fields and current_sheet in self.config.keep_fields:
+            df = df[[col for col in self.config.keep_fields[current_sheet] if col in df.columns]]
+        sample = df.head(sample_rows)
+        cells = (len(sample) + 1) * len(sample.columns)
+        template = SheetStyleTemplate.from_file(input_file, current_sheet)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            sample_path = os.path.join(tmpdir, "calibration.xlsx")
+            start = time.perf_counter()
+            self.write_excel_with_format_optimized(sample, template, sample_path, current_sheet)
+            elapsed = time.perf_counter() - start
+            size = os.path.getsize(sample_path)
+
+        model = self.cost_model
+        self.cost_model = SplitCostModel(
+            bytes_per_cell=max(size - model.file_overhead_bytes, 0) / cells,
+            seconds_per_cell=max(elapsed - model.file_overhead_seconds, 0) / cells,
+            file_overhead_bytes=model.file_overhead_bytes,
+            file_overhead_seconds=model.file_overhead_seconds,
+            calibrated=True
+        )
+        detailed_timer.end("校准成本模型", extra_info=f"样本单元格数: {cells}")
+        return self.cost_model
+
+    def plan_split(self, input_file: str, sheet_name: str = None,
+                   calibrate: bool = False) -> Dict[str, Any]:
+        """拆分预演：只执行列投影读取和分区，返回每个分组的行数及输出大小/耗时预估，不写任何文件"""
+        detailed_timer.start("拆分预演")
+
+        if calibrate and not self.cost_model.calibrated:
+            self.calibrate_cost_model(input_file, sheet_name)
+
+        wb = openpyxl.load_workbook(input_file, read_only=True)
+        sheetnames = wb.sheetnames
+        wb.close()
+
+        plan = {
+            'sheets': {},
+            'total_files': 0,
+            'total_rows': 0,
+            'total_est_bytes': 0,
+            'total_est_seconds': 0.0,
+            'cost_model': asdict(self.cost_model)
+        }
+
+        for current_sheet in self._resolve_sheets(sheetnames, sheet_name):
+            df = self._read_split_sheet(input_file, current_sheet, planning=True)
+            if df is None:
+                continue
+
+            if self.config.keep_fields and current_sheet in self.config.keep_fields:
+                columns = len([col for col in self.config.keep_fields[current_sheet] if col in df.columns])
+            else:
+                columns = len(df.columns)
+
+            detailed_timer.start("分区统计")
+            row_counts, unassigned_rows = self._partition_row_counts(self._compute_split_key(df))
+            detailed_timer.end("分区统计", extra_info=f"分组数: {len(row_counts)}")
+
+            groups = []
+            for value, rows in row_counts.items():
+                if rows == 0:
+                    continue  # 与拆分一致：空分组不生成文件
+                est_bytes, est_seconds = self.cost_model.estimate(rows, columns)
+                groups.append({
+                    'group': value,
+                    'file': self._split_output_path(value).name,
+                    'rows': rows,
+                    'est_bytes': est_bytes,
+                    'est_seconds': est_seconds
+                })
+
+            plan['sheets'][current_sheet] = {
+                'rows': len(df),
+                'columns': columns,
+                'groups': groups,
+                'unassigned_rows': unassigned_rows
+            }
+            plan['total_files'] += len(groups)
+            plan['total_rows'] += sum(g['rows'] for g in groups)
+            plan['total_est_bytes'] += sum(g['est_bytes'] for g in groups)
+            plan['total_est_seconds'] += sum(g['est_seconds'] for g in groups)
+            del df
+
+        detailed_timer.end("拆分预演", extra_info=f"预计生成文件数: {plan['total_files']}")
+        return plan
+
+    def split_excel_optimized(self, input_file: str, sheet_name: str = None, 
+                            progress_callback=None) -> List[str]:
+        """优化版Excel拆分，支持大文件和多sheet"""
+        detailed_timer.start("Excel拆分总流程")
+        logger.info(f"开始处理文件: {input_file}")
         
-        logger.info(f"将处理以下sheet: {sheets_to_process}")
+        self.split_report = {}
+        gc_policy = self.memory_manager.gc_policy
+        
+        # 整个拆分任务按源文件大小预约内存，各分组的写出任务在此基础上另行预约
+        with processing_metrics.job("split"), \
+                self.memory_manager.reserve(self.memory_manager.estimate_file_bytes(input_file),
+                                            f"拆分 {os.path.basename(input_file)}") as reservation, \
+                gc_policy.bulk_phase("Excel拆分"):
+            # 只读模式只读取sheet名；格式按sheet提取为模板，不再完整加载源工作簿
+            wb = openpyxl.load_workbook(input_file, read_only=True)
+            sheetnames = wb.sheetnames
+            wb.close()
+            
+            # 拆分期间长期存活的对象（已导入的模块、配置等）冻结后垃圾回收不再遍历
+            gc_policy.freeze()
+            self._split_reservation = reservation
+            try:
+                # 确定要处理的sheet列表
+                sheets_to_process = self._resolve_sheets(sheetnames, sheet_name)
+                logger.info(f"将处理以下sheet: {sheets_to_process}")
+                
+                all_output_files = self._split_sheets(input_file, sheets_to_process, progress_callback)
+            finally:
+                self._split_reservation = None
+                gc_policy.unfreeze()
         
+        detailed_timer.end("Excel拆分总流程", extra_info=f"总生成文件数: {len(all_output_files)}")
+        return all_output_files
+    
+    def _split_sheets(self, input_file: str, sheets_to_process: List[str],
+                      progress_callback=None) -> List[str]:
+        """逐个拆分选中的sheet"""
         all_output_files = []
         
         # 对每个选中的sheet进行处理
         for current_sheet in sheets_to_process:
             try:
-                detailed_timer.start(f"处理Sheet: {current_sheet}")
+                detailed_timer.start("处理Sheet", sheet=current_sheet)
                 logger.info(f"正在处理sheet: {current_sheet}")
                 
-                # 只读取当前要处理的sheet
-                detailed_timer.start("读取Sheet数据")
-                df = pd.read_excel(input_file, sheet_name=current_sheet, header=0)
-                detailed_timer.end("读取Sheet数据", extra_info=f"数据行数: {len(df)}")
-                
-                # 检查拆分字段是否存在
-                if self.config.split_field not in df.columns:
-                    logger.warning(f"拆分字段 '{self.config.split_field}' 在sheet '{current_sheet}' 中不存在，跳过该sheet")
+                # 只读取当前要处理的sheet（列投影）
+                df = self._read_split_sheet(input_file, current_sheet)
+                if df is None:
                     continue
                 
-                # 应用字段筛选
-                if self.config.keep_fields and current_sheet in self.config.keep_fields:
-                    available_fields = [col for col in self.config.keep_fields[current_sheet] if col in df.columns]
-                    df = df[available_fields]
+                # 拆分键在字段筛选前计算，拆分字段不必出现在输出列中
+                split_key = self._compute_split_key(df)
                 
-                # 应用排序
-                if self.config.sort_fields:
-                    sort_fields = [col for col in self.config.sort_fields if col in df.columns]
-                    if sort_fields:
-                        df = df.sort_values(by=sort_fields)
+                # 排序并分区：每个分组是排序后数据中的一段连续切片
+                partition = self._partition_split(df, split_key, current_sheet)
+                del df, split_key
+                self.split_report[current_sheet] = {
+                    'groups': partition.row_counts(),
+                    'unassigned_rows': partition.unassigned_rows,
+                    'catch_all_group': self.config.catch_all_group if self.config.custom_groups else None
+                }
+                
+                # 写出只需要表头、首行数据的格式和版式，提取为模板
+                detailed_timer.start("提取格式模板")
+                template = SheetStyleTemplate.from_file(input_file, current_sheet)
+                detailed_timer.end("提取格式模板", extra_info=f"合并单元格: {len(template.merged_ranges)}")
                 
                 # 检查自定义分组
                 if self.config.custom_groups:
-                    sheet_output_files = self.split_excel_with_groups_optimized(df, wb, current_sheet, progress_callback)
+                    sheet_output_files = self.split_excel_with_groups_optimized(partition, template, current_sheet, progress_callback)
                 else:
-                    sheet_output_files = self.split_excel_traditional_optimized(df, wb, current_sheet, progress_callback)
+                    sheet_output_files = self.split_excel_traditional_optimized(partition, template, current_sheet, progress_callback)
                 
                 all_output_files.extend(sheet_output_files)
-                detailed_timer.end(f"处理Sheet: {current_sheet}", extra_info=f"生成文件数: {len(sheet_output_files)}")
+                detailed_timer.end("处理Sheet", extra_info=f"Sheet: {current_sheet}, 生成文件数: {len(sheet_output_files)}")
                 
             except Exception as e:
                 logger.error(f"处理sheet '{current_sheet}' 时出错: {e}")
-                detailed_timer.end(f"处理Sheet: {current_sheet}", extra_info=f"失败: {str(e)}")
+                detailed_timer.end("处理Sheet", extra_info=f"Sheet: {current_sheet}, 失败: {str(e)}")
                 continue
         
-        detailed_timer.end("Excel拆分总流程", extra_info=f"总生成文件数: {len(all_output_files)}")
         return all_output_files
     
-    def split_excel_traditional_optimized(self, df: pd.DataFrame, wb: openpyxl.Workbook, 
+    def split_excel_traditional_optimized(self, partition: SplitPartition, template: SheetStyleTemplate, 
                                         sheet_name: str, progress_callback=None) -> List[str]:
         """优化版传统拆分模式"""
         detailed_timer.start("传统拆分模式")
         
-        split_values = df[self.config.split_field].unique()
-        output_files = []
-        
-        logger.info(f"开始传统拆分，共有 {len(split_values)} 个唯一值需要处理")
+        logger.info(f"开始传统拆分，共有 {len(partition)} 个唯一值需要处理")
+        output_files = self._write_partition(partition, template, sheet_name, "拆分处理", progress_callback)
         
-        progress = ProgressTracker(len(split_values), "拆分处理")
-        
-        # 使用线程池并行处理
-        with ThreadPoolExecutor(max_workers=self.config.max_workers) as executor:
-            futures = []
-            
-            for value in split_values:
-                future = executor.submit(
-                    self._process_single_split, df, wb, sheet_name, value
-                )
-                futures.append(future)
-            
-            # 收集结果
-            for future in as_completed(futures):
-                try:
-                    output_file = future.result()
-                    if output_file:
-                        output_files.append(output_file)
-                    progress.update()
-                    if progress_callback:
-                        progress_callback(progress.current_step, progress.total_steps)
-                except Exception as e:
-                    logger.error(f"处理拆分值时出错: {e}")
-        
-        progress.complete()
         detailed_timer.end("传统拆分模式", extra_info=f"成功生成文件数: {len(output_files)}")
         return output_files
     
-    def _process_single_split(self, df: pd.DataFrame, wb: openpyxl.Workbook, 
-                            sheet_name: str, value) -> str:
-        """处理单个拆分值"""
-        thread_id = threading.current_thread().name
-        detailed_timer.start("单个拆分处理", thread_id)
-        
-        try:
-            detailed_timer.start("数据筛选", thread_id)
-            subset = df[df[self.config.split_field] == value]
-            detailed_timer.end("数据筛选", thread_id, extra_info=f"筛选结果: {len(subset)} 行")
-            
-            if subset.empty:
-                detailed_timer.end("单个拆分处理", thread_id, extra_info="无数据，跳过")
-                return None
-            
-            safe_value = str(value).replace('/', '_').replace('\\', '_').replace(':', '_')
-            output_file = self.output_dir / f"{self.config.split_field}-{safe_value}.xlsx"
-            
-            detailed_timer.start("写入拆分文件", thread_id)
-            self.write_excel_with_format_optimized(subset, wb, str(output_file), sheet_name)
-            detailed_timer.end("写入拆分文件", thread_id, extra_info=f"文件: {output_file.name}")
-            
-            detailed_timer.end("单个拆分处理", thread_id, extra_info=f"值: {value}, 行数: {len(subset)}")
-            return str(output_file)
-            
-        except Exception as e:
-            detailed_timer.end("单个拆分处理", thread_id, extra_info=f"失败: {str(e)}")
-            raise
-    
-    def split_excel_with_groups_optimized(self, df: pd.DataFrame, wb: openpyxl.Workbook, 
+    def split_excel_with_groups_optimized(self, partition: SplitPartition, template: SheetStyleTemplate, 
                                         sheet_name: str, progress_callback=None) -> List[str]:
         """优化版自定义分组拆分"""
         detailed_timer.start("分组拆分模式")
         
-        output_files = []
-        
-        # 验证分组配置
-        detailed_timer.start("验证分组配置")
-        all_group_values = set()
-        for group_values in self.config.custom_groups.values():
-            all_group_values.update(group_values)
-        
-        split_values = set(df[self.config.split_field].astype(str).unique())
-        unassigned = split_values - all_group_values
-        
-        if unassigned:
-            logger.warning(f"以下字段值未分配到任何分组: {unassigned}")
+        for group_name, rows in partition.row_counts().items():
+            if rows == 0:
+                logger.warning(f"分组 '{group_name}' 没有匹配的数据")
         
-        logger.info(f"开始分组拆分，共有 {len(self.config.custom_groups)} 个分组需要处理")
-        detailed_timer.end("验证分组配置", extra_info=f"分组数: {len(self.config.custom_groups)}")
+        logger.info(f"开始分组拆分，共有 {len(partition)} 个分组需要处理")
+        output_files = self._write_partition(partition, template, sheet_name, "分组处理", progress_callback)
         
-        progress = ProgressTracker(len(self.config.custom_groups), "分组处理")
+        detailed_timer.end("分组拆分模式", extra_info=f"成功生成文件数: {len(output_files)}")
+        return output_files
+    
+    def _write_partition(self, partition: SplitPartition, template: SheetStyleTemplate, sheet_name: str,
+                         description: str, progress_callback=None) -> List[str]:
+        """并行写出分区中的每个分组"""
+        output_files = []
+        progress = ProgressTracker(len(partition), description)
         
-        # 并行处理分组
+        # 使用线程池并行处理
         with ThreadPoolExecutor(max_workers=self.config.max_workers) as executor:
-            futures = []
-            
-            for group_name, group_values in self.config.custom_groups.items():
-                if not group_values:
-                    continue
-                
-                future = executor.submit(
-                    self._process_single_group, df, wb, sheet_name, group_name, group_values
-                )
-                futures.append(future)
+            futures = [
+                executor.submit(self._process_single_partition, partition, index, template, sheet_name)
+                for index in range(len(partition))
+            ]
             
             # 收集结果
             for future in as_completed(futures):
@@ -610,46 +2758,96 @@ class OptimizedExcelProcessor:
                     if progress_callback:
                         progress_callback(progress.current_step, progress.total_steps)
                 except Exception as e:
-                    logger.error(f"处理分组时出错: {e}")
+                    logger.error(f"{description}时出错: {e}")
         
         progress.complete()
-        detailed_timer.end("分组拆分模式", extra_info=f"成功生成文件数: {len(output_files)}")
         return output_files
     
-    def _process_single_group(self, df: pd.DataFrame, wb: openpyxl.Workbook, 
-                            sheet_name: str, group_name: str, group_values: List[str]) -> str:
-        """处理单个分组"""
+    def _process_single_partition(self, partition: SplitPartition, index: int,
+                                  template: SheetStyleTemplate, sheet_name: str) -> Optional[str]:
+        """写出单个分组：直接使用分区切片，不再逐组筛选复制"""
         thread_id = threading.current_thread().name
-        detailed_timer.start("单个分组处理", thread_id)
+        detailed_timer.start("单个拆分处理", thread_id)
         
         try:
-            detailed_timer.start("分组数据筛选", thread_id)
-            subset = df[df[self.config.split_field].astype(str).isin(group_values)]
-            detailed_timer.end("分组数据筛选", thread_id, extra_info=f"分组 '{group_name}' 筛选结果: {len(subset)} 行")
+            label = partition.labels[index]
+            subset = partition.group(index)
             
             if subset.empty:
-                logger.warning(f"分组 '{group_name}' 没有匹配的数据")
-                detailed_timer.end("单个分组处理", thread_id, extra_info="无数据，跳过")
+                detailed_timer.end("单个拆分处理", thread_id, extra_info="无数据，跳过")
                 return None
             
-            safe_group_name = group_name.replace('/', '_').replace('\\', '_').replace(':', '_')
-            output_file = self.output_dir / f"{safe_group_name}.xlsx"
+            output_file = self._split_output_path(label)
             
-            detailed_timer.start("写入分组文件", thread_id)
-            self.write_excel_with_format_optimized(subset, wb, str(output_file), sheet_name)
-            detailed_timer.end("写入分组文件", thread_id, extra_info=f"文件: {output_file.name}")
+            # 写出时整个分组会以openpyxl单元格对象的形式驻留内存，先预约再开始
+            estimate = self.memory_manager.estimate_sheet_bytes(len(subset), len(subset.columns))
+            with self.memory_manager.reserve(estimate, f"写出分组 {label}", self._split_reservation):
+                detailed_timer.start("写入拆分文件", thread_id)
+                self.write_excel_with_format_optimized(subset, template, str(output_file), sheet_name)
+                detailed_timer.end("写入拆分文件", thread_id, extra_info=f"文件: {output_file.name}")
             
-            logger.info(f"分组 '{group_name}' 完成，包含 {len(subset)} 行数据")
-            detailed_timer.end("单个分组处理", thread_id, extra_info=f"分组: {group_name}, 行数: {len(subset)}")
+            detailed_timer.end("单个拆分处理", thread_id, extra_info=f"值: {label}, 行数: {len(subset)}")
             return str(output_file)
             
         except Exception as e:
-            detailed_timer.end("单个分组处理", thread_id, extra_info=f"失败: {str(e)}")
+            detailed_timer.end("单个拆分处理", thread_id, extra_info=f"失败: {str(e)}")
             raise
     
     def merge_excel_files_optimized(self, input_files: list, output_file: str, 
                                   progress_callback=None) -> str:
-        """优化版Excel合并"""
+        """优化版Excel合并，input_files也可以是文件路径迭代器（如目录扫描）
+        
+        只有能够惰性流式合并时（见_lazy_streaming_blocker）迭代器才边产出边读取，其余情况开始前先列出全部路径。
+        """
+        self.merge_report = {}
+        self._source_names = {}
+        if not isinstance(input_files, (list, tuple)):
+            reason = self._lazy_streaming_blocker()
+            if reason:
+                if self.config.streaming_merge:
+                    logger.warning(f"{reason}，无法边扫描边合并，将先列出全部输入文件")
+                input_files = list(input_files)
+        # 按估算占用预约内存，预算不足时等待其他拆分/合并任务完成
+        with processing_metrics.job("merge"), \
+                self.memory_manager.reserve(self._estimate_merge_bytes(input_files), "Excel合并"), \
+                self.memory_manager.gc_policy.bulk_phase("Excel合并"):
+            return self._merge_excel_files(input_files, output_file, progress_callback)
+    
+    def _lazy_streaming_blocker(self) -> Optional[str]:
+        """流式合并需要先列出全部输入的原因，可以边扫描边合并时返回None"""
+        config = self.config
+        if not config.streaming_merge:
+            return "未开启流式合并"
+        if config.sort_fields:
+            return "配置了排序字段"
+        if config.selected_sheets:
+            return "按sheet合并"
+        if config.reconcile_schema:
+            return "统一列结构需要预先采样所有输入"
+        if config.dedup_keys and config.dedup_keep != "first":
+            return "去重策略需要预读所有输入的去重字段"
+        if not config.merge_columns:
+            return "未指定输出列(merge_columns)，需要预读所有输入的表头"
+        return None
+    
+    def _estimate_merge_bytes(self, input_files) -> int:
+        """估算合并任务的内存占用：流式路径逐个文件预约（此处为0），有序归并同时只持有一个文件，拼接路径持有全部输入"""
+        if self.config.streaming_merge and not self.config.sort_fields:
+            return 0
+        if self.config.sort_fields and not self.config.dedup_keys:
+            return max((self.memory_manager.estimate_file_bytes(f) for f in input_files), default=0)
+        return self.memory_manager.estimate_file_bytes(input_files)
+    
+    def _merge_excel_files(self, input_files: list, output_file: str, progress_callback=None) -> str:
+        """按配置选择多sheet、流式、有序归并或拼接合并路径"""
+        sheets = self._merge_sheets(input_files)
+        if sheets:
+            return self.merge_excel_files_multi_sheet(input_files, output_file, sheets, progress_callback)
+        if self.config.streaming_merge and not self.config.sort_fields:
+            return self.merge_excel_files_streaming(input_files, output_file, progress_callback)
+        if self.config.sort_fields and not self.config.dedup_keys and self._inputs_presorted(input_files):
+            return self.merge_excel_files_presorted(input_files, output_file, progress_callback)
+        
         detailed_timer.start("Excel合并总流程")
         logger.info(f"开始合并 {len(input_files)} 个文件")
         
@@ -657,51 +2855,79 @@ class OptimizedExcelProcessor:
         
         all_data = []
         reference_wb = None
+        files_read = 0
+        buffered_bytes = 0
+        spiller = None
+        schema = self._resolve_merge_schema(input_files)
+        if schema is not None:
+            self.merge_report['schema'] = dict(schema.dtypes)
+        dedup = self._create_deduplicator(input_files, schema)
         
         detailed_timer.start("读取合并文件")
-        for i, file_path in enumerate(input_files):
+        for i, file_path, df in self._read_inputs_ordered(input_files):
+            if isinstance(df, Exception):
+                self._skip_merge_input(file_path, df)
+                continue
+            df = self._apply_merge_schema(df, schema, file_path)
+            if dedup is not None:
+                df = dedup.filter(i, df)
+            df = self._tag_source(df, file_path)
             try:
-                detailed_timer.start(f"读取文件 {i+1}")
-                # 合并时也用默认模式，保证格式属性可用
-                wb = openpyxl.load_workbook(file_path)
-                first_sheet = wb.sheetnames[0]
-                df = pd.read_excel(file_path, sheet_name=first_sheet)
+                # 只有第一个成功读取的文件作为格式参考完整加载，其余文件只读数据
                 if reference_wb is None:
-                    reference_wb = wb
-                
-                # 应用字段筛选
-                if self.config.keep_fields:
-                    if first_sheet in self.config.keep_fields:
-                        available_fields = [col for col in self.config.keep_fields[first_sheet] if col in df.columns]
-                        df = df[available_fields]
+                    detailed_timer.start("加载参考工作簿")
+                    reference_wb = openpyxl.load_workbook(file_path)
+                    detailed_timer.end("加载参考工作簿", extra_info=f"文件: {os.path.basename(file_path)}")
                 
                 all_data.append(df)
-                detailed_timer.end(f"读取文件 {i+1}", extra_info=f"文件: {os.path.basename(file_path)}, 行数: {len(df)}")
+                files_read += 1
+                
+                # 排序合并时缓冲区超出内存预算则排序后溢写到磁盘
+                if self.config.sort_fields:
+                    buffered_bytes += int(df.memory_usage(deep=True).sum())
+                    if self.memory_manager.should_spill(buffered_bytes):
+                        spiller = spiller or self._create_spiller()
+                        if spiller is not None:
+                            detailed_timer.start("溢写有序段")
+                            rows = spiller.spill(all_data)
+                            detailed_timer.end("溢写有序段", extra_info=f"段 {len(spiller.run_paths)}, 行数: {rows}")
+                            all_data = []
+                            buffered_bytes = 0
+                            self.memory_manager.gc_policy.maybe_collect("溢写有序段")
                 
                 progress.update()
                 if progress_callback:
                     progress_callback(progress.current_step, progress.total_steps)
                 
             except Exception as e:
-                logger.error(f"读取文件 {file_path} 时出错: {e}")
-                detailed_timer.end(f"读取文件 {i+1}", extra_info=f"失败: {str(e)}")
+                self._skip_merge_input(file_path, e)
                 continue
         
-        detailed_timer.end("读取合并文件", extra_info=f"成功读取 {len(all_data)} 个文件")
+        detailed_timer.end("读取合并文件", extra_info=f"成功读取 {files_read} 个文件")
+        self._record_dedup(dedup)
         
-        if not all_data:
+        if not files_read:
             raise ValueError("没有成功读取任何文件")
         
+        if spiller is not None:
+            try:
+                if all_data:
+                    spiller.spill(all_data)
+                    all_data = []
+                output_path = self._merge_spilled_runs(spiller, reference_wb, output_file)
+            finally:
+                spiller.cleanup()
+            progress.complete()
+            detailed_timer.end("Excel合并总流程", extra_info=f"合并文件数: {files_read}, 溢写段数: {len(spiller.run_paths)}")
+            return output_path
+        
         detailed_timer.start("合并数据")
         # 合并数据
-        merged_df = pd.concat(all_data, ignore_index=True)
+        merged_df = self._concat_merge_frames(all_data)
         detailed_timer.end("合并数据", extra_info=f"合并后总行数: {len(merged_df)}")
         
         # 应用排序
-        if self.config.sort_fields:
-            sort_fields = [col for col in self.config.sort_fields if col in merged_df.columns]
-            if sort_fields:
-                merged_df = merged_df.sort_values(by=sort_fields)
+        merged_df = self._sort_frame(merged_df)
         
         detailed_timer.start("写入合并结果")
         # 写入结果
@@ -711,12 +2937,837 @@ class OptimizedExcelProcessor:
         
         output_path = self.output_dir / output_file
         self.write_excel_with_format_optimized(merged_df, reference_wb, str(output_path), sheet_name)
+        self._share_source_strings(output_path, {sheet_name: list(merged_df.columns)})
         detailed_timer.end("写入合并结果", extra_info=f"输出文件: {output_file}")
         
         progress.complete()
-        detailed_timer.end("Excel合并总流程", extra_info=f"合并文件数: {len(all_data)}")
+        detailed_timer.end("Excel合并总流程", extra_info=f"合并文件数: {files_read}")
         return str(output_path)
     
+    def _create_spiller(self) -> Optional[SortedRunSpiller]:
+        """创建溢写器，pyarrow不可用时返回None（继续在内存中排序）"""
+        try:
+            return SortedRunSpiller(self._sort_frame, self.config.spill_dir)
+        except ImportError:
+            logger.warning("pyarrow模块不可用，无法溢写到磁盘，将在内存中排序")
+            return None
+    
+    def _merge_spilled_runs(self, spiller: SortedRunSpiller, reference_wb: openpyxl.Workbook,
+                            output_file: str) -> str:
+        """k路归并所有溢写的有序段并流式写出"""
+        detailed_timer.start("归并溢写段")
+        
+        sheet_name = self.config.sheet_name
+        if sheet_name not in reference_wb.sheetnames:
+            sheet_name = reference_wb.sheetnames[0]
+        template = SheetStyleTemplate.from_worksheet(reference_wb[sheet_name])
+        
+        spiller.columns = columns = self._source_column_last(spiller.columns)
+        sort_positions = [columns.index(col) for col in self.config.sort_fields if col in columns]
+        sources = [spiller.iter_run(path, self.config.batch_size) for path in spiller.run_paths]
+        run_names = [os.path.basename(path) for path in spiller.run_paths]
+        
+        output_path = self.output_dir / output_file
+        try:
+            writer = StreamingSheetWriter(str(output_path), columns, sheet_name,
+                                          template, self.config.preserve_format)
+            for row in self._kway_merge(sources, sort_positions, run_names):
+                writer.append_row(row)
+            writer.close()
+        finally:
+            for source in sources:
+                source.close()
+        self._share_source_strings(output_path, {sheet_name: columns})
+        
+        detailed_timer.end("归并溢写段", extra_info=f"段数: {len(spiller.run_paths)}, 总行数: {writer.rows_written}")
+        return str(output_path)
+    
+    def _read_inputs_ordered(self, input_files, nrows: int = None, sheet_name: str = None,
+                             processes: int = None,
+                             columns: List[str] = None) -> Generator[Tuple[int, str, Any], None, None]:
+        """并行读取合并输入，按输入顺序逐个返回 (序号, 文件路径, 数据或异常)
+        
+        input_files可以是列表，也可以是惰性产生文件路径的迭代器（如目录扫描），只在需要时取下一个。
+        同时在途（已提交但尚未被消费）的文件数不超过prefetch_files（默认进程数+1），
+        在途文件的总大小不超过内存限制的一半（至少保留一个），以限制打开的文件数和内存占用。
+        nrows不为空时只读取每个输入的前nrows行；sheet_name为空时读取第一个sheet；
+        columns不为空时只读取这些列。
+        """
+        processes = processes or self.config.read_processes or self.config.max_workers
+        if processes <= 1 or (isinstance(input_files, (list, tuple)) and len(input_files) <= 1):
+            for i, file_path in enumerate(input_files):
+                try:
+                    df, elapsed = read_excel_input(file_path, self.config.keep_fields, nrows, sheet_name, columns)
+                    detailed_timer.record("读取输入文件", elapsed, extra_info=f"文件: {os.path.basename(file_path)}, 行数: {len(df)}")
+                    if nrows is None and columns is None:  # 采样和只读去重字段的预读不计入
+                        processing_metrics.inc('rows_read_total', len(df), kind="merge")
+                    yield i, file_path, df
+                except Exception as e:
+                    yield i, file_path, e
+            return
+        
+        max_in_flight = self.config.prefetch_files or processes + 1
+        byte_budget = self.memory_manager.limit_bytes // 2
+        pending = deque()  # (序号, 文件路径, 文件大小, future)，按提交顺序
+        in_flight_bytes = 0
+        files = iter(input_files)
+        next_file = next(files, None)
+        next_index = 0
+        
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            while pending or next_file is not None:
+                # 在数量和大小预算内尽量多提交
+                while next_file is not None and len(pending) < max_in_flight:
+                    try:
+                        size = os.path.getsize(next_file)
+                    except OSError:
+                        size = 0
+                    if pending and in_flight_bytes + size > byte_budget:
+                        break
+                    future = executor.submit(read_excel_input, next_file, self.config.keep_fields, nrows, sheet_name, columns)
+                    pending.append((next_index, next_file, size, future))
+                    in_flight_bytes += size
+                    next_index += 1
+                    next_file = next(files, None)
+                
+                # 按顺序取回最早提交的结果
+                index, file_path, size, future = pending.popleft()
+                in_flight_bytes -= size
+                try:
+                    df, elapsed = future.result()
+                    detailed_timer.record("读取输入文件", elapsed, extra_info=f"文件: {os.path.basename(file_path)}, 行数: {len(df)}")
+                    if nrows is None and columns is None:  # 采样和只读去重字段的预读不计入
+                        processing_metrics.inc('rows_read_total', len(df), kind="merge")
+                    yield index, file_path, df
+                except Exception as e:
+                    yield index, file_path, e
+    
+    def _resolve_merge_schema(self, input_files: list, sheet_name: str = None,
+                              processes: int = None) -> Optional[MergeSchema]:
+        """采样各输入的表头和前若干行，推断合并的列并集和目标类型"""
+        if not self.config.reconcile_schema:
+            return None
+        
+        detailed_timer.start("推断合并结构", sheet_name)
+        samples = []
+        for i, file_path, sample in self._read_inputs_ordered(input_files, nrows=self.config.schema_sample_rows,
+                                                               sheet_name=sheet_name, processes=processes):
+            if isinstance(sample, Exception):
+                logger.warning(f"采样文件 {file_path} 时出错: {sample}")
+                continue
+            samples.append(sample)
+        schema = MergeSchema.infer(samples)
+        detailed_timer.end("推断合并结构", sheet_name, extra_info=f"列数: {len(schema.columns)}, 采样文件数: {len(samples)}")
+        return schema
+    
+    def _merge_header_union(self, input_files: list) -> List[str]:
+        """只读取各输入的表头，按首次出现的顺序返回列并集（与concat合并的列顺序一致）"""
+        detailed_timer.start("读取输入表头")
+        columns = {}
+        for i, file_path, header in self._read_inputs_ordered(input_files, nrows=0):
+            if isinstance(header, Exception):
+                continue  # 读取失败的输入在数据阶段同样会被跳过
+            columns.update(dict.fromkeys(header.columns))
+        detailed_timer.end("读取输入表头", extra_info=f"列数: {len(columns)}")
+        return list(columns)
+    
+    def _apply_merge_schema(self, df: pd.DataFrame, schema: Optional[MergeSchema],
+                            file_path: str, sheet_name: str = None) -> pd.DataFrame:
+        """按合并结构对齐并转换一个输入，记录类型转换"""
+        if schema is None:
+            return df
+        df, coercions = schema.cast(df)
+        self._record_coercions(coercions, schema, file_path, sheet_name)
+        return df
+    
+    def _record_coercions(self, coercions: List[Dict[str, Any]], schema: MergeSchema,
+                          file_path: str, sheet_name: str = None):
+        """记录一个输入的类型转换到合并报告并输出日志"""
+        file_name = os.path.basename(file_path)
+        for coercion in coercions:
+            coercion['file'] = file_name
+            if sheet_name:
+                coercion['sheet'] = sheet_name
+            if coercion['failed']:
+                logger.warning(f"文件 {file_name} 列 {coercion['column']} 有 {coercion['failed']} 个值无法转换为"
+                               f" {schema.dtypes[coercion['column']]}，保留原值")
+            else:
+                logger.info(f"文件 {file_name} 列 {coercion['column']}: {coercion['from']} -> {coercion['to']}")
+        self.merge_report.setdefault('coercions', []).extend(coercions)
+    
+    def _create_deduplicator(self, input_files: list, schema: Optional[MergeSchema] = None,
+                             sheet_name: str = None, processes: int = None) -> Optional[MergeDeduplicator]:
+        """按配置创建去重器；保留最后一次或最新文件时先只读去重字段确定保留行"""
+        if not self.config.dedup_keys:
+            return None
+        dedup = MergeDeduplicator(self.config.dedup_keys, self.config.dedup_keep)
+        if not dedup.needs_prepass:
+            return dedup
+        
+        detailed_timer.start("建立去重索引", sheet_name)
+        key_frames = []
+        ranks = {}
+        for i, file_path, key_frame in self._read_inputs_ordered(input_files, sheet_name=sheet_name,
+                                                                  processes=processes, columns=dedup.keys):
+            if isinstance(key_frame, Exception):
+                continue  # 读取失败的输入在数据阶段同样会被跳过
+            if schema is not None:
+                key_frame = schema.cast(key_frame)[0][dedup.keys]
+            key_frames.append((i, key_frame))
+            if dedup.keep == "newest_file":
+                ranks[i] = (os.path.getmtime(file_path), i)
+            else:
+                ranks[i] = i
+        dedup.prepare(key_frames, ranks)
+        detailed_timer.end("建立去重索引", sheet_name, extra_info=f"去重字段: {dedup.keys}, 文件数: {len(key_frames)}")
+        return dedup
+    
+    def _source_name(self, file_path: str) -> str:
+        """登记来源文件名，返回写入来源列的值"""
+        name = os.path.basename(file_path)
+        self._source_names.setdefault(name, len(self._source_names))
+        return name
+    
+    def _tag_source(self, df: pd.DataFrame, file_path: str) -> pd.DataFrame:
+        """追加来源文件列：单一取值的分类列，每行只占1字节的编码"""
+        if not self.config.source_column:
+            return df
+        name = self._source_name(file_path)
+        df = df.copy(deep=False)
+        df[self.config.source_column] = pd.Categorical.from_codes(np.zeros(len(df), dtype=np.int8), categories=[name])
+        return df
+    
+    def _source_column_last(self, columns: List[Any]) -> List[Any]:
+        """来源列排在最后，与流式和有序归并路径的列顺序一致（后面文件才有的列不会排到来源列之后）"""
+        source_column = self.config.source_column
+        if not source_column or source_column not in columns:
+            return list(columns)
+        return [col for col in columns if col != source_column] + [source_column]
+    
+    def _concat_merge_frames(self, frames: List[pd.DataFrame]) -> pd.DataFrame:
+        """合并各输入的数据；来源列先统一到全部来源文件的分类，使合并结果仍是分类列"""
+        source_column = self.config.source_column
+        if source_column and all(source_column in df.columns for df in frames):
+            dtype = pd.CategoricalDtype(list(self._source_names))
+            for df in frames:
+                df[source_column] = df[source_column].astype(dtype)
+        merged_df = pd.concat(frames, ignore_index=True)
+        columns = self._source_column_last(merged_df.columns)
+        return merged_df if columns == list(merged_df.columns) else merged_df[columns]
+    
+    def _share_source_strings(self, output_path, sheet_columns: Dict[str, List[Any]]):
+        """把输出中的来源列改写为共享字符串，每个来源文件名只保存一次（对输出文件额外改写一遍）"""
+        source_column = self.config.source_column
+        if not source_column or not self._source_names:
+            return
+        positions = {sheet: list(columns).index(source_column)
+                     for sheet, columns in sheet_columns.items() if source_column in list(columns)}
+        if not positions:
+            return
+        detailed_timer.start("来源列共享字符串")
+        rewriter = SharedStringColumnWriter(str(output_path), list(self._source_names))
+        cells = rewriter.rewrite(positions)
+        detailed_timer.end("来源列共享字符串", extra_info=f"来源文件数: {len(self._source_names)}, 单元格数: {cells}")
+    
+    def _skip_merge_input(self, file_path: str, error: Exception):
+        """记录读取失败而跳过的输入（merge_report['skipped_files']）"""
+        logger.error(f"读取文件 {file_path} 时出错: {error}")
+        self.merge_report.setdefault('skipped_files', []).append(file_path)
+    
+    def _record_dedup(self, dedup: Optional[MergeDeduplicator], sheet_name: str = None):
+        """记录去重结果到合并报告"""
+        if dedup is None:
+            return
+        logger.info(f"按 {dedup.keys} 去重（保留策略: {dedup.keep}），删除重复行 {dedup.dropped_rows} 行"
+                    + (f"（sheet: {sheet_name}）" if sheet_name else ""))
+        if sheet_name:
+            self.merge_report.setdefault('sheet_dedup_dropped_rows', {})[sheet_name] = dedup.dropped_rows
+        else:
+            self.merge_report['dedup_dropped_rows'] = dedup.dropped_rows
+    
+    def merge_excel_files_streaming(self, input_files: list, output_file: str,
+                                    progress_callback=None) -> str:
+        """流式合并（不排序）：每读完一个输入就追加到只写模式的输出，不做整体concat
+        
+        输出的表头要在写第一行前确定：给定merge_columns时直接使用（其它列忽略并告警），
+        开启统一列结构时使用推断的列并集，否则先只读各输入的表头得到列并集。
+        只有给定merge_columns且不需要预读时，迭代器输入才边产出边读取，否则先列出全部路径。
+        每个文件的内存在读入后按文件大小单独预约。
+        """
+        detailed_timer.start("Excel流式合并总流程")
+        if not isinstance(input_files, (list, tuple)) and self._lazy_streaming_blocker():
+            input_files = list(input_files)
+        total_files = len(input_files) if isinstance(input_files, (list, tuple)) else None
+        logger.info(f"开始流式合并 {total_files if total_files is not None else '边扫描边读取的'} 个文件")
+        
+        progress = ProgressTracker(total_files, "文件合并")
+        output_path = self.output_dir / output_file
+        writer = None
+        merged_files = 0
+        schema = self._resolve_merge_schema(input_files)
+        if schema is not None:
+            self.merge_report['schema'] = dict(schema.dtypes)
+            columns = list(schema.columns)
+        elif self.config.merge_columns:
+            columns = list(self.config.merge_columns)
+        else:
+            columns = self._merge_header_union(input_files)
+        dedup = self._create_deduplicator(input_files, schema)
+        
+        try:
+            for i, file_path, df in self._read_inputs_ordered(input_files):
+                if isinstance(df, Exception):
+                    self._skip_merge_input(file_path, df)
+                    continue
+                reservation = self.memory_manager.acquire(self.memory_manager.estimate_file_bytes(file_path),
+                                                          f"流式合并 {os.path.basename(file_path)}")
+                try:
+                    writer = self._stream_merge_input(i, file_path, df, writer, columns, schema, dedup, output_path)
+                finally:
+                    self.memory_manager.release(reservation)
+                del df
+                merged_files += 1
+                
+                progress.update()
+                if progress_callback:
+                    progress_callback(progress.current_step, progress.total_steps)
+            
+            if writer is None:
+                raise ValueError("没有成功读取任何文件")
+            self._record_dedup(dedup)
+            
+            detailed_timer.start("保存文件")
+            writer.close()
+            detailed_timer.end("保存文件", extra_info=f"文件路径: {output_path}")
+            self._share_source_strings(output_path, {writer.ws.title: writer.columns})
+        except Exception as e:
+            detailed_timer.end("Excel流式合并总流程", extra_info=f"失败: {str(e)}")
+            raise
+        
+        progress.complete()
+        detailed_timer.end("Excel流式合并总流程", extra_info=f"合并文件数: {merged_files}, 总行数: {writer.rows_written}")
+        return str(output_path)
+    
+    def _stream_merge_input(self, i: int, file_path: str, df: pd.DataFrame,
+                            writer: Optional[StreamingSheetWriter], columns: List[Any],
+                            schema: Optional[MergeSchema], dedup: Optional[MergeDeduplicator],
+                            output_path: Path) -> StreamingSheetWriter:
+        """流式合并中处理一个输入：转换、去重、标记来源后追加到输出，第一个输入时创建写入器"""
+        df = self._apply_merge_schema(df, schema, file_path)
+        if dedup is not None:
+            df = dedup.filter(i, df)
+        df = self._tag_source(df, file_path)
+        
+        if writer is None:
+            # 第一个成功读取的文件作为格式参考，提取模板后立即释放工作簿
+            detailed_timer.start("提取格式模板")
+            reference_wb = openpyxl.load_workbook(file_path)
+            sheet_name = self.config.sheet_name
+            if sheet_name not in reference_wb.sheetnames:
+                sheet_name = reference_wb.sheetnames[0]
+            template = SheetStyleTemplate.from_worksheet(reference_wb[sheet_name])
+            reference_wb.close()
+            del reference_wb
+            detailed_timer.end("提取格式模板")
+            
+            # 来源列等合并时新增的列排在输入列之后
+            writer_columns = columns + [col for col in df.columns if col not in columns]
+            writer = StreamingSheetWriter(str(output_path), writer_columns, sheet_name,
+                                          template, self.config.preserve_format)
+        
+        extra_columns = [col for col in df.columns if col not in writer.columns]
+        if extra_columns:
+            logger.warning(f"文件 {os.path.basename(file_path)} 的列 {extra_columns} 不在输出列中，已忽略")
+        detailed_timer.start("追加写入数据")
+        writer.append_frame(df)
+        detailed_timer.end("追加写入数据", extra_info=f"累计行数: {writer.rows_written}")
+        return writer
+    
+    def _merge_sheets(self, input_files: list) -> Optional[List[str]]:
+        """需要按sheet合并时返回要合并的sheet列表；只合并各文件第一个sheet时返回None"""
+        sheets = self.config.selected_sheets
+        if not sheets or not input_files:
+            return None
+        if len(sheets) == 1:
+            try:
+                wb = openpyxl.load_workbook(input_files[0], read_only=True)
+                first_sheet = wb.sheetnames[0]
+                wb.close()
+            except Exception:
+                first_sheet = None
+            if sheets[0] == first_sheet:
+                return None
+        return list(sheets)
+    
+    def _scan_input_sheets(self, input_files: list, sheets: List[str]) -> Dict[str, List[str]]:
+        """扫描各输入包含的sheet，返回 {sheet: 包含该sheet的文件列表（按输入顺序）}"""
+        sheet_files = {sheet: [] for sheet in sheets}
+        for file_path in input_files:
+            try:
+                wb = openpyxl.load_workbook(file_path, read_only=True)
+                names = set(wb.sheetnames)
+                wb.close()
+            except Exception as e:
+                logger.error(f"读取文件 {file_path} 时出错: {e}")
+                continue
+            for sheet in sheets:
+                if sheet in names:
+                    sheet_files[sheet].append(file_path)
+        return sheet_files
+    
+    def _merge_sheet_data(self, sheet_name: str, input_files: list, processes: int) -> Optional[pd.DataFrame]:
+        """读取所有输入中的同名sheet，统一结构后合并并排序"""
+        detailed_timer.start("合并单个sheet", sheet_name)
+        schema = self._resolve_merge_schema(input_files, sheet_name, processes)
+        if schema is not None:
+            self.merge_report.setdefault('sheet_schemas', {})[sheet_name] = dict(schema.dtypes)
+        
+        dedup = None
+        if self.config.dedup_keys:
+            header, _ = read_excel_input(input_files[0], sheet_name=sheet_name, nrows=0)
+            if all(key in header.columns for key in self.config.dedup_keys):
+                dedup = self._create_deduplicator(input_files, schema, sheet_name, processes)
+            else:
+                logger.info(f"sheet {sheet_name} 不包含去重字段 {self.config.dedup_keys}，不去重")
+        
+        frames = []
+        for i, file_path, df in self._read_inputs_ordered(input_files, sheet_name=sheet_name, processes=processes):
+            if isinstance(df, Exception):
+                logger.error(f"读取文件 {file_path} 的sheet {sheet_name} 时出错: {df}")
+                continue
+            df = self._apply_merge_schema(df, schema, file_path, sheet_name)
+            if dedup is not None:
+                df = dedup.filter(i, df)
+            frames.append(self._tag_source(df, file_path))
+        self._record_dedup(dedup, sheet_name)
+        
+        if not frames:
+            detailed_timer.end("合并单个sheet", sheet_name, extra_info=f"sheet: {sheet_name}, 无可用数据")
+            return None
+        merged_df = self._sort_frame(self._concat_merge_frames(frames))
+        detailed_timer.end("合并单个sheet", sheet_name, extra_info=f"sheet: {sheet_name}, 文件数: {len(frames)}, 行数: {len(merged_df)}")
+        return merged_df
+    
+    def merge_excel_files_multi_sheet(self, input_files: list, output_file: str, sheets: List[str],
+                                      progress_callback=None) -> str:
+        """多sheet合并：每个选中的sheet跨所有输入合并到输出工作簿的同名sheet
+        
+        各sheet的读取、结构统一和排序并行进行；写出时每个sheet的格式取自包含它的第一个文件。
+        """
+        detailed_timer.start("Excel多sheet合并总流程")
+        logger.info(f"开始合并 {len(input_files)} 个文件的 {len(sheets)} 个sheet")
+        
+        detailed_timer.start("扫描输入sheet")
+        sheet_files = self._scan_input_sheets(input_files, sheets)
+        for sheet, files in sheet_files.items():
+            if not files:
+                logger.warning(f"没有输入文件包含sheet {sheet}，已跳过")
+        sheet_files = {sheet: files for sheet, files in sheet_files.items() if files}
+        detailed_timer.end("扫描输入sheet", extra_info=f"可合并sheet数: {len(sheet_files)}")
+        if not sheet_files:
+            raise ValueError("没有输入文件包含选中的sheet")
+        
+        # 数据阶段：各sheet并行，读取进程数在sheet之间分配
+        progress = ProgressTracker(len(sheet_files), "sheet合并")
+        total_processes = self.config.read_processes or self.config.max_workers
+        processes = max(1, total_processes // len(sheet_files))
+        merged = {}
+        detailed_timer.start("并行合并sheet数据")
+        with ThreadPoolExecutor(max_workers=min(len(sheet_files), self.config.max_workers)) as executor:
+            futures = {
+                executor.submit(self._merge_sheet_data, sheet, files, processes): sheet
+                for sheet, files in sheet_files.items()
+            }
+            for future in as_completed(futures):
+                sheet = futures[future]
+                try:
+                    merged[sheet] = future.result()
+                except Exception as e:
+                    logger.error(f"合并sheet {sheet} 时出错: {e}")
+                    merged[sheet] = None
+                progress.update()
+                if progress_callback:
+                    progress_callback(progress.current_step, progress.total_steps)
+        detailed_timer.end("并行合并sheet数据", extra_info=f"sheet数: {len(sheet_files)}")
+        
+        if all(df is None for df in merged.values()):
+            raise ValueError("没有成功读取任何文件")
+        
+        # 写出阶段：按选中顺序写入同一个只写工作簿，每个参考文件只加载一次
+        detailed_timer.start("写入合并结果")
+        output_path = self.output_dir / output_file
+        output_wb = openpyxl.Workbook(write_only=True)
+        reference_wbs = {}
+        sheet_columns = {}
+        total_rows = 0
+        try:
+            for sheet, files in sheet_files.items():
+                df = merged.pop(sheet)
+                if df is None:
+                    continue
+                reference_file = files[0]
+                if reference_file not in reference_wbs:
+                    reference_wbs[reference_file] = openpyxl.load_workbook(reference_file)
+                template = SheetStyleTemplate.from_worksheet(reference_wbs[reference_file][sheet])
+                writer = StreamingSheetWriter(str(output_path), df.columns, sheet, template,
+                                              self.config.preserve_format, wb=output_wb)
+                writer.append_frame(df)
+                total_rows += writer.rows_written
+                sheet_columns[sheet] = writer.columns
+                del df
+            output_wb.save(str(output_path))
+        finally:
+            output_wb.close()
+            for wb in reference_wbs.values():
+                wb.close()
+        self._share_source_strings(output_path, sheet_columns)
+        detailed_timer.end("写入合并结果", extra_info=f"输出文件: {output_file}, 总行数: {total_rows}")
+        
+        progress.complete()
+        detailed_timer.end("Excel多sheet合并总流程", extra_info=f"合并文件数: {len(input_files)}, sheet数: {len(sheet_files)}")
+        return str(output_path)
+    
+    def _is_sorted_frame(self, df: pd.DataFrame, sort_fields: List[str]) -> bool:
+        """向量化检查数据是否已按排序字段（字典序）有序"""
+        if len(df) < 2:
+            return True
+        # 从最后一个排序字段向前：相邻行在更靠前的字段上不相等时由该字段决定顺序
+        in_order = np.ones(len(df) - 1, dtype=bool)
+        for col in reversed(sort_fields):
+            diff = np.diff(self._sort_key_codes(df[col]))
+            in_order = np.where(diff != 0, diff > 0, in_order)
+        return bool(in_order.all())
+    
+    def _inputs_presorted(self, input_files: list) -> bool:
+        """判断所有输入是否已按排序字段有序，detect模式下只读取排序列"""
+        mode = self.config.presorted_inputs
+        if mode == "assume":
+            return True
+        if mode != "detect":
+            return False
+        
+        detailed_timer.start("检测输入排序")
+        for file_path in input_files:
+            try:
+                with pd.ExcelFile(file_path) as excel_file:
+                    needed = set(self.config.sort_fields)
+                    df = excel_file.parse(excel_file.sheet_names[0], usecols=lambda col: col in needed)
+            except Exception as e:
+                logger.warning(f"检测文件 {file_path} 排序时出错: {e}")
+                detailed_timer.end("检测输入排序", extra_info="检测失败")
+                return False
+            sort_fields = [col for col in self.config.sort_fields if col in df.columns]
+            if not sort_fields or not self._is_sorted_frame(df, sort_fields):
+                logger.info(f"文件 {os.path.basename(file_path)} 未按排序字段有序，使用常规排序合并")
+                detailed_timer.end("检测输入排序", extra_info="存在无序输入")
+                return False
+        detailed_timer.end("检测输入排序", extra_info=f"{len(input_files)} 个输入均已有序")
+        return True
+    
+    def _merge_sort_key(self, value) -> tuple:
+        """单个值的归并比较键：空值最后，数值、日期、文本分别比较"""
+        if value is None or (isinstance(value, float) and value != value):
+            return (1,)
+        if isinstance(value, numbers.Number):
+            return (0, 0, value)
+        if isinstance(value, (datetime, date)):
+            return (0, 1, value)
+        if isinstance(value, str):
+            if self.config.sort_collation == 'pinyin':
+                return (0, 2, pinyin_collation_key(value))
+            return (0, 2, value)
+        return (0, 3, str(value))
+    
+    def _iter_input_rows(self, file_path: str, columns: List[Any] = None,
+                         source_name: str = None) -> Generator[tuple, None, None]:
+        """以只读模式逐行读取输入的第一个sheet，按columns对齐列顺序（None时返回表头后的列）
+        
+        source_name不为空时在每行末尾追加来源文件名。
+        """
+        wb = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+        try:
+            ws = wb[wb.sheetnames[0]]
+            rows = ws.iter_rows(values_only=True)
+            header = list(next(rows, ()))
+            if columns is None:
+                columns = header
+            header_index = {name: idx for idx, name in enumerate(header)}
+            positions = [header_index.get(col) for col in columns]
+            width = len(header)
+            for row in rows:
+                if row is None or all(value is None for value in row):
+                    continue  # 与pandas一致，跳过空行
+                if len(row) < width:
+                    row = tuple(row) + (None,) * (width - len(row))
+                values = tuple(row[pos] if pos is not None else None for pos in positions)
+                yield values + (source_name,) if source_name is not None else values
+        finally:
+            wb.close()
+    
+    def _kway_merge(self, sources: List[Generator], sort_positions: List[int],
+                    file_names: List[str]) -> Generator[tuple, None, None]:
+        """k路堆归并：同键时保持输入顺序，发现输入无序时报错"""
+        def row_key(row):
+            return tuple(self._merge_sort_key(row[pos]) for pos in sort_positions)
+        
+        heap = []
+        for source_index, source in enumerate(sources):
+            row = next(source, None)
+            if row is not None:
+                heap.append((row_key(row), source_index, row))
+        heapq.heapify(heap)
+        
+        while heap:
+            key, source_index, row = heap[0]
+            yield row
+            next_row = next(sources[source_index], None)
+            if next_row is None:
+                heapq.heappop(heap)
+                continue
+            next_key = row_key(next_row)
+            if next_key < key:
+                raise ValueError(f"输入文件 {file_names[source_index]} 未按排序字段 {self.config.sort_fields} 排序")
+            heapq.heapreplace(heap, (next_key, source_index, next_row))
+    
+    def _iter_merge_rows(self, file_path: str, columns: List[Any], schema: Optional[MergeSchema],
+                         source_name: str = None) -> Generator[tuple, None, None]:
+        """逐行读取输入并对齐到合并列，按批做与pandas读取相同的值解析（如数字文本转为数值），
+        有合并结构时再按目标类型转换，与其它合并路径的结果一致
+        
+        source_name不为空时在每行末尾追加来源文件名。
+        """
+        suffix = (source_name,) if source_name is not None else ()
+        rows = self._iter_input_rows(file_path, columns)
+        coercions = {}
+        while True:
+            batch = list(itertools.islice(rows, self.config.batch_size))
+            if not batch:
+                break
+            df = TextParser(batch, names=columns).read()
+            if schema is None:
+                batch_coercions = []
+            else:
+                df, batch_coercions = schema.cast(df)
+            for coercion in batch_coercions:
+                merged = coercions.get(coercion['column'])
+                if merged is None:
+                    coercions[coercion['column']] = coercion
+                else:
+                    merged['rows'] += coercion['rows']
+                    merged['failed'] += coercion['failed']
+                    if coercion['failed']:
+                        merged['to'] = coercion['to']
+            values = df.astype(object)
+            values = values.where(values.notna(), None)
+            for row in values.itertuples(index=False, name=None):
+                yield row + suffix
+        if coercions:
+            self._record_coercions(list(coercions.values()), schema, file_path)
+    
+    def merge_excel_files_presorted(self, input_files: list, output_file: str,
+                                    progress_callback=None) -> str:
+        """有序输入的流式k路归并：输出边归并边写出，不在内存中对全量数据排序
+        
+        输出列与其它合并路径相同：开启统一列结构时为推断的列并集（并按目标类型转换），
+        否则为各输入表头的并集；无法读取的输入记录后跳过。
+        """
+        detailed_timer.start("Excel归并合并总流程")
+        logger.info(f"开始k路归并 {len(input_files)} 个已排序文件")
+        
+        output_path = self.output_dir / output_file
+        schema = self._resolve_merge_schema(input_files)
+        if schema is not None:
+            self.merge_report['schema'] = dict(schema.dtypes)
+            columns = list(schema.columns)
+        else:
+            columns = self._merge_header_union(input_files)
+        sort_positions = [columns.index(col) for col in self.config.sort_fields if col in columns]
+        if not sort_positions:
+            detailed_timer.end("Excel归并合并总流程", extra_info="排序字段不在输出字段中")
+            raise ValueError(f"排序字段 {self.config.sort_fields} 不在输出字段中，无法归并")
+        
+        # 先取出每个输入的第一行：打不开的输入在归并开始前跳过
+        source_column = self.config.source_column
+        readers, sources, file_names, merged_files = [], [], [], []
+        for file_path in input_files:
+            source_name = self._source_name(file_path) if source_column else None
+            reader = self._iter_merge_rows(file_path, columns, schema, source_name)
+            try:
+                first_row = next(reader, None)
+            except Exception as e:
+                self._skip_merge_input(file_path, e)
+                continue
+            merged_files.append(file_path)
+            if first_row is not None:
+                readers.append(reader)
+                sources.append(itertools.chain([first_row], reader))
+                file_names.append(os.path.basename(file_path))
+        if not merged_files:
+            detailed_timer.end("Excel归并合并总流程", extra_info="没有成功读取任何文件")
+            raise ValueError("没有成功读取任何文件")
+        if source_column:
+            columns = columns + [source_column]
+        
+        detailed_timer.start("提取格式模板")
+        reference_wb = openpyxl.load_workbook(merged_files[0], read_only=True)
+        sheet_name = self.config.sheet_name
+        if sheet_name not in reference_wb.sheetnames:
+            sheet_name = reference_wb.sheetnames[0]
+        reference_wb.close()
+        template = SheetStyleTemplate.from_file(merged_files[0], sheet_name)
+        detailed_timer.end("提取格式模板")
+        
+        try:
+            detailed_timer.start("归并写入数据")
+            writer = StreamingSheetWriter(str(output_path), columns, sheet_name,
+                                          template, self.config.preserve_format)
+            for row in self._kway_merge(sources, sort_positions, file_names):
+                writer.append_row(row)
+            detailed_timer.end("归并写入数据", extra_info=f"总行数: {writer.rows_written}")
+            
+            detailed_timer.start("保存文件")
+            writer.close()
+            detailed_timer.end("保存文件", extra_info=f"文件路径: {output_path}")
+            self._share_source_strings(output_path, {sheet_name: columns})
+        except Exception as e:
+            detailed_timer.end("Excel归并合并总流程", extra_info=f"失败: {str(e)}")
+            raise
+        finally:
+            for reader in readers:
+                reader.close()
+        
+        if progress_callback:
+            progress_callback(len(input_files), len(input_files))
+        detailed_timer.end("Excel归并合并总流程", extra_info=f"合并文件数: {len(merged_files)}, 总行数: {writer.rows_written}")
+        return str(output_path)
+    
+    @staticmethod
+    def _file_content_hash(file_path: str) -> str:
+        """按内容计算文件的SHA-256，用于识别已合并过的输入（与文件名无关）"""
+        digest = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        return digest.hexdigest()
+    
+    @staticmethod
+    def _append_manifest_path(master_path: Path) -> Path:
+        return master_path.with_name(master_path.name + ".manifest.json")
+    
+    def _save_append_manifest(self, manifest_path: Path, manifest: Dict[str, Any]):
+        tmp_path = manifest_path.with_name(manifest_path.name + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, manifest_path)
+    
+    def append_merge(self, input_files: list, output_file: str, progress_callback=None) -> str:
+        """增量追加合并：只读取总表中还没有的输入，把新行直接追加到总表工作表末尾
+        
+        已合并输入的内容哈希记录在总表旁的 <总表>.manifest.json 中。总表或清单不存在时
+        先完整合并一次。追加的行不参与排序，已有行不会被重新读取或设置格式。
+        """
+        detailed_timer.start("增量追加合并总流程")
+        self.merge_report = {}
+        master_path = self.output_dir / output_file
+        manifest_path = self._append_manifest_path(master_path)
+        
+        detailed_timer.start("计算文件哈希")
+        file_hashes = {file_path: self._file_content_hash(file_path) for file_path in input_files}
+        detailed_timer.end("计算文件哈希", extra_info=f"文件数: {len(input_files)}")
+        
+        if not master_path.exists() or not manifest_path.exists():
+            if master_path.exists():
+                logger.warning(f"总表 {output_file} 没有合并清单，无法确定已合并的输入，将重新完整合并")
+            if self._merge_sheets(input_files):
+                raise ValueError("增量追加合并只支持单sheet合并")
+            output_path = self.merge_excel_files_optimized(input_files, output_file, progress_callback)
+            
+            wb = openpyxl.load_workbook(output_path, read_only=True)
+            ws = wb[wb.sheetnames[0]]
+            columns = [cell.value for cell in next(ws.iter_rows(min_row=1, max_row=1))]
+            sheet_name = ws.title
+            wb.close()
+            # 读取失败被跳过的输入不记入清单，下次追加时会重新尝试
+            skipped = set(self.merge_report.get('skipped_files', []))
+            if skipped:
+                logger.warning(f"{len(skipped)} 个文件未能合并，未记入合并清单: "
+                               f"{[os.path.basename(file_path) for file_path in skipped]}")
+            added_at = datetime.now().isoformat(timespec="seconds")
+            manifest = {
+                'sheet': sheet_name,
+                'columns': columns,
+                'files': {digest: {'name': os.path.basename(file_path), 'added_at': added_at}
+                          for file_path, digest in file_hashes.items() if file_path not in skipped},
+            }
+            self._save_append_manifest(manifest_path, manifest)
+            detailed_timer.end("增量追加合并总流程", extra_info=f"完整合并文件数: {len(input_files)}")
+            return output_path
+        
+        with open(manifest_path, encoding="utf-8") as f:
+            manifest = json.load(f)
+        
+        new_files = []
+        seen = set(manifest['files'])
+        for file_path in input_files:
+            digest = file_hashes[file_path]
+            if digest in seen:
+                logger.info(f"文件 {os.path.basename(file_path)} 已在总表中，跳过")
+                continue
+            seen.add(digest)
+            new_files.append(file_path)
+        
+        if not new_files:
+            logger.info("没有新的输入文件，总表保持不变")
+            if progress_callback:
+                progress_callback(len(input_files), len(input_files))
+            detailed_timer.end("增量追加合并总流程", extra_info="无新文件")
+            return str(master_path)
+        
+        columns = manifest['columns']
+        # 新增文件会全部读入后一次追加，按其大小预约内存
+        estimate = self.memory_manager.estimate_file_bytes(new_files)
+        with processing_metrics.job("append"), \
+                self.memory_manager.reserve(estimate, "增量追加合并"), \
+                self.memory_manager.gc_policy.bulk_phase("增量追加合并"):
+            frames = []
+            appended_files = []
+            detailed_timer.start("读取新增文件")
+            for i, file_path, df in self._read_inputs_ordered(new_files):
+                if isinstance(df, Exception):
+                    logger.error(f"读取文件 {file_path} 时出错: {df}")
+                    continue
+                extra_columns = [col for col in df.columns if col not in columns]
+                if extra_columns:
+                    logger.warning(f"文件 {os.path.basename(file_path)} 的列 {extra_columns} 不在总表中，已忽略")
+                # 总表有来源列时同样标记追加的行，文件名以内联字符串写入
+                if self.config.source_column in columns:
+                    df = self._tag_source(df, file_path)
+                frames.append(df)
+                appended_files.append((file_path, len(df)))
+            detailed_timer.end("读取新增文件", extra_info=f"新增文件数: {len(appended_files)}")
+        
+            detailed_timer.start("追加写入总表")
+            appender = XlsxSheetAppender(str(master_path), manifest['sheet'])
+            rows = appender.append_frames(frames, columns)
+            del frames
+            processing_metrics.inc('rows_written_total', rows)
+            processing_metrics.inc('cells_written_total', rows * len(columns))
+            detailed_timer.end("追加写入总表", extra_info=f"追加行数: {rows}")
+        
+        added_at = datetime.now().isoformat(timespec="seconds")
+        for file_path, file_rows in appended_files:
+            manifest['files'][file_hashes[file_path]] = {
+                'name': os.path.basename(file_path), 'added_at': added_at, 'rows': file_rows
+            }
+        self._save_append_manifest(manifest_path, manifest)
+        self.merge_report['appended_files'] = [os.path.basename(file_path) for file_path, _ in appended_files]
+        self.merge_report['appended_rows'] = rows
+        
+        if progress_callback:
+            progress_callback(len(input_files), len(input_files))
+        detailed_timer.end("增量追加合并总流程", extra_info=f"新增文件数: {len(appended_files)}, 追加行数: {rows}")
+        return str(master_path)
+    
     def create_zip_archive(self, file_paths: List[str], zip_name: str) -> str:
         """创建ZIP压缩包"""
         detailed_timer.start("创建ZIP压缩包")
@@ -727,10 +3778,10 @@ class OptimizedExcelProcessor:
         with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
             for i, file_path in enumerate(file_paths):
                 if os.path.exists(file_path):
-                    detailed_timer.start(f"压缩文件 {i+1}")
+                    detailed_timer.start("压缩单个文件", file=os.path.basename(file_path))
                     zipf.write(file_path, arcname=os.path.basename(file_path))
                     file_size = os.path.getsize(file_path) / 1024 / 1024  # MB
-                    detailed_timer.end(f"压缩文件 {i+1}", extra_info=f"文件: {os.path.basename(file_path)}, 大小: {file_size:.2f}MB")
+                    detailed_timer.end("压缩单个文件", extra_info=f"文件: {os.path.basename(file_path)}, 大小: {file_size:.2f}MB")
         
         detailed_timer.end("压缩文件", extra_info=f"压缩文件数: {len(file_paths)}")
         
@@ -741,7 +3792,6 @@ class OptimizedExcelProcessor:
     
     def cleanup_cache(self):
         """清理缓存"""
-        self._format_cache.clear()
         self._workbook_cache.clear()
         self.memory_manager.force_gc()
 
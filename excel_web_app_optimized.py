@@ -34,6 +34,27 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
+@st.cache_resource
+def start_metrics_export():
+    """启动指标导出（每个进程只执行一次）
+    
+    EXCEL_METRICS_PORT：本机/metrics端口，默认9108，设为0不启动；
+    EXCEL_METRICS_FILE：设置后每 EXCEL_METRICS_INTERVAL 秒（默认15）把指标写到该文件。
+    """
+    from excel_processor_optimized import processing_metrics
+    port = int(os.environ.get("EXCEL_METRICS_PORT", "9108"))
+    if port:
+        try:
+            processing_metrics.serve(port, os.environ.get("EXCEL_METRICS_HOST", "127.0.0.1"))
+        except OSError as e:
+            print(f"指标端口 {port} 启动失败: {e}")
+    metrics_file = os.environ.get("EXCEL_METRICS_FILE")
+    if metrics_file:
+        processing_metrics.start_file_writer(metrics_file, float(os.environ.get("EXCEL_METRICS_INTERVAL", "15")))
+    return processing_metrics
+
+start_metrics_export()
+
 # 自定义CSS样式
 st.markdown("""
 <style>
@@ -116,7 +137,7 @@ with st.sidebar:
         max_value=2048, 
         value=512, 
         step=128,
-        help="内存使用限制，超过时自动垃圾回收"
+        help="内存使用限制：拆分/合并任务按估算占用预约内存，预算不足时排队等待；排序合并的数据超出时溢写到磁盘"
     )
     
     # 文件大小警告阈值
@@ -128,6 +149,13 @@ with st.sidebar:
         step=10,
         help="超过此大小的文件会显示性能提示"
     )
+    
+    # 计时模式
+    aggregate_timing = st.checkbox(
+        "低开销计时（只输出汇总）",
+        value=False,
+        help="各线程只累计计时次数和耗时，不逐次记录日志、trace和各步骤内存，适合多人同时使用时常开"
+    )
 
 # 操作模式选择
 mode = st.radio("请选择操作模式：", ["拆分大表为多个小表", "合并多个小表为大表"])
@@ -197,6 +225,8 @@ if mode == "拆分大表为多个小表":
                     all_columns = df.columns.tolist()
                     split_field = st.selectbox("选择拆分字段（每个唯一值生成一个Excel文件）", all_columns)
                     sort_fields = st.multiselect("排序字段（可多选）", all_columns)
+                    sort_collation = st.selectbox("文本排序规则", ["Unicode编码", "拼音"], key="split_collation",
+                                                  help="拼音：姓名等中文字段按拼音顺序排序")
                 except Exception as e:
                     st.error(f"读取字段失败: {e}")
                 preserve_format = st.checkbox("保留单元格格式", value=True, help="保留字体、颜色、边框等格式")
@@ -221,6 +251,7 @@ if mode == "拆分大表为多个小表":
                     help="将多个字段值合并到同一个Excel文件中"
                 )
                 
+                catch_all_group = ""
                 if use_custom_groups:
                     # 分组配置管理
                     col1, col2 = st.columns(2)
@@ -321,6 +352,67 @@ if mode == "拆分大表为多个小表":
                                 st.write("请先创建分组")
                     else:
                         st.success("✅ 所有字段值已分配完毕！")
+                    
+                    catch_all_group = st.text_input(
+                        "未分配值归入分组",
+                        value="",
+                        placeholder="如：其他",
+                        help="未分配到任何分组的数据归入此分组单独输出；留空则不输出这些数据"
+                    )
+                
+                def build_split_config():
+                    """根据当前界面选项创建拆分配置"""
+                    config = ProcessingConfig(
+                        split_field=split_field,
+                        keep_fields=keep_fields_dict,
+                        sort_fields=sort_fields,
+                        sort_collation="pinyin" if sort_collation == "拼音" else None,
+                        output_dir="output",
+                        sheet_name=None,
+                        selected_sheets=selected_sheets,  # 传递用户选择的sheet列表
+                        preserve_format=preserve_format,
+                        batch_size=batch_size,
+                        max_workers=max_workers,
+                        memory_limit_mb=memory_limit_mb,
+                        timer_mode="aggregate" if aggregate_timing else "detailed"
+                    )
+                    
+                    if use_custom_groups and 'groups' in st.session_state and st.session_state.groups:
+                        config.custom_groups = st.session_state.groups
+                        config.catch_all_group = catch_all_group.strip() or None
+                    return config
+                
+                # 拆分预演：只读取和分区，不写文件
+                calibrate_plan = st.checkbox("预估前用数据样本校准成本模型", value=False, help="写入少量样本到临时目录以测量实际单元格成本")
+                if st.button("📋 预估拆分结果"):
+                    try:
+                        with st.spinner("正在预估拆分结果..."):
+                            planner = OptimizedExcelProcessor(build_split_config())
+                            plan = planner.plan_split(tmp_path, calibrate=calibrate_plan)
+                        
+                        st.info(f"""
+                        📋 **拆分预估：**
+                        - 预计生成文件数：{plan['total_files']} 个
+                        - 预计输出行数：{plan['total_rows']} 行
+                        - 预计输出总大小：{plan['total_est_bytes'] / 1024 / 1024:.2f} MB
+                        - 预计写入耗时：{plan['total_est_seconds']:.1f} 秒
+                        """)
+                        plan_rows = [
+                            {
+                                "工作表": sheet,
+                                "分组": str(group['group']),
+                                "输出文件": group['file'],
+                                "行数": group['rows'],
+                                "预计大小(KB)": round(group['est_bytes'] / 1024, 1),
+                                "预计耗时(秒)": round(group['est_seconds'], 2)
+                            }
+                            for sheet, sheet_plan in plan['sheets'].items()
+                            for group in sheet_plan['groups']
+                        ]
+                        if plan_rows:
+                            st.dataframe(pd.DataFrame(plan_rows), use_container_width=True)
+                    except Exception as e:
+                        st.error(f"预估拆分结果失败: {str(e)}")
                 
                 # 开始处理按钮
                 if st.button("🚀 开始拆分", type="primary"):
@@ -336,26 +428,11 @@ if mode == "拆分大表为多个小表":
                     try:
                         # 重置计时器
                         from excel_processor_optimized import detailed_timer
-                        detailed_timer.timers.clear()
-                        detailed_timer.current_timers.clear()
+                        detailed_timer.reset()
                         
                         with st.spinner("正在初始化处理..."):
                             # 创建配置
-                            config = ProcessingConfig(
-                                split_field=split_field,
-                                keep_fields=keep_fields_dict,
-                                sort_fields=sort_fields,
-                                output_dir="output",
-                                sheet_name=None,
-                                selected_sheets=selected_sheets,  # 传递用户选择的sheet列表
-                                preserve_format=preserve_format,
-                                batch_size=batch_size,
-                                max_workers=max_workers,
-                                memory_limit_mb=memory_limit_mb
-                            )
-                            
-                            if use_custom_groups and 'groups' in st.session_state and st.session_state.groups:
-                                config.custom_groups = st.session_state.groups
+                            config = build_split_config()
                             
                             # 创建处理器
                             processor = OptimizedExcelProcessor(config)
@@ -393,6 +470,33 @@ if mode == "拆分大表为多个小表":
                         - 内存使用：{processor.memory_manager.get_memory_usage():.1f} MB
                         """)
                         
+                        # 分组行数统计
+                        for sheet, report in processor.split_report.items():
+                            if report['unassigned_rows']:
+                                if report['catch_all_group']:
+                                    st.info(f"工作表 {sheet}：{report['unassigned_rows']} 行未分配数据已归入分组「{report['catch_all_group']}」")
+                                else:
+                                    st.warning(f"工作表 {sheet}：{report['unassigned_rows']} 行数据未分配到任何分组，未输出")
+                        if use_custom_groups:
+                            report_rows = [
+                                {"工作表": sheet, "分组": str(group), "行数": rows}
+                                for sheet, report in processor.split_report.items()
+                                for group, rows in report['groups'].items()
+                            ]
+                            if report_rows:
+                                st.dataframe(pd.DataFrame(report_rows), use_container_width=True)
+                        
+                        # 各步骤的峰值内存（后台采样）
+                        memory_rows = [
+                            {"步骤": step, "执行次数": stat['count'], "峰值内存(MB)": round(stat['peak_rss_mb'], 1),
+                             "最大增长(MB)": round(stat['max_growth_mb'], 1)}
+                            for step, stat in detailed_timer.get_stats().items() if 'peak_rss_mb' in stat
+                        ]
+                        if memory_rows:
+                            with st.expander("各步骤内存使用"):
+                                st.dataframe(pd.DataFrame(memory_rows).sort_values("最大增长(MB)", ascending=False),
+                                             use_container_width=True)
+                        
                         # 下载按钮
                         with open(zip_path, "rb") as f:
                             st.download_button(
@@ -409,6 +513,16 @@ if mode == "拆分大表为多个小表":
                         from excel_processor_optimized import detailed_timer
                         detailed_timer.print_summary()
                         
+                        # 计时区间导出为trace，可在chrome://tracing或Perfetto中查看各线程时间线
+                        trace_path = detailed_timer.export_chrome_trace(str(processor.output_dir / "split_trace.json"))
+                        with open(trace_path, "rb") as f:
+                            st.download_button(
+                                "📈 下载计时trace（Chrome/Perfetto）",
+                                f,
+                                file_name="split_trace.json",
+                                mime="application/json"
+                            )
+                        
                     except Exception as e:
                         st.error(f"处理过程中出现错误: {str(e)}")
                         st.exception(e)
@@ -456,7 +570,7 @@ elif mode == "合并多个小表为大表":
         with tempfile.TemporaryDirectory() as tmpdir:
             file_paths = []
             all_columns = set()
-            all_sheet_names = set()
+            sheet_files = {}  # sheet名 -> 包含该sheet的文件
             
             with st.spinner("正在分析文件结构..."):
                 for up in uploaded_files:
@@ -465,14 +579,17 @@ elif mode == "合并多个小表为大表":
                         f.write(up.getvalue())
                     
                     wb = openpyxl.load_workbook(file_path, read_only=True)
-                    all_sheet_names.update(wb.sheetnames)
+                    for name in wb.sheetnames:
+                        sheet_files.setdefault(name, []).append(file_path)
                     df = pd.read_excel(file_path, sheet_name=wb.sheetnames[0], nrows=100)  # 只读取前100行
                     all_columns.update(df.columns.tolist())
                     file_paths.append(file_path)
                     wb.close()
             
-            all_sheet_names = list(all_sheet_names)
+            all_sheet_names = sorted(sheet_files)
             all_columns = list(all_columns)
+            # 多个文件共有的sheet名；各文件只有一个名称不同的sheet（如按分公司命名）时按各文件第一个sheet合并
+            shared_sheet_names = [name for name in all_sheet_names if len(sheet_files[name]) > 1]
             
             # 工作表选择
             selected_sheets = st.multiselect(
@@ -486,7 +603,7 @@ elif mode == "合并多个小表为大表":
                 # 多sheet字段选择
                 keep_fields_dict = {}
                 for sheet in selected_sheets:
-                    df_sheet = pd.read_excel(file_paths[0], sheet_name=sheet, nrows=100)
+                    df_sheet = pd.read_excel(sheet_files[sheet][0], sheet_name=sheet, nrows=100)
                     all_columns = df_sheet.columns.tolist()
                     keep_fields_dict[sheet] = st.multiselect(
                         f"{sheet} 保留字段（可多选）", 
@@ -502,13 +619,58 @@ elif mode == "合并多个小表为大表":
                     all_columns,
                     help="选择用于排序的字段，可以多选"
                 )
+                sort_collation = st.selectbox("文本排序规则", ["Unicode编码", "拼音"], key="merge_collation",
+                                              help="拼音：姓名等中文字段按拼音顺序排序")
+                presorted_modes = {"常规排序": "off", "自动检测是否已排序": "detect", "输入均已排序": "assume"}
+                presorted_choice = st.selectbox(
+                    "输入文件排序状态",
+                    list(presorted_modes.keys()),
+                    help="输入已按排序字段排好序时（如拆分结果），使用流式k路归并，无需在内存中整体排序"
+                )
+                
+                # 去重选项
+                dedup_keys = st.multiselect(
+                    "去重字段（可多选）",
+                    all_columns,
+                    help="按这些字段判断重复员工，如工号或姓名+部门；不选则不去重"
+                )
+                dedup_policies = {"保留第一次出现": "first", "保留最后一次出现": "last", "保留最新文件中的": "newest_file"}
+                dedup_choice = st.selectbox("重复时保留", list(dedup_policies.keys()), disabled=not dedup_keys)
                 
                 # 格式保留选项
                 preserve_format = st.checkbox("保留单元格格式", value=True, help="保留字体、颜色、边框等格式")
                 
+                # 流式合并选项
+                streaming_merge = st.checkbox(
+                    "流式合并（不排序时生效）",
+                    value=True,
+                    help="逐个文件读取并追加写出，内存占用只与单个文件大小有关"
+                )
+                
+                # 结构统一选项
+                reconcile_schema = st.checkbox(
+                    "统一列结构和类型",
+                    value=True,
+                    help="合并前采样各文件，补齐缺失列并统一列类型（如部分文件中薪资为文本），减少内存占用"
+                )
+                
+                # 来源文件列
+                source_column = st.text_input(
+                    "来源文件列名（可选）",
+                    value="",
+                    help="填写后在合并结果中追加一列，记录每行来自哪个文件；每个文件名在结果文件中只保存一次"
+                )
+                
                 # 输出文件名
                 output_file = st.text_input("合并后文件名", value="合并结果.xlsx", help="指定合并后的文件名")
                 
+                # 增量追加选项
+                append_mode = st.checkbox(
+                    "增量追加到已有总表",
+                    value=False,
+                    help="只读取总表中还没有的文件（按文件内容识别），新行追加到总表末尾，不重新合并已有数据"
+                )
+                
                 # 开始合并按钮
                 if st.button("🚀 开始合并", type="primary"):
                     # 创建进度条（在按钮下方）
@@ -523,20 +685,31 @@ elif mode == "合并多个小表为大表":
                     try:
                         # 重置计时器
                         from excel_processor_optimized import detailed_timer
-                        detailed_timer.timers.clear()
-                        detailed_timer.current_timers.clear()
+                        detailed_timer.reset()
                         
                         with st.spinner("正在初始化合并..."):
+                            # 只有输入共有多个sheet或用户缩小了选择时才按sheet分别合并，
+                            # 否则合并各文件的第一个sheet，并可使用流式/有序归并/溢写等路径
+                            merge_by_sheet = len(shared_sheet_names) > 1 or set(selected_sheets) != set(all_sheet_names)
                             # 创建配置
                             config = ProcessingConfig(
                                 keep_fields=keep_fields_dict,
+                                selected_sheets=selected_sheets if merge_by_sheet else None,
                                 sort_fields=sort_fields,
+                                sort_collation="pinyin" if sort_collation == "拼音" else None,
                                 output_dir="output",
                                 sheet_name=None,
                                 preserve_format=preserve_format,
+                                streaming_merge=streaming_merge,
+                                reconcile_schema=reconcile_schema,
+                                dedup_keys=dedup_keys,
+                                dedup_keep=dedup_policies[dedup_choice],
+                                source_column=source_column.strip() or None,
+                                presorted_inputs=presorted_modes[presorted_choice],
                                 batch_size=batch_size,
                                 max_workers=max_workers,
-                                memory_limit_mb=memory_limit_mb
+                                memory_limit_mb=memory_limit_mb,
+                                timer_mode="aggregate" if aggregate_timing else "detailed"
                             )
                             
                             # 创建处理器
@@ -546,7 +719,8 @@ elif mode == "合并多个小表为大表":
                         start_time = time.time()
                         
                         with st.spinner("正在合并数据..."):
-                            result_file = processor.merge_excel_files_optimized(
+                            merge = processor.append_merge if append_mode else processor.merge_excel_files_optimized
+                            result_file = merge(
                                 file_paths, 
                                 output_file,
                                 progress_callback=progress_callback
@@ -567,6 +741,34 @@ elif mode == "合并多个小表为大表":
                         - 内存使用：{processor.memory_manager.get_memory_usage():.1f} MB
                         - 输出文件：{output_file}
                         """)
+                        if append_mode and 'appended_rows' in processor.merge_report:
+                            st.info(f"已追加 {len(processor.merge_report['appended_files'])} 个新文件，"
+                                    f"共 {processor.merge_report['appended_rows']} 行")
+                        dropped_rows = processor.merge_report.get('dedup_dropped_rows')
+                        if dropped_rows:
+                            st.info(f"按 {'+'.join(dedup_keys)} 去重，删除重复行 {dropped_rows} 行")
+                        for sheet, rows in processor.merge_report.get('sheet_dedup_dropped_rows', {}).items():
+                            if rows:
+                                st.info(f"工作表 {sheet}：按 {'+'.join(dedup_keys)} 去重，删除重复行 {rows} 行")
+                        coercions = processor.merge_report.get('coercions', [])
+                        if coercions:
+                            st.info("合并时进行了以下类型转换：")
+                            st.dataframe(pd.DataFrame([
+                                {"文件": c['file'], "列": c['column'], "原类型": c['from'], "目标类型": c['to'],
+                                 "行数": c['rows'], "无法转换": c['failed']}
+                                for c in coercions
+                            ]), use_container_width=True)
+                        
+                        # 各步骤的峰值内存（后台采样）
+                        memory_rows = [
+                            {"步骤": step, "执行次数": stat['count'], "峰值内存(MB)": round(stat['peak_rss_mb'], 1),
+                             "最大增长(MB)": round(stat['max_growth_mb'], 1)}
+                            for step, stat in detailed_timer.get_stats().items() if 'peak_rss_mb' in stat
+                        ]
+                        if memory_rows:
+                            with st.expander("各步骤内存使用"):
+                                st.dataframe(pd.DataFrame(memory_rows).sort_values("最大增长(MB)", ascending=False),
+                                             use_container_width=True)
                         
                         # 下载按钮
                         with open(result_file, "rb") as f:
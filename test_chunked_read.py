@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试分块读取的列缓冲区：构造的数据块与按行构造DataFrame的结果一致
+"""
+
+from datetime import datetime
+
+import pandas as pd
+
+from excel_processor_optimized import ColumnChunkBuilder
+
+def build_chunk(rows, headers):
+    """逐行写入列缓冲区并构造数据块"""
+    chunk = ColumnChunkBuilder(len(headers), 8)
+    for row in rows:
+        chunk.append(row)
+    return chunk.to_frame(headers)
+
+def test_chunk_matches_row_frame():
+    """整数、小数列使用数值缓冲区，混合类型、短行和全空列与按行构造一致"""
+    headers = ['工号', '薪资', '入职日期', '部门', '备注', '编号', '状态']
+    rows = [
+        (1, 8000.5, datetime(2020, 1, 1), '技术部', None, 1, True),
+        (2, None, None, '人事部', None, None, '在职'),
+        (3, 7000.0, datetime(2021, 5, 3), 42),  # 短行
+        (2 ** 70, 6500.0, datetime(2022, 7, 9), '财务部', None, 'A-1', False, '多出的列'),
+    ]
+    expected = pd.DataFrame([list(row[:len(headers)]) + [None] * (len(headers) - len(row)) for row in rows],
+                            columns=headers)
+    actual = build_chunk(rows, headers)
+    pd.testing.assert_frame_equal(actual, expected, check_exact=True)
+    assert actual['编号'].tolist() == [1, None, None, 'A-1']  # 退回object时空值还原为None
+    
+    numeric = build_chunk([(1, 1.5), (2, None)], ['工号', '薪资'])
+    assert numeric.dtypes.tolist() == ['int64', 'float64']
+
+if __name__ == "__main__":
+    test_chunk_matches_row_frame()
+    print("分块读取测试完成！")
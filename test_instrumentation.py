@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试计时和指标：嵌套区间、累计模式、分位耗时和Prometheus指标导出
+"""
+
+import json
+import logging
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import pandas as pd
+
+from excel_processor_optimized import (DetailedTimer, OptimizedExcelProcessor, ProcessingConfig,
+                                       ProcessingMetrics, detailed_timer, processing_metrics)
+
+logging.disable(logging.INFO)
+
+def test_nested_spans_and_trace():
+    """嵌套区间记录父区间，步骤耗时与区间时长使用同一时钟，并能导出Chrome trace"""
+    timer = DetailedTimer()
+    with timer.span("拆分", sheet="员工信息"):
+        with timer.span("写入拆分文件"):
+            time.sleep(0.01)
+    inner, outer = timer.spans
+    assert (inner.name, outer.name) == ("写入拆分文件", "拆分")
+    assert inner.parent_id == outer.span_id and outer.parent_id is None
+    assert abs(timer.get_stats("写入拆分文件")['total_time'] - (inner.end - inner.start)) < 0.001
+    
+    with tempfile.TemporaryDirectory() as tmpdir:
+        trace_path = timer.export_chrome_trace(str(Path(tmpdir) / "trace.json"))
+        with open(trace_path, encoding="utf-8") as f:
+            events = [event for event in json.load(f)['traceEvents'] if event['ph'] == 'X']
+    assert {event['name'] for event in events} == {"拆分", "写入拆分文件"}
+    outer_event = next(event for event in events if event['name'] == "拆分")
+    assert outer_event['args']['sheet'] == "员工信息"
+
+def test_aggregate_mode_counts_all_threads():
+    """累计模式不记录区间，各线程的计时在统计时合并"""
+    timer = DetailedTimer()
+    timer.set_mode("aggregate")
+    
+    def work():
+        for _ in range(50):
+            timer.start("写入数据行")
+            timer.end("写入数据行")
+    
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert timer.get_stats("写入数据行")['count'] == 200
+    assert len(timer.spans) == 0
+
+def test_step_quantiles():
+    """分位耗时由直方图估算，误差在2%以内"""
+    timer = DetailedTimer()
+    for ms in range(1, 101):
+        timer.record("读取输入文件", ms / 1000)
+    stats = timer.get_stats("读取输入文件")
+    assert stats['count'] == 100 and stats['max_time'] == 0.1
+    assert abs(stats['p50_time'] - 0.05) <= 0.001
+    assert abs(stats['p99_time'] - 0.099) <= 0.002
+
+def test_metrics_export_survives_reset():
+    """指标中的读取行数和步骤耗时在detailed_timer.reset()后仍然累计"""
+    metrics = ProcessingMetrics()
+    metrics.inc('rows_read_total', 3, kind="merge")
+    metrics.inc('rows_read_total', 2, kind="merge")
+    detailed_timer.record("指标测试步骤", 0.2)
+    detailed_timer.reset()
+    detailed_timer.record("指标测试步骤", 0.4)
+    
+    lines = metrics.render().splitlines()
+    assert 'excel_rows_read_total{kind="merge"} 5.0' in lines
+    assert 'excel_step_duration_seconds_count{step="指标测试步骤"} 2.0' in lines
+    step_sum = next(line for line in lines if line.startswith('excel_step_duration_seconds_sum{step="指标测试步骤"}'))
+    assert abs(float(step_sum.split()[-1]) - 0.6) < 1e-9
+
+def test_plan_split_does_not_count_reads():
+    """拆分预演只统计分组行数，不计入读取的数据行数"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        input_file = Path(tmpdir) / "员工花名册.xlsx"
+        pd.DataFrame({
+            '姓名': ['张一', '张二', '张三'],
+            '部门': ['技术部', '人事部', '技术部']
+        }).to_excel(input_file, index=False, sheet_name="员工信息")
+        config = ProcessingConfig(split_field='部门', sheet_name="员工信息", output_dir=tmpdir, memory_sample_ms=0)
+        before = processing_metrics.render()
+        plan = OptimizedExcelProcessor(config).plan_split(str(input_file))
+        assert {group['group']: group['rows'] for group in plan['sheets']['员工信息']['groups']} == {
+            '技术部': 2, '人事部': 1}
+        rows_read = lambda text: [line for line in text.splitlines() if line.startswith('excel_rows_read_total')]
+        assert rows_read(processing_metrics.render()) == rows_read(before)
+
+if __name__ == "__main__":
+    test_nested_spans_and_trace()
+    test_aggregate_mode_counts_all_threads()
+    test_step_quantiles()
+    test_metrics_export_survives_reset()
+    test_plan_split_does_not_count_reads()
+    print("计时和指标测试完成！")
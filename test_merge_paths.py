@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+测试合并路径：各合并路径输出的列和行顺序一致
+"""
+
+import json
+import logging
+import os
+import tempfile
+import zipfile
+from pathlib import Path
+
+import pandas as pd
+import openpyxl
+
+from excel_processor_optimized import OptimizedExcelProcessor, ProcessingConfig
+
+logging.disable(logging.INFO)
+
+def create_branch_files(tmpdir):
+    """创建两个表头不同、均已按姓名排序的分公司文件，后一个文件多出"备注"列"""
+    first = Path(tmpdir) / "分公司1.xlsx"
+    second = Path(tmpdir) / "分公司2.xlsx"
+    pd.DataFrame({
+        '姓名': ['张一', '张三', '张五'],
+        '部门': ['技术部', '人事部', '财务部'],
+        '薪资': [8000, 6000, 7000]
+    }).to_excel(first, index=False, sheet_name="员工信息")
+    pd.DataFrame({
+        '姓名': ['张二', '张四'],
+        '部门': ['销售部', '技术部'],
+        '薪资': ['9000', '12000'],  # 文本形式的数字
+        '备注': ['新入职', '']
+    }).to_excel(second, index=False, sheet_name="员工信息")
+    return [str(first), str(second)]
+
+def merged_rows(input_files, output_dir, **options):
+    """按给定配置合并，返回输出工作表的所有行（含表头）"""
+    config = ProcessingConfig(output_dir=output_dir, memory_sample_ms=0, **options)
+    processor = OptimizedExcelProcessor(config)
+    output_path = processor.merge_excel_files_optimized(input_files, "合并结果.xlsx")
+    wb = openpyxl.load_workbook(output_path)
+    rows = list(wb.active.values)
+    wb.close()
+    return rows
+
+def test_presorted_merge_keeps_all_columns():
+    """有序输入的k路归并与拼接合并输出相同的列并集和行顺序"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        input_files = create_branch_files(tmpdir)
+        for reconcile_schema in (True, False):
+            expected = merged_rows(input_files, tmpdir, sort_fields=['姓名'], reconcile_schema=reconcile_schema)
+            presorted = merged_rows(input_files, tmpdir, sort_fields=['姓名'], reconcile_schema=reconcile_schema,
+                                    presorted_inputs="assume")
+            assert presorted[0] == ('姓名', '部门', '薪资', '备注')
+            assert [row[0] for row in presorted[1:]] == sorted(['张一', '张二', '张三', '张四', '张五'])
+            assert presorted == expected
+
+def test_merge_paths_agree():
+    """拼接、流式、按sheet、溢写和有序归并各路径输出相同的列顺序和行顺序（含来源列）"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        input_files = create_branch_files(tmpdir)
+        for options in ({}, {'source_column': '来源文件'}, {'reconcile_schema': True, 'source_column': '来源文件'}):
+            expected = merged_rows(input_files, tmpdir, **options)
+            assert expected[0][:4] == ('姓名', '部门', '薪资', '备注')
+            assert merged_rows(input_files, tmpdir, streaming_merge=True, **options) == expected
+            assert merged_rows(input_files, tmpdir, selected_sheets=['员工信息'], **options) == expected
+            
+            sorted_rows = merged_rows(input_files, tmpdir, sort_fields=['姓名'], **options)
+            assert sorted_rows[0] == expected[0]
+            assert sorted(sorted_rows[1:]) == sorted(expected[1:])
+            assert merged_rows(input_files, tmpdir, sort_fields=['姓名'], memory_limit_mb=0, **options) == sorted_rows
+            assert merged_rows(input_files, tmpdir, sort_fields=['姓名'], presorted_inputs="assume",
+                               **options) == sorted_rows
+
+def create_duplicate_files(tmpdir):
+    """创建两个有重复工号的月度文件：一月内部工号1重复，工号2在两个文件中都有"""
+    january = Path(tmpdir) / "一月.xlsx"
+    february = Path(tmpdir) / "二月.xlsx"
+    pd.DataFrame({
+        '工号': [1, 2, 1, 3],
+        '姓名': ['张一', '张二', '张一', '张三'],
+        '薪资': [100, 200, 110, 300]
+    }).to_excel(january, index=False, sheet_name="员工信息")
+    pd.DataFrame({
+        '工号': [2, 4],
+        '姓名': ['张二', '张四'],
+        '薪资': [220, 400]
+    }).to_excel(february, index=False, sheet_name="员工信息")
+    return [str(january), str(february)]
+
+def test_dedup_keep_first_and_last():
+    """各合并路径去重时保留第一次或最后一次出现的行，未排序时保持该行原来的位置"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        input_files = create_duplicate_files(tmpdir)
+        expected = {
+            'first': [(1, '张一', 100), (2, '张二', 200), (3, '张三', 300), (4, '张四', 400)],
+            'last': [(1, '张一', 110), (3, '张三', 300), (2, '张二', 220), (4, '张四', 400)],
+        }
+        for keep, rows in expected.items():
+            for options in ({}, {'streaming_merge': True}, {'selected_sheets': ['员工信息']}):
+                merged = merged_rows(input_files, tmpdir, dedup_keys=['工号'], dedup_keep=keep, **options)
+                assert merged[1:] == rows, (keep, options)
+            for options in ({}, {'memory_limit_mb': 0}):
+                merged = merged_rows(input_files, tmpdir, dedup_keys=['工号'], dedup_keep=keep,
+                                     sort_fields=['工号'], **options)
+                assert merged[1:] == sorted(rows), (keep, options)
+
+def test_dedup_keep_newest_file():
+    """保留最新文件中的行：重复工号取修改时间最新的文件，同一文件内取最后一次出现"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        january, february = create_duplicate_files(tmpdir)
+        os.utime(february, (1_600_000_000, 1_600_000_000))  # 二月的文件反而更旧
+        merged = merged_rows([january, february], tmpdir, dedup_keys=['工号'], dedup_keep="newest_file")
+        assert merged[1:] == [(2, '张二', 200), (1, '张一', 110), (3, '张三', 300), (4, '张四', 400)]
+
+def test_append_merge_matches_full_merge():
+    """增量追加合并：首次完整合并并记录清单，之后只追加新文件，结果与一次性完整合并相同"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        input_files = create_branch_files(tmpdir)
+        third = Path(tmpdir) / "分公司3.xlsx"
+        third.write_bytes(b"not an xlsx file")  # 首次合并时读取失败
+        all_files = input_files + [str(third)]
+        
+        processor = OptimizedExcelProcessor(ProcessingConfig(output_dir=tmpdir, memory_sample_ms=0))
+        processor.append_merge(all_files, "总表.xlsx")
+        manifest_path = Path(tmpdir) / "总表.xlsx.manifest.json"
+        manifest = json.loads(manifest_path.read_text(encoding="utf-8"))
+        assert sorted(entry['name'] for entry in manifest['files'].values()) == ['分公司1.xlsx', '分公司2.xlsx']
+        
+        pd.DataFrame({
+            '姓名': ['张六'], '部门': ['人事部'], '薪资': [5000], '备注': ['补录']
+        }).to_excel(third, index=False, sheet_name="员工信息")
+        processor.append_merge(all_files, "总表.xlsx")
+        assert processor.merge_report['appended_files'] == ['分公司3.xlsx']
+        processor.append_merge(all_files, "总表.xlsx")  # 没有新文件，总表不变
+        assert 'appended_files' not in processor.merge_report
+        
+        wb = openpyxl.load_workbook(Path(tmpdir) / "总表.xlsx")
+        appended = list(wb.active.values)
+        wb.close()
+        assert appended == merged_rows(all_files, tmpdir)
+
+def test_multi_sheet_merge_reconciles_each_sheet():
+    """多sheet合并：每个sheet单独统一结构并合并到同名sheet，缺少该sheet的输入不影响其他sheet"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        first = Path(tmpdir) / "分公司1.xlsx"
+        second = Path(tmpdir) / "分公司2.xlsx"
+        with pd.ExcelWriter(first) as writer:
+            pd.DataFrame({'姓名': ['张一'], '薪资': [8000]}).to_excel(writer, index=False, sheet_name='员工')
+            pd.DataFrame({'部门': ['技术部'], '人数': [3]}).to_excel(writer, index=False, sheet_name='部门')
+        with pd.ExcelWriter(second) as writer:
+            pd.DataFrame({'姓名': ['张二'], '薪资': [6500.5]}).to_excel(writer, index=False, sheet_name='员工')
+        
+        config = ProcessingConfig(output_dir=tmpdir, memory_sample_ms=0, selected_sheets=['员工', '部门'],
+                                  reconcile_schema=True, source_column='来源文件')
+        processor = OptimizedExcelProcessor(config)
+        output_path = processor.merge_excel_files_optimized([str(first), str(second)], "合并结果.xlsx")
+        wb = openpyxl.load_workbook(output_path)
+        sheets = {ws.title: list(ws.values) for ws in wb}
+        wb.close()
+        
+        assert sheets == {
+            '员工': [('姓名', '薪资', '来源文件'), ('张一', 8000, '分公司1.xlsx'), ('张二', 6500.5, '分公司2.xlsx')],
+            '部门': [('部门', '人数', '来源文件'), ('技术部', 3, '分公司1.xlsx')],
+        }
+        assert processor.merge_report['sheet_schemas']['员工'] == {'姓名': 'string', '薪资': 'float'}
+        assert processor.merge_report['coercions'] == [{
+            'column': '薪资', 'from': 'int', 'to': 'float', 'rows': 1, 'failed': 0,
+            'file': '分公司1.xlsx', 'sheet': '员工'
+        }]
+
+def test_streaming_merge_reads_iterator_lazily():
+    """指定输出列时，迭代器输入边产出边合并，多出的列被忽略"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        input_files = create_branch_files(tmpdir)
+        events = []
+        
+        def scan():
+            for file_path in input_files:
+                events.append(('扫描', Path(file_path).name))
+                yield file_path
+        
+        config = ProcessingConfig(output_dir=tmpdir, memory_sample_ms=0, read_processes=1,
+                                  streaming_merge=True, merge_columns=['姓名', '部门', '薪资'])
+        processor = OptimizedExcelProcessor(config)
+        output_path = processor.merge_excel_files_optimized(
+            scan(), "合并结果.xlsx", progress_callback=lambda current, total: events.append(('合并', current)))
+        assert events == [('扫描', '分公司1.xlsx'), ('合并', 1), ('扫描', '分公司2.xlsx'), ('合并', 2)]
+        
+        wb = openpyxl.load_workbook(output_path)
+        rows = list(wb.active.values)
+        wb.close()
+        assert rows[0] == ('姓名', '部门', '薪资')
+        assert [row[0] for row in rows[1:]] == ['张一', '张三', '张五', '张二', '张四']
+
+def test_source_column_keeps_surrounding_spaces():
+    """来源列改为共享字符串后，首尾带空格的来源文件名保持原样"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        input_files = create_branch_files(tmpdir)
+        spaced = Path(tmpdir) / " 分公司2.xlsx"
+        Path(input_files[1]).rename(spaced)
+        rows = merged_rows([input_files[0], str(spaced)], tmpdir, source_column='来源文件')
+        position = rows[0].index('来源文件')
+        assert [row[position] for row in rows[1:]] == ['分公司1.xlsx'] * 3 + [' 分公司2.xlsx'] * 2
+        
+        with zipfile.ZipFile(Path(tmpdir) / "合并结果.xlsx") as archive:
+            shared = archive.read("xl/sharedStrings.xml").decode("utf-8")
+        assert '<t xml:space="preserve"> 分公司2.xlsx</t>' in shared
+        assert '<t>分公司1.xlsx</t>' in shared
+
+if __name__ == "__main__":
+    test_presorted_merge_keeps_all_columns()
+    test_merge_paths_agree()
+    test_dedup_keep_first_and_last()
+    test_dedup_keep_newest_file()
+    test_append_merge_matches_full_merge()
+    test_multi_sheet_merge_reconciles_each_sheet()
+    test_streaming_merge_reads_iterator_lazily()
+    test_source_column_keeps_surrounding_spaces()
+    print("合并路径测试完成！")
@@ -24,6 +24,8 @@ from pathlib import Path
 from typing import Dict, List, Any, Optional, Tuple
 from dataclasses import dataclass
 import argparse
+import glob
+import itertools
 from datetime import datetime
 
 import pandas as pd
@@ -368,6 +370,53 @@ def create_sample_config():
     
     logger.info("已创建示例配置文件: config.json, config.yaml, config_with_groups.json, config_with_groups.yaml")
 
+def iter_merge_inputs(args):
+    """惰性产出合并输入：--input-dir 按目录扫描，--input 中的通配符按glob展开"""
+    from excel_processor_optimized import discover_input_files
+    
+    if args.input_dir:
+        yield from discover_input_files(args.input_dir, args.pattern, args.recursive)
+    if args.input:
+        for item in args.input.split(','):
+            item = item.strip()
+            if glob.has_magic(item):
+                yield from sorted(glob.iglob(item, recursive=args.recursive))
+            elif item:
+                yield item
+
+def streaming_merge_from_inputs(args):
+    """目录/通配符输入的合并：预读文件数有上限，交给优化版流式合并写出
+    
+    给定 --columns 时边扫描边读取；否则先扫描出全部文件并预读表头确定输出列。
+    配置了排序字段时无法流式写出，改为读入全部文件排序后写出。
+    """
+    from excel_processor_optimized import OptimizedExcelProcessor, load_config_optimized
+    
+    config = load_config_optimized(args.config)
+    config.streaming_merge = True
+    if args.prefetch:
+        config.prefetch_files = args.prefetch
+    if args.columns:
+        config.merge_columns = [col.strip() for col in args.columns.split(',') if col.strip()]
+    if config.sort_fields:
+        logger.warning(f"配置了排序字段 {config.sort_fields}，不能流式合并，将读入全部文件排序后写出")
+    output_path = Path(args.output).resolve()
+    config.output_dir = str(output_path.parent)
+    
+    input_files = (f for f in iter_merge_inputs(args) if Path(f).resolve() != output_path)
+    first_file = next(input_files, None)
+    if first_file is None:
+        raise ValueError("没有找到匹配的输入文件")
+    if isinstance(config.keep_fields, list):
+        # 基础版配置的保留字段是列表，按第一个文件的第一个sheet转换为优化版的按sheet配置
+        wb = openpyxl.load_workbook(first_file, read_only=True)
+        config.keep_fields = {wb.sheetnames[0]: config.keep_fields}
+        wb.close()
+    
+    processor = OptimizedExcelProcessor(config)
+    result = processor.merge_excel_files_optimized(itertools.chain([first_file], input_files), output_path.name)
+    logger.info(f"合并完成: {result}")
+
 def main():
     """主函数 - 命令行接口"""
     parser = argparse.ArgumentParser(description='Excel处理自动化工作台')
@@ -376,7 +425,17 @@ def main():
     parser.add_argument('--config', '-c',
                        help='配置文件路径 (JSON或YAML)。拆分模式支持自定义分组配置')
     parser.add_argument('--input', '-i',
-                       help='输入文件路径 (拆分模式) 或文件列表 (合并模式，用逗号分隔)')
+                       help='输入文件路径 (拆分模式) 或文件列表 (合并模式，用逗号分隔，支持通配符如 stores/*.xlsx)')
+    parser.add_argument('--input-dir',
+                       help='合并模式：输入目录，合并其中匹配 --pattern 的文件（配合 --columns 边扫描边合并）')
+    parser.add_argument('--pattern', default='*.xlsx',
+                       help='与 --input-dir 一起使用的文件名通配符 (默认: *.xlsx)')
+    parser.add_argument('--recursive', action='store_true',
+                       help='递归扫描子目录（通配符中的 ** 同样需要此选项）')
+    parser.add_argument('--prefetch', type=int,
+                       help='合并时最多预读的文件数，限制同时打开的文件数和内存占用')
+    parser.add_argument('--columns',
+                       help='目录/通配符合并时输出的列 (用逗号分隔)，给定后不预读表头，边扫描边合并')
     parser.add_argument('--output', '-o',
                        help='输出文件路径 (仅合并模式需要)')
     parser.add_argument('--create-config', action='store_true',
@@ -394,12 +453,19 @@ def main():
         missing.append('--mode')
     if not args.config:
         missing.append('--config/-c')
-    if not args.input:
-        missing.append('--input/-i')
+    if not args.input and not (args.mode == 'merge' and args.input_dir):
+        missing.append('--input/-i' + (' 或 --input-dir' if args.mode == 'merge' else ''))
     if missing:
         parser.error(f'the following arguments are required: {", ".join(missing)}')
     
     try:
+        if args.mode == 'merge' and (args.input_dir or glob.has_magic(args.input or '')):
+            # 大量文件：惰性发现 + 有界预读，使用优化版配置和流式合并
+            if not args.output:
+                raise ValueError("合并模式需要指定输出文件路径 (--output)")
+            streaming_merge_from_inputs(args)
+            return
+        
         # 加载配置
         config = load_config(args.config)
         